@@ -0,0 +1,857 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the NS trip notifier
+"""
+import bisect
+import click
+import collections
+import configparser
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import io
+import json
+import ns_api
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+from urllib.parse import urlparse
+
+import config
+import ns_client
+import ns_notifications
+from ns_notifications import STATE_CODECS, diff_disruptions, dump_objects, get_disruption_hash, get_serializer, \
+    json_deserializer
+from fake_services import FakeNS, FakeOpenHAB, RecordingNSAPI
+from history import DelayHistory
+from planner import ViaIndex, rank_trips
+from prediction import DelayModel
+import replay
+from sharding import Shard
+from state_store import LRUStore, MemcacheStore, SQLiteStore
+from stations import StationIndex
+
+
+## Synthetic NS API objects and the state the notifier stores them in
+STATIONS = ['Amsterdam Centraal', 'Amsterdam Sloterdijk', 'Haarlem', 'Heemskerk', 'Hoofddorp', 'Schiphol Airport',
+            'Leiden Centraal', 'Den Haag Centraal', 'Utrecht Centraal', 'Amersfoort Centraal', 'Zwolle', 'Nijmegen']
+# ns_api stores timezone-aware timestamps
+START_TIME = datetime.datetime(2019, 5, 1, 7, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+
+
+def make_disruption(index, timestamp):
+    """
+    Serialised Disruption number index
+    """
+    departure = STATIONS[index % len(STATIONS)]
+    destination = STATIONS[(index * 7 + 3) % len(STATIONS)]
+    return json.dumps({
+        'key': 'prio-' + str(100000 + index),
+        'line': departure + ' - ' + destination,
+        'disruption': 'Tussen ' + departure + ' en ' + destination + ' rijden minder treinen door een defect aan '
+                      'het spoor. Houd rekening met een langere reistijd van ' + str(index % 60) + ' minuten.',
+        'timestamp': (timestamp + datetime.timedelta(minutes=index)).isoformat(),
+        'class_name': 'Disruption',
+    }, ensure_ascii=False)
+
+
+def make_disruption_objects(count, timestamp, changed_every=0):
+    """
+    List of count Disruption objects; with changed_every, the text of every so many is different
+    """
+    disruptions = []
+    for disruption_json in [make_disruption(index, timestamp) for index in range(count)]:
+        disruption = ns_api.Disruption()
+        disruption.from_json(disruption_json)
+        disruptions.append(disruption)
+    if changed_every:
+        for disruption in disruptions[::changed_every]:
+            disruption.disruption = disruption.disruption + ' Update: er rijden weer treinen.'
+    return disruptions
+
+
+def make_stop(name, stop_time, platform):
+    """
+    Serialised TripStop
+    """
+    return json.dumps({
+        'name': name,
+        'planned_time': stop_time.isoformat(),
+        'key': stop_time.strftime('%H:%M') + '_' + name,
+        'time': stop_time.isoformat(),
+        'actual_time': stop_time.isoformat(),
+        'actual_key': stop_time.strftime('%H:%M') + '_' + name,
+        'platform_changed': False,
+        'planned_platform': platform,
+        'actual_platform': platform,
+        'delay': None,
+        'class_name': 'TripStop',
+    }, ensure_ascii=False)
+
+
+def make_trip(index, timestamp):
+    """
+    Serialised Trip number index, with one transfer
+    """
+    departure_time = timestamp + datetime.timedelta(minutes=index)
+    parts = []
+    for part in range(2):
+        stops = []
+        for stop in range(6):
+            name = STATIONS[(index + part * 6 + stop) % len(STATIONS)]
+            stops.append(make_stop(name, departure_time + datetime.timedelta(minutes=part * 30 + stop * 5),
+                                   str(1 + stop % 8) + 'a'))
+        parts.append(json.dumps({
+            'trip_type': 'PUBLIC_TRANSIT',
+            'transporter': 'NS',
+            'transport_type': 'IC' if part else 'SPR',
+            'journey_id': str(3000 + index * 2 + part),
+            'going': True,
+            'has_delay': bool(index % 3),
+            'crowd_forecast': 'MEDIUM',
+            'stops': stops,
+            'class_name': 'TripSubpart',
+        }, ensure_ascii=False))
+    arrival_time = departure_time + datetime.timedelta(minutes=55)
+    return json.dumps({
+        'status': 'NORMAL' if index % 4 else 'DISRUPTION',
+        'nr_transfers': 1,
+        'travel_time_planned': 55,
+        'going': True,
+        'travel_time_actual': 55 + index % 7,
+        'requested_time': departure_time.isoformat(),
+        'crowd_forecast': 'MEDIUM',
+        'departure_time_planned': departure_time.isoformat(),
+        'departure_time_actual': (departure_time + datetime.timedelta(minutes=index % 7)).isoformat(),
+        'arrival_time_planned': arrival_time.isoformat(),
+        'arrival_time_actual': (arrival_time + datetime.timedelta(minutes=index % 7)).isoformat(),
+        'departure_platform_planned': '4',
+        'departure_platform_actual': '4',
+        'arrival_platform_planned': '7b',
+        'arrival_platform_actual': '7b',
+        'trip_parts': parts,
+        'trip_remarks': [],
+        'class_name': 'Trip',
+    }, ensure_ascii=False)
+
+
+def make_trip_objects(count, timestamp, first=0):
+    """
+    List of count Trip objects, starting at trip number first
+    """
+    trips = []
+    for trip_json in [make_trip(index, timestamp) for index in range(first, first + count)]:
+        trip = ns_api.Trip()
+        trip.from_json(trip_json)
+        trips.append(trip)
+    return trips
+
+
+def make_state(nr_disruptions, nr_trips):
+    """
+    The prev_disruptions and <userkey>_trips values as the notifier stores them
+    """
+    timestamp = START_TIME
+    _, _, unplanned, hashes = diff_disruptions({}, make_disruption_objects(nr_disruptions, timestamp))
+    return {
+        'prev_disruptions': {'unplanned': unplanned, 'planned': [], 'hashes': hashes},
+        '1_trips': dump_objects(make_trip_objects(nr_trips, timestamp)),
+    }
+
+
+def fill_history(delay_history, routes, days):
+    """
+    Record days of synthetic trains of routes in delay_history, returning the first day
+    """
+    first_day = START_TIME - datetime.timedelta(days=days)
+    for day in range(days):
+        observations = []
+        for index in range(routes):
+            departure_planned = first_day + datetime.timedelta(days=day, minutes=index * 3)
+            observations.append({'route': 'route ' + str(index), 'departure_planned': departure_planned,
+                                 'departure_delay': (index * day) % 11 * 60, 'arrival_delay': (index + day) % 7 * 60,
+                                 'cancelled': (index * day) % 97 == 0, 'disruptions': (index + day) % 5 == 0})
+        delay_history.record(observations)
+    return first_day
+
+
+def write_harness_config(config_dir, ns_url, openhab_url, routes, users, whole_day=False):
+    """
+    Write a config.ini for the harness: routes spread over users (all of them also share the first route),
+    departing in the coming hour (whole_day: between 6 and 22 hours), state in SQLite in config_dir
+    """
+    now = datetime.datetime.now()
+    all_routes = []
+    for index in range(routes):
+        departure = STATIONS[index % len(STATIONS)]
+        destination = STATIONS[(index * 5 + 1) % len(STATIONS)]
+        if departure == destination:
+            destination = STATIONS[(index + 1) % len(STATIONS)]
+        if whole_day:
+            departure_time = datetime.datetime.combine(now.date(), datetime.time(6)) + datetime.timedelta(
+                minutes=index * 16 * 60 // routes)
+        else:
+            departure_time = now + datetime.timedelta(minutes=5 + index % 50)
+        all_routes.append({'departure': departure, 'destination': destination,
+                           'time': departure_time.strftime('%H:%M'), 'keyword': None, 'minimum': 2})
+    settings = configparser.ConfigParser()
+    settings['General'] = {'apikey': 'harness', 'ns_api_url': ns_url, 'state_backend': 'sqlite',
+                           'state_path': os.path.join(config_dir, 'state.sqlite'), 'history_path': '',
+                           'model_path': '', 'metrics_textfile': '', 'userkey': '1'}
+    settings['Openhab'] = {'openhab_url': openhab_url, 'openhab_item_route_name': 'NS_RouteName'}
+    for user in range(users):
+        user_routes = [all_routes[0]] + all_routes[user + 1::users]
+        section = {'routes': repr(user_routes),
+                   'openhab_item_trains': json.dumps(['U{0}_Train{1}'.format(user, item) for item in range(1, 4)]),
+                   'openhab_item_notifications': 'U{0}_Notifications'.format(user)}
+        if user == 0:
+            settings['Routes'] = {'routes': section.pop('routes')}
+            settings['Openhab'].update(section)
+        else:
+            settings['User ' + str(user + 1)] = section
+    with open(os.path.join(config_dir, 'config.ini'), 'w') as config_file:
+        settings.write(config_file)
+    return all_routes
+
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100.0))]
+
+
+def run_scenario(function, runs, before_run=None):
+    """
+    Call function runs times, returning the latencies (in seconds) of the calls, the number of failed calls and the
+    traceback of the first failure (None if none failed). Output of the notifier is swallowed
+    """
+    latencies = []
+    failures = 0
+    first_error = None
+    for run in range(runs):
+        if before_run:
+            before_run(run)
+        started = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                function()
+        except (Exception, SystemExit):
+            failures += 1
+            if first_error is None:
+                first_error = traceback.format_exc()
+        latencies.append(time.perf_counter() - started)
+    return latencies, failures, first_error
+
+
+def get_peak_memory(function):
+    """
+    Peak memory (in KiB) allocated by Python while calling function once
+    """
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+    except (Exception, SystemExit):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024.0
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Print the change of every result against baseline, returning the number of results that got worse than
+    tolerance (a percentage). Only throughput is better when higher
+    """
+    regressions = 0
+    for scenario, result in results.items():
+        for name, value in sorted(result.items()):
+            previous = baseline.get(scenario, {}).get(name)
+            if name in ('runs', 'failures') or not previous:
+                continue
+            change = (value - previous) / float(previous) * 100
+            worse = change < -tolerance if name == 'throughput' else change > tolerance
+            regressions += worse
+            click.echo('{0:<22} {1:<18} {2:>10.2f} {3:>10.2f} {4:>+8.1f}%{5}'.format(
+                scenario, name, previous, value, change, '  WORSE' if worse else ''))
+    return regressions
+
+
+def time_call(function, repeat):
+    """
+    Average wall time of function in microseconds
+    """
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat * 1000000
+
+
+## Benchmarks
+@click.group()
+def cli():
+    """
+    NS-Notifications benchmarks
+    """
+    pass
+
+
+@cli.command()
+@click.option('--disruptions', default=500, help='Number of disruptions in the state')
+@click.option('--trips', default=100, help='Number of trips in the state')
+@click.option('--repeat', default=50, help='Number of times each operation is timed')
+def codec(disruptions, trips, repeat):
+    """
+    Compare size and (de)serialisation time of the state codecs
+    """
+    state = make_state(disruptions, trips)
+    click.echo('{0:<14} {1:<18} {2:>10} {3:>14} {4:>14}'.format('codec', 'key', 'bytes', 'serialize us',
+                                                                'deserialize us'))
+    for codec_name in STATE_CODECS:
+        try:
+            serializer = get_serializer(codec_name)
+        except ValueError as e:
+            click.echo('{0:<14} skipped: {1}'.format(codec_name, e))
+            continue
+        for key, value in state.items():
+            stored, flags = serializer(key, value)
+            assert json_deserializer(key, stored, flags) == value
+            serialize_time = time_call(lambda: serializer(key, value), repeat)
+            deserialize_time = time_call(lambda: json_deserializer(key, stored, flags), repeat)
+            click.echo('{0:<14} {1:<18} {2:>10} {3:>14.0f} {4:>14.0f}'.format(codec_name, key, len(stored),
+                                                                             serialize_time, deserialize_time))
+
+
+@cli.command()
+@click.option('--sizes', default='10,100,1000', help='Comma separated numbers of disruptions')
+@click.option('--repeat', default=20, help='Number of times each diff is timed')
+def diff(sizes, repeat):
+    """
+    Compare the hash-indexed disruption diff with the ns_api list_diff/list_merge approach
+    """
+    timestamp = START_TIME
+    click.echo('{0:>8} {1:>16} {2:>16}'.format('size', 'list_diff us', 'hash diff us'))
+    for size in [int(value) for value in sizes.split(',')]:
+        # 90% of the previous disruptions is unchanged, 10% changed or new
+        prev_json = ns_api.list_to_json(make_disruption_objects(size - size // 20, timestamp))
+        current = make_disruption_objects(size, timestamp, changed_every=20)
+
+        def list_approach():
+            prev = ns_api.list_from_json(prev_json)
+            new_or_changed = ns_api.list_diff(prev, current)
+            return ns_api.list_to_json(ns_api.list_merge(prev, new_or_changed))
+
+        prev_hashes = dict((item.key, get_disruption_hash(item)) for item in ns_api.list_from_json(prev_json))
+        click.echo('{0:>8} {1:>16.0f} {2:>16.0f}'.format(size, time_call(list_approach, repeat),
+                                                         time_call(lambda: diff_disruptions(prev_hashes, current),
+                                                                   repeat)))
+
+
+@cli.command()
+@click.option('--disruptions', default=500, help='Number of disruptions in the state')
+@click.option('--users', default=10, help='Number of users with trips in the state')
+@click.option('--trips', default=10, help='Number of trips per user')
+@click.option('--codec', 'codec_name', default='json', type=click.Choice(STATE_CODECS), help='State codec')
+@click.option('--repeat', default=20, help='Number of ticks timed per backend')
+def state(disruptions, users, trips, codec_name, repeat):
+    """
+    Per-tick state read and write latency of the state backends
+    """
+    values = make_state(disruptions, trips)
+    tick_values = {'prev_disruptions': values['prev_disruptions']}
+    for userkey in range(1, users + 1):
+        tick_values[str(userkey) + '_trips'] = values['1_trips']
+    serializer = get_serializer(codec_name)
+
+    stores = [('lru', LRUStore())]
+    database_dir = tempfile.mkdtemp()
+    stores.append(('sqlite', SQLiteStore(os.path.join(database_dir, 'state.sqlite'), serializer, json_deserializer)))
+    memcache = MemcacheStore(('127.0.0.1', 11211), serializer, json_deserializer)
+    try:
+        memcache.get('nsapi_run')
+        stores.append(('memcache', memcache))
+    except (socket.error, OSError):
+        click.echo('memcache skipped: not running on 127.0.0.1:11211')
+
+    click.echo('{0:<10} {1:>10} {2:>10}'.format('backend', 'read ms', 'write ms'))
+    for name, store in stores:
+        store.set_many(tick_values, 3600)
+
+        def read():
+            return store.get_many(list(tick_values.keys()))
+
+        def write():
+            with store.batch():
+                for key, value in tick_values.items():
+                    store.set(key, value, 3600)
+
+        assert read() == tick_values
+        click.echo('{0:<10} {1:>10.2f} {2:>10.2f}'.format(name, time_call(read, repeat) / 1000,
+                                                          time_call(write, repeat) / 1000))
+    shutil.rmtree(database_dir)
+
+
+@cli.command()
+@click.option('--routes', default=200, help='Number of routes in the history')
+@click.option('--days', default=365, help='Number of days in the history')
+def history(routes, days):
+    """
+    Time the punctuality statistics over a synthetic delay history of routes * days trains
+    """
+    database_dir = tempfile.mkdtemp()
+    delay_history = DelayHistory(os.path.join(database_dir, 'history.sqlite'))
+    started = time.perf_counter()
+    first_day = fill_history(delay_history, routes, days)
+    click.echo('Recorded {0} trains in {1:.1f} s'.format(routes * days, time.perf_counter() - started))
+    for per_weekday in (True, False):
+        started = time.perf_counter()
+        rows = delay_history.get_statistics(first_day, per_weekday)
+        click.echo('Statistics {0}: {1} rows in {2:.2f} s'.format('per weekday' if per_weekday else 'per route',
+                                                                 len(rows), time.perf_counter() - started))
+    shutil.rmtree(database_dir)
+
+
+@cli.command()
+@click.option('--routes', default=200, help='Number of routes in the history')
+@click.option('--days', default=365, help='Number of days in the history')
+@click.option('--repeat', default=20, help='Number of times the scoring of all routes is timed')
+def prediction(routes, days, repeat):
+    """
+    Time training the delay prediction model and scoring all routes with it
+    """
+    database_dir = tempfile.mkdtemp()
+    delay_history = DelayHistory(os.path.join(database_dir, 'history.sqlite'))
+    first_day = fill_history(delay_history, routes, days)
+
+    started = time.perf_counter()
+    model = DelayModel.train(delay_history, first_day, 5 * 60)
+    click.echo('Trained on {0} trains ({1} cells) in {2:.2f} s'.format(routes * days, len(model.counts),
+                                                                       time.perf_counter() - started))
+
+    def score_all():
+        return [model.score('route ' + str(index), START_TIME + datetime.timedelta(minutes=index * 3), index % 2)
+                for index in range(routes)]
+
+    click.echo('Scored {0} routes in {1:.0f} us'.format(routes, time_call(score_all, repeat)))
+    shutil.rmtree(database_dir)
+
+
+@cli.command()
+@click.option('--routes', default=100, help='Number of routes in the via index')
+@click.option('--trips', default=5, help='Number of trips in the answer of a route')
+@click.option('--repeat', default=20, help='Number of times planning all routes is timed')
+def planner(routes, trips, repeat):
+    """
+    Time learning via stations and planning alternatives for all routes from the answers already fetched
+    """
+    answers = []
+    for index in range(routes):
+        route_trips = make_trip_objects(trips, START_TIME, index)
+        answers.append((STATIONS[index % len(STATIONS)], STATIONS[(index * 5 + 1) % len(STATIONS)], route_trips))
+
+    def learn_all():
+        via_index = ViaIndex()
+        for departure, destination, route_trips in answers:
+            via_index.learn(departure, destination, route_trips)
+        return via_index
+
+    click.echo('Learned the vias of {0} routes in {1:.0f} us'.format(routes, time_call(learn_all, repeat)))
+    via_index = learn_all()
+
+    def plan_all():
+        return [(rank_trips(route_trips, START_TIME), via_index.get_candidates(departure, destination, 2))
+                for departure, destination, route_trips in answers]
+
+    click.echo('Planned {0} routes of {1} trips in {2:.0f} us'.format(routes, trips, time_call(plan_all, repeat)))
+
+
+@cli.command()
+@click.option('--stations', default=400, help='Number of stations in the index')
+@click.option('--repeat', default=20, help='Number of times the lookups are timed')
+def stations(stations, repeat):
+    """
+    Time building the station index and resolving exact, prefix and misspelled station names
+    """
+    entries = [['S' + str(index), STATIONS[index % len(STATIONS)] + ' ' + str(index),
+                [STATIONS[index % len(STATIONS)][:8] + str(index)]] for index in range(stations)]
+    click.echo('Built the index of {0} stations in {1:.0f} us'.format(
+        stations, time_call(lambda: StationIndex(entries), repeat)))
+    station_index = StationIndex(entries)
+    names = [('exact', entries[-1][1]), ('prefix', 'Zwolle 1'), ('misspelled', 'Amsterdm Centraal 12')]
+    for kind, name in names:
+        click.echo('Resolved the {0} name in {1:.0f} us'.format(
+            kind, time_call(lambda: station_index.resolve(name), repeat)))
+
+
+def get_import_times(stderr):
+    """
+    (cumulative microseconds, module) of the top-level imports in the output of python -X importtime
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        # Nested imports are indented below the module importing them
+        if not module[1:].startswith(' '):
+            imports.append((int(cumulative), module.strip()))
+    return imports
+
+
+@cli.command()
+@click.option('--repeat', default=5, help='Number of times each command is started')
+@click.option('--routes', default=500, help='Number of routes in the configuration that is loaded')
+@click.option('--top', default=5, help='Number of slowest imports shown')
+@click.option('--run-routes', default=20, help='Number of routes of the timed run_all_notifications')
+def startup(repeat, routes, top, run_routes):
+    """
+    Time starting every command of ns_notifications (python -X importtime, the median wall time of <command>
+    --help), a whole run_all_notifications against the stand-ins of the NS API and openHAB, and loading a
+    configuration with and without its compiled cache
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ns_notifications.py')
+    for name in sorted(ns_notifications.cli.commands):
+        wall_times = []
+        imports = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            process = subprocess.run([sys.executable, '-X', 'importtime', script, name, '--help'],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+            wall_times.append(time.perf_counter() - started)
+            imports = get_import_times(process.stderr)
+        click.echo('{0}: started in {1:.0f} ms, slowest imports: {2}'.format(
+            name, get_percentile(wall_times, 50) * 1000,
+            ', '.join('{0} {1:.0f} ms'.format(module, cumulative / 1000.0)
+                      for cumulative, module in sorted(imports, reverse=True)[:top])))
+
+    ## A whole run as cron starts it, from starting the process until it exits
+    fake_ns = FakeNS(STATIONS, 50).start()
+    fake_openhab = FakeOpenHAB().start()
+    run_dir = tempfile.mkdtemp(prefix='nsapi_startup_run_')
+    try:
+        write_harness_config(run_dir, fake_ns.url, fake_openhab.url, run_routes, max(1, run_routes // 4))
+        command = ns_notifications.run_all_notifications.name
+        wall_times = []
+        for run in range(repeat):
+            fake_ns.generation = run
+            started = time.perf_counter()
+            # In run_dir, which gets the log files
+            process = subprocess.run([sys.executable, script, command, '--config_dir', run_dir], cwd=run_dir,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+            wall_times.append(time.perf_counter() - started)
+            if process.returncode:
+                click.echo(command + ' failed:\n' + process.stderr, err=True)
+                sys.exit(1)
+        click.echo('{0} of {1} routes: {2:.0f} ms from start to exit, the first run (empty state) {3:.0f} ms, '
+                   '{4:.1f} NS API requests per run'.format(command, run_routes, get_percentile(wall_times, 50) * 1000,
+                                                            wall_times[0] * 1000, fake_ns.requests / float(repeat)))
+    finally:
+        fake_ns.stop()
+        fake_openhab.stop()
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    work_dir = tempfile.mkdtemp(prefix='nsapi_startup_')
+    try:
+        write_harness_config(work_dir, 'http://localhost', 'http://localhost', routes, max(1, routes // 50))
+        click.echo('Loaded the configuration of {0} routes in {1:.0f} us without cache'.format(
+            routes, time_call(lambda: config.load_settings(work_dir, use_cache=False), repeat)))
+        config.load_settings(work_dir)
+        click.echo('Loaded the configuration of {0} routes in {1:.0f} us from its cache'.format(
+            routes, time_call(lambda: config.load_settings(work_dir), repeat)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@cli.command()
+@click.option('--routes', default=20, help='Number of distinct routes (N)')
+@click.option('--users', default=5, help='Number of users sharing the routes (M)')
+@click.option('--disruptions', default=50, help='Number of disruptions the NS stand-in reports (K)')
+@click.option('--runs', default=10, help='Number of times each scenario is run')
+@click.option('--latency', default=20, help='Milliseconds every request to the stand-ins takes')
+@click.option('--error-rate', default=0.0, help='Share (0-1) of the requests to the stand-ins that fail')
+@click.option('--fixtures', default=None, help='Directory with recorded NS API responses, see record-fixtures')
+@click.option('--baseline', default=None, help='JSON file with results of an earlier harness run to compare with')
+@click.option('--save-baseline', is_flag=True, help='Save the results in the --baseline file')
+@click.option('--tolerance', default=10.0, help='Percentage a result may be worse than the baseline')
+def harness(routes, users, disruptions, runs, latency, error_rate, fixtures, baseline, save_baseline, tolerance):
+    """
+    Run run_all_notifications, check_connections and the status page of server.py against stand-ins of
+    the NS API and openHAB, reporting throughput, latency percentiles and peak memory
+    """
+    work_dir = tempfile.mkdtemp()
+    original_dir = os.getcwd()
+    fake_ns = FakeNS(STATIONS, disruptions, fixtures, latency=latency / 1000.0, error_rate=error_rate).start()
+    fake_openhab = FakeOpenHAB(latency=latency / 1000.0, error_rate=error_rate).start()
+    all_routes = write_harness_config(work_dir, fake_ns.url, fake_openhab.url, routes, users)
+    # Keep the log files of the notifier and server out of the working copy
+    os.chdir(work_dir)
+    try:
+        settings = ns_notifications.get_config(work_dir)
+        mc = ns_notifications.get_state_store(settings)
+
+        def set_generation(run):
+            fake_ns.generation = run
+
+        scenarios = [
+            ('run_all_notifications', lambda: ns_notifications.run_all_notifications.callback(work_dir), set_generation),
+            ('check_connections', lambda: ns_notifications.check_connections.callback(
+                all_routes[0]['departure'], all_routes[0]['destination'], all_routes[0]['time'], work_dir), None),
+        ]
+        try:
+            # server.py reads config.ini from sys.path[0] when imported
+            sys.path.insert(0, work_dir)
+            try:
+                import server
+            finally:
+                sys.path.remove(work_dir)
+            server.settings, server.mc = settings, mc
+            client = server.app.test_client()
+
+            def get_status_pages():
+                # Render every page again, as after a run of the notifier that changed everything
+                server.rendered_pages.clear()
+                for user in range(users):
+                    client.get('/user/' + str(user + 1))
+            scenarios.append(('status_page', get_status_pages, None))
+        except ImportError as e:
+            click.echo('Skipping the status page: ' + repr(e))
+
+        results = {}
+        errors = {}
+        for name, function, before_run in scenarios:
+            ns_requests, openhab_requests = fake_ns.requests, fake_openhab.requests
+            started = time.perf_counter()
+            latencies, failures, errors[name] = run_scenario(function, runs, before_run)
+            duration = time.perf_counter() - started
+            results[name] = {
+                'runs': runs, 'failures': failures, 'throughput': runs / duration,
+                'p50_ms': get_percentile(latencies, 50) * 1000, 'p90_ms': get_percentile(latencies, 90) * 1000,
+                'p99_ms': get_percentile(latencies, 99) * 1000,
+                'ns_requests': (fake_ns.requests - ns_requests) / float(runs),
+                'openhab_requests': (fake_openhab.requests - openhab_requests) / float(runs),
+                'peak_memory_kb': get_peak_memory(function),
+            }
+    finally:
+        os.chdir(original_dir)
+        fake_ns.stop()
+        fake_openhab.stop()
+        shutil.rmtree(work_dir)
+
+    click.echo('{0} routes, {1} users, {2} disruptions, {3} ms latency, {4:.0%} errors'.format(
+        routes, users, disruptions, latency, error_rate))
+    click.echo('{0:<22} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>8} {7:>8} {8:>10}'.format(
+        'scenario', 'runs/s', 'p50 ms', 'p90 ms', 'p99 ms', 'failures', 'NS/run', 'oH/run', 'peak KiB'))
+    for name, result in results.items():
+        click.echo('{0:<22} {throughput:>8.2f} {p50_ms:>9.1f} {p90_ms:>9.1f} {p99_ms:>9.1f} {failures:>9} '
+                   '{ns_requests:>8.1f} {openhab_requests:>8.1f} {peak_memory_kb:>10.0f}'.format(name, **result))
+
+    ## The timings of runs that failed say nothing, show why they failed instead of comparing them
+    failed = [name for name, result in results.items() if result['failures']]
+    for name in failed:
+        click.echo('\nFirst failure of ' + name + ':\n' + errors[name], err=True)
+    if failed:
+        click.echo('{0} scenarios had failed runs'.format(len(failed)), err=True)
+        sys.exit(1)
+
+    if baseline and save_baseline:
+        with open(baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        click.echo('Saved the results in ' + baseline)
+    elif baseline:
+        with open(baseline) as baseline_file:
+            regressions = compare_with_baseline(results, json.load(baseline_file), tolerance)
+        if regressions:
+            click.echo('{0} results are more than {1}% worse than the baseline'.format(regressions, tolerance))
+            sys.exit(1)
+
+
+class LRUClient(LRUStore):
+    """
+    Client of the LRUStore server, like the memcache client of one node: the keys are the ones of server,
+    batches are its own
+    """
+
+    def __init__(self, server):
+        super(LRUClient, self).__init__(server.maxsize, server.clock)
+        self._values = server._values
+        self._lock = server._lock
+
+
+@cli.command()
+@click.option('--routes', default=60, help='Number of distinct routes')
+@click.option('--users', default=5, help='Number of users sharing the routes')
+@click.option('--nodes', default='1,2,4', help='Comma separated numbers of nodes to simulate')
+@click.option('--runs', default=3, help='Number of runs of every node per number of nodes')
+@click.option('--latency', default=20, help='Milliseconds every request to the stand-ins takes')
+@click.option('--lease-ttl', default=10, help='Seconds before the routes of a stopped node are taken over')
+def sharding(routes, users, nodes, runs, latency, lease_ttl):
+    """
+    Simulate several notifier nodes sharing one state store (an LRUStore standing in for memcache): the requests
+    to the NS API per run should not change with the number of nodes, while every node polls fewer routes.
+    Stops the node holding the disruptions lease at the end, to show the others take over its work.
+    All nodes share the CPU of this process, so their run time does not go down like it would on separate hosts
+    """
+    work_dir = tempfile.mkdtemp()
+    original_dir = os.getcwd()
+    fake_ns = FakeNS(STATIONS, 20, latency=latency / 1000.0).start()
+    # Every node sends to the openHAB items of its users, only the polling is split
+    fake_openhab = FakeOpenHAB().start()
+    write_harness_config(work_dir, fake_ns.url, fake_openhab.url, routes, users)
+    os.chdir(work_dir)
+    try:
+        settings = ns_notifications.get_config(work_dir)
+        logger = ns_notifications.get_logger(settings)
+        click.echo('{0:>5} {1:>8} {2:>16} {3:>9} {4:>9}'.format('nodes', 'NS/run', 'queries/node', 'scaling',
+                                                             'run ms'))
+
+        def run_node(shard):
+            """
+            One run of the node of shard, with its own NS API handle. Returns the number of trip queries it did
+            """
+            nsapi = ns_notifications.get_nsapi(settings)
+            ns_notifications.run_notifications(settings, shard.mc, nsapi, logger, shard=shard)
+            return nsapi.misses
+
+        def run_nodes(shards, generation):
+            """
+            One run of all nodes at the same time, like separate hosts. Returns the requests to the NS API, the
+            trip queries per node and the duration of the run
+            """
+            fake_ns.generation = generation
+            ns_requests = fake_ns.requests
+            started = time.perf_counter()
+            with ThreadPoolExecutor(len(shards)) as executor:
+                queries = list(executor.map(run_node, shards))
+            return fake_ns.requests - ns_requests, queries, time.perf_counter() - started
+
+        def show(node_count, results, note=''):
+            # With a host per node, a run takes as long as the busiest node: the scaling is the number of
+            # queries of one node doing everything, divided by the queries of the busiest node
+            queries = [max(result[1]) for result in results]
+            click.echo('{0:>5} {1:>8.1f} {2:>16} {3:>8.1f}x {4:>9.0f}{5}'.format(
+                node_count, sum(result[0] for result in results) / float(len(results)),
+                '/'.join(str(count) for count in results[-1][1]), routes * len(queries) / float(sum(queries)),
+                sum(result[2] for result in results) / len(results) * 1000, note))
+
+        generation = 0
+        for node_count in [int(count) for count in nodes.split(',')]:
+            server = LRUStore()
+            shards = [Shard(LRUClient(server), 'node' + str(node), lease_ttl) for node in range(node_count)]
+            # The first run resolves the stations and lets all nodes join
+            generation += 1
+            run_nodes(shards, generation)
+            results = []
+            for _ in range(runs):
+                generation += 1
+                results.append(run_nodes(shards, generation))
+            show(node_count, results)
+
+        if len(shards) > 1:
+            leader = server.get('shard_lease_disruptions')
+            shards = [shard for shard in shards if shard.node_id != leader]
+            click.echo('Stopped {0}, the holder of the disruptions lease, running the others for {1} s'.format(
+                leader, lease_ttl))
+            stopped = time.perf_counter()
+            while time.perf_counter() - stopped <= lease_ttl:
+                generation += 1
+                run_nodes(shards, generation)
+            generation += 1
+            show(len(shards), [run_nodes(shards, generation)],
+                 '   disruptions checked by ' + str(server.get('shard_lease_disruptions')))
+    finally:
+        os.chdir(original_dir)
+        fake_ns.stop()
+        fake_openhab.stop()
+        shutil.rmtree(work_dir)
+
+
+class GeneratedRecording(object):
+    """
+    Recording of a day made up by fake_ns, without network: a snapshot every interval seconds from start,
+    with other delays in every snapshot
+    """
+
+    def __init__(self, fake_ns, start, hours, interval):
+        self.fake_ns = fake_ns
+        self.times = [start + datetime.timedelta(seconds=offset) for offset in range(0, int(hours * 3600), interval)]
+
+    def get_snapshot(self, moment):
+        return max(0, bisect.bisect(self.times, moment) - 1)
+
+    def respond(self, moment, url):
+        # All queries of a run are done at the same moment, so they agree on the generation
+        self.fake_ns.generation = self.get_snapshot(moment)
+        status, text = self.fake_ns.respond('GET', urlparse(url), None)
+        return text if status == 200 else None
+
+
+@cli.command('replay')
+@click.option('--routes', default=300, help='Number of routes, departing between 6 and 22 hours')
+@click.option('--users', default=20, help='Number of users sharing the routes')
+@click.option('--disruptions', default=20, help='Number of disruptions in every snapshot')
+@click.option('--hours', default=24.0, help='Hours to replay, from midnight')
+@click.option('--snapshot-interval', default=300, help='Seconds between two snapshots of the NS API')
+@click.option('--interval', default=ns_notifications.DAEMON_INTERVAL,
+              help='Seconds between polls of the disruptions (and of the routes with the interval strategy)')
+def replay_day(routes, users, disruptions, hours, snapshot_interval, interval):
+    """
+    Replay a generated day of NS API answers through the notifier with both polling strategies, timing the replay
+    """
+    work_dir = tempfile.mkdtemp()
+    fake_ns = FakeNS(STATIONS, disruptions)
+    try:
+        write_harness_config(work_dir, 'http://localhost', 'http://localhost', routes, users, whole_day=True)
+        settings = replay.get_replay_settings(ns_notifications.get_config(work_dir))
+        start = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+        source = GeneratedRecording(fake_ns, start, hours, snapshot_interval)
+        reports = collections.OrderedDict()
+        # Like the replay command, the strategies share the parsed trips
+        answers = {}
+        for strategy in ('schedule', 'interval'):
+            started = time.perf_counter()
+            reports[strategy] = replay.replay(settings, source, start, start + datetime.timedelta(hours=hours),
+                                              strategy, interval, answers=answers)
+            reports[strategy]['replay_seconds'] = time.perf_counter() - started
+    finally:
+        fake_ns.server.server_close()
+        shutil.rmtree(work_dir)
+    click.echo('{0} routes, {1} users, {2} hours, a snapshot every {3} s'.format(routes, users, hours,
+                                                                             snapshot_interval))
+    for line in replay.format_reports(reports):
+        click.echo(line)
+
+
+@cli.command('record-fixtures')
+@click.option('--config_dir', default=sys.path[0], help='Directory where config.ini is located')
+@click.option('--fixtures', required=True, help='Directory to save the responses of the NS API in')
+@click.option('--snapshot', is_flag=True, help='Save them in a directory named after the current time, for replay '
+                                               '(run it from cron to record a day)')
+def record_fixtures(config_dir, fixtures, snapshot):
+    """
+    Save the current disruptions, stations and the trips of the configured routes from the NS API,
+    for harness --fixtures and ns_notifications.py replay --recording
+    """
+    settings = ns_notifications.get_config(config_dir)
+    if snapshot:
+        fixtures = os.path.join(fixtures, datetime.datetime.now().strftime(replay.SNAPSHOT_FORMAT))
+    if not os.path.isdir(fixtures):
+        os.makedirs(fixtures)
+    nsapi = RecordingNSAPI(settings['General'].get('apikey', ''), fixtures,
+                           base_url=settings['General'].get('ns_api_url', ns_client.NS_API_URL))
+    nsapi.get_disruptions()
+    station_index = StationIndex.from_stations(nsapi.get_stations())
+    for routes in ns_notifications.get_user_routes(settings).values():
+        for route in routes:
+            route, problems = ns_notifications.normalise_route(route, station_index)
+            if not problems:
+                ns_notifications.fetch_route_trips(nsapi, route)
+    click.echo('Saved {0} responses in {1}'.format(len(os.listdir(fixtures)), fixtures))
+
+
+if __name__ == '__main__':
+    cli()
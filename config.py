@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Loading of config.ini: the file is parsed and checked once, and the result is cached next to it (keyed by the
+modification times of the configuration files), so starting a command does not parse the routes again
+"""
+import ast
+import collections
+import datetime
+import json
+import os
+from configparser import ConfigParser
+
+CONFIG_FILES = ('config.ini.dist', 'config.ini')
+CACHE_FILE = '.config.cache.json'
+# Changes when the cached format changes
+CACHE_VERSION = 2
+
+
+class ConfigError(ValueError):
+    """
+    The configuration has values that can't be used
+    """
+
+
+def get_config_mtime(config_dir):
+    """
+    Modification times of the configuration files, to detect changes in daemon mode
+    """
+    mtimes = []
+    for filename in CONFIG_FILES:
+        try:
+            mtimes.append(os.path.getmtime(os.path.join(config_dir, filename)))
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+def parse_route_time(value):
+    """
+    [hours, minutes] of a daily route time like '7:44', or [year, month, day, hours, minutes] of a single
+    date and time like '24-12-2019 7:44'
+    """
+    if len(value) <= 5:
+        parsed = datetime.datetime.strptime(value, '%H:%M')
+        return [parsed.hour, parsed.minute]
+    parsed = datetime.datetime.strptime(value, '%d-%m-%Y %H:%M')
+    return [parsed.year, parsed.month, parsed.day, parsed.hour, parsed.minute]
+
+
+def parse_routes(value, section):
+    """
+    The routes in value (a Python list of dicts), with their times parsed, and written as the NS API wants them
+    ('07:44' or '24-12-2019 07:44'). Raises ConfigError on invalid routes
+    """
+    try:
+        routes = ast.literal_eval(value)
+    except (SyntaxError, ValueError) as e:
+        raise ConfigError('[' + section + '] routes is not a list of routes: ' + str(e))
+    if not isinstance(routes, (list, tuple)):
+        raise ConfigError('[' + section + '] routes is not a list of routes')
+    for route in routes:
+        if not isinstance(route, dict):
+            raise ConfigError('[' + section + '] route ' + repr(route) + ' is not a dict')
+        missing = [field for field in ('departure', 'destination', 'time') if not route.get(field)]
+        if missing:
+            raise ConfigError('[' + section + '] route ' + repr(route) + ' misses ' + ', '.join(missing))
+        try:
+            route['parsed_time'] = parse_route_time(route['time'])
+        except ValueError:
+            raise ConfigError('[' + section + '] route ' + repr(route) + ' has an invalid time, use 7:44 or '
+                              '24-12-2019 7:44')
+        if len(route['parsed_time']) == 2:
+            route['time'] = '{0:02d}:{1:02d}'.format(*route['parsed_time'])
+        else:
+            route['time'] = '{2:02d}-{1:02d}-{0:04d} {3:02d}:{4:02d}'.format(*route['parsed_time'])
+        if 'minimum' in route:
+            try:
+                int(route['minimum'])
+            except (TypeError, ValueError):
+                raise ConfigError('[' + section + '] route ' + repr(route) + ' has an invalid minimum')
+    return list(routes)
+
+
+def parse_items(value, section):
+    try:
+        items = json.loads(value)
+    except ValueError as e:
+        raise ConfigError('[' + section + '] openhab_item_trains is not a JSON list: ' + str(e))
+    if not isinstance(items, list):
+        raise ConfigError('[' + section + '] openhab_item_trains is not a JSON list')
+    return items
+
+
+class Settings(ConfigParser):
+    """
+    The configuration: the sections of config.ini, the flags of [General] and [Routes] as typed attributes,
+    and the users with their (checked) routes and openHAB items in users
+    """
+
+    # attribute: (section, option, type, default)
+    FLAGS = collections.OrderedDict([
+        ('apikey', ('General', 'apikey', str, '')),
+        ('userkey', ('General', 'userkey', str, '1')),
+        ('auto_update', ('General', 'auto_update', bool, False)),
+        ('skip_disruptions', ('Routes', 'skip_disruptions', bool, False)),
+        ('skip_trips', ('Routes', 'skip_trips', bool, False)),
+        ('arrival_delays', ('Routes', 'arrival_delays', bool, True)),
+    ])
+
+    def __init__(self):
+        super(Settings, self).__init__(delimiters=('=', ))
+        self.optionxform = str
+        self.users = collections.OrderedDict()
+        for attribute, (section, option, value_type, default) in self.FLAGS.items():
+            setattr(self, attribute, default)
+
+    def compile(self):
+        """
+        Check the values and set the attributes from them. Raises ConfigError on invalid values
+        """
+        for attribute, (section, option, value_type, default) in self.FLAGS.items():
+            try:
+                if value_type is bool:
+                    value = self.getboolean(section, option, fallback=default)
+                else:
+                    value = self.get(section, option, fallback=default)
+            except ValueError:
+                raise ConfigError('[' + section + '] ' + option + ' should be True or False')
+            setattr(self, attribute, value)
+
+        self.users = collections.OrderedDict()
+        self.users[self.userkey] = self.get_user('Routes', 'Openhab')
+        for section in self.sections():
+            if section.startswith('User '):
+                self.users[section[len('User '):].strip()] = self.get_user(section, section)
+        return self
+
+    def get_user(self, routes_section, items_section):
+        return {
+            'routes': parse_routes(self.get(routes_section, 'routes', fallback='[]'), routes_section),
+            'openhab_item_trains': parse_items(self.get(items_section, 'openhab_item_trains', fallback='[]'),
+                                               items_section),
+            'openhab_item_notifications': self.get(items_section, 'openhab_item_notifications', fallback=None),
+            'openhab_item_prediction': self.get(items_section, 'openhab_item_prediction', fallback=None),
+        }
+
+    def to_json(self):
+        sections = {'DEFAULT': dict(self.defaults())}
+        for section in self.sections():
+            sections[section] = dict(self.items(section, raw=True))
+        return {'sections': sections, 'users': self.users}
+
+    @classmethod
+    def from_json(cls, compiled):
+        settings = cls()
+        settings.read_dict(compiled['sections'])
+        for attribute, (section, option, value_type, default) in cls.FLAGS.items():
+            if value_type is bool:
+                setattr(settings, attribute, settings.getboolean(section, option, fallback=default))
+            else:
+                setattr(settings, attribute, settings.get(section, option, fallback=default))
+        settings.users = collections.OrderedDict(compiled['users'])
+        return settings
+
+
+def load_settings(config_dir, use_cache=True):
+    """
+    The Settings of config_dir: from the cache when the configuration files did not change since it was
+    written, otherwise parsed (and cached, if config_dir is writable)
+    """
+    mtimes = list(get_config_mtime(config_dir))
+    cache_path = os.path.join(config_dir, CACHE_FILE)
+    if use_cache:
+        try:
+            with open(cache_path) as cache_file:
+                cached = json.load(cache_file)
+            if cached['version'] == CACHE_VERSION and cached['mtimes'] == mtimes:
+                return Settings.from_json(cached)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    settings = Settings()
+    settings.read([os.path.join(config_dir, filename) for filename in CONFIG_FILES])
+    settings.compile()
+    if use_cache and any(mtimes):
+        cached = settings.to_json()
+        cached.update(version=CACHE_VERSION, mtimes=mtimes)
+        try:
+            with open(cache_path + '.tmp', 'w') as cache_file:
+                json.dump(cached, cache_file)
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError:
+            # Read-only configuration directory, parse it every time
+            pass
+    return settings
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Delivery of the notifications (changed disruptions, delayed trips) to the sinks: the openHAB notifications item of
+a user, PushBullet and a webhook. Identical notifications are sent once per window, updates of the same trip are
+merged, and a background thread sends them within a rate limit per sink and user
+"""
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import requests
+
+import metrics
+import upstream
+
+# Identical notifications (same user, header and message) are sent once per this many seconds
+DEDUP_WINDOW = 3600
+# Seconds a notification waits for updates of the same trip or disruption before it is sent
+COALESCE_DELAY = 60
+# Messages per sink and user per minute; notifications beyond that are merged into one message. 0: no limit
+RATE_LIMIT = 6
+# Seconds flush() waits for the sinks
+FLUSH_TIMEOUT = 30
+
+PUSHBULLET_URL = 'https://api.pushbullet.com/v2/pushes'
+
+
+class Sink(object):
+    """
+    Destination of notifications. userkey is None for notifications meant for every user (disruptions)
+    """
+
+    name = None
+
+    def send(self, userkey, header, message):
+        raise NotImplementedError
+
+
+class OpenHABSink(Sink):
+    """
+    Sets the openhab_item_notifications item of the user
+    """
+
+    name = 'openhab'
+
+    def __init__(self, output, items):
+        # OpenHABOutput, and userkey: item name
+        self.output = output
+        self.items = dict((userkey, item) for userkey, item in items.items() if item)
+
+    def send(self, userkey, header, message):
+        if userkey is None:
+            names = set(self.items.values())
+        elif userkey in self.items:
+            names = [self.items[userkey]]
+        else:
+            return
+        self.output.update(dict((name, header + '\n' + message) for name in names))
+
+
+class PushbulletSink(Sink):
+    """
+    Pushes a note to a PushBullet device (or all devices when device_iden is empty)
+    """
+
+    name = 'pushbullet'
+
+    def __init__(self, api_key, device_iden=None, url=PUSHBULLET_URL):
+        self.device_iden = device_iden
+        self.url = url
+        self.session = requests.Session()
+        self.session.headers['Access-Token'] = api_key
+
+    def send(self, userkey, header, message):
+        note = {'type': 'note', 'title': header, 'body': message}
+        if self.device_iden:
+            note['device_iden'] = self.device_iden
+        upstream.get_upstream(self.name).request(self.session, 'POST', self.url, json=note)
+        metrics.inc('notifications_total', sink=self.name)
+
+
+class WebhookSink(Sink):
+    """
+    POSTs every message as JSON object with userkey, header and message to url
+    """
+
+    name = 'webhook'
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+
+    def send(self, userkey, header, message):
+        upstream.get_upstream(self.name).request(self.session, 'POST', self.url,
+                                                 json={'userkey': userkey, 'header': header, 'message': message})
+        metrics.inc('notifications_total', sink=self.name)
+
+
+class RateLimit(object):
+    """
+    Token bucket of limit messages per minute
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+
+    def available(self):
+        now = time.monotonic()
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / 60.0)
+        self.updated = now
+        return int(self.tokens)
+
+    def take(self, count=1):
+        self.tokens -= count
+
+    def next_token(self):
+        """
+        Seconds until the next message may be sent
+        """
+        return max(0.0, (1 - self.tokens) * 60.0 / self.limit)
+
+
+def merge_notifications(notifications):
+    """
+    One message for several notifications of a user
+    """
+    if len(notifications) == 1:
+        return notifications[0]['header'], notifications[0]['message']
+    header = str(len(notifications)) + ' NS notifications'
+    message = '\n\n'.join(notification['header'] + '\n' + notification['message'] for notification in notifications)
+    return header, message
+
+
+class Dispatcher(object):
+    """
+    Queue per sink of the notifications to send, per (userkey, key). A notification that gets an update
+    (same key) before it is sent is replaced by the update. A background thread sends every notification
+    coalesce_delay seconds after its first version was submitted, merging what does not fit in the rate limit
+    """
+
+    def __init__(self, sinks, mc=None, dedup_window=DEDUP_WINDOW, coalesce_delay=COALESCE_DELAY,
+                 rate_limit=RATE_LIMIT):
+        self.sinks = sinks
+        # State store for the deduplication, shared by all notifier processes
+        self.mc = mc
+        self.dedup_window = dedup_window
+        self.coalesce_delay = coalesce_delay
+        self.rate_limit = rate_limit
+        # sink name: OrderedDict of (userkey, key): notification
+        self.queues = dict((sink.name, collections.OrderedDict()) for sink in sinks)
+        # (sink name, userkey): RateLimit
+        self.limits = {}
+        self._flushing = False
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='dispatch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, userkey, key, header, message):
+        """
+        Queue a notification for all sinks. key identifies what it is about (a trip, a disruption), so later
+        updates replace it. Returns False when the same notification was already sent (or is queued) within the
+        window. The marker of that in the state is removed again when the notification is not delivered: when it
+        is replaced by an update before it is sent, or a sink fails to send it
+        """
+        marker = None
+        if self.mc is not None and self.dedup_window:
+            digest = hashlib.sha1(json.dumps([userkey, header, message]).encode('utf-8')).hexdigest()
+            marker = 'dispatched_' + digest
+            if not self.mc.add(marker, '1', self.dedup_window):
+                metrics.inc('dispatch_total', result='duplicate')
+                return False
+        result = 'queued'
+        replaced = set()
+        with self._condition:
+            for queue in self.queues.values():
+                queued = queue.get((userkey, key))
+                if queued:
+                    result = 'coalesced'
+                    replaced.add(queued['marker'])
+                    queued.update(header=header, message=message, marker=marker)
+                else:
+                    queue[(userkey, key)] = {'userkey': userkey, 'header': header, 'message': message,
+                                             'marker': marker, 'due': time.monotonic() + self.coalesce_delay}
+            self._condition.notify()
+        for replaced_marker in replaced:
+            self._forget(replaced_marker)
+        metrics.inc('dispatch_total', result=result)
+        return True
+
+    def _forget(self, marker):
+        """
+        Remove the deduplication marker of a notification that was not delivered, so it can be sent again
+        """
+        if marker is None:
+            return
+        try:
+            self.mc.delete(marker)
+        except Exception as e:
+            logging.getLogger('ns_notifications').error('Exception removing ' + marker + ' ' + repr(e))
+
+    def _get_limit(self, sink, userkey):
+        limit = self.limits.get((sink.name, userkey))
+        if limit is None:
+            limit = self.limits[(sink.name, userkey)] = RateLimit(self.rate_limit)
+        return limit
+
+    def _take_due(self, now):
+        """
+        Remove the notifications that are due (all of them when flushing) and may be sent from the queues.
+        Returns the list of (sink, userkey, notifications) to send, and the seconds until the next is due
+        """
+        batches = []
+        wait = None
+        for sink in self.sinks:
+            queue = self.queues[sink.name]
+            per_user = collections.OrderedDict()
+            for queue_key, notification in queue.items():
+                if self._flushing or notification['due'] <= now:
+                    per_user.setdefault(notification['userkey'], []).append(queue_key)
+                else:
+                    wait = min(wait, notification['due'] - now) if wait is not None else notification['due'] - now
+            for userkey, queue_keys in per_user.items():
+                if not self.rate_limit:
+                    batches.append((sink, userkey, [queue.pop(queue_key) for queue_key in queue_keys]))
+                    continue
+                limit = self._get_limit(sink, userkey)
+                available = limit.available()
+                if available <= 0 and not self._flushing:
+                    wait = min(wait, limit.next_token()) if wait is not None else limit.next_token()
+                    continue
+                # What does not fit in the rate limit is merged into the last message
+                messages = max(1, available)
+                notifications = [queue.pop(queue_key) for queue_key in queue_keys]
+                if len(notifications) > messages:
+                    metrics.inc('dispatch_total', len(notifications) - messages, result='merged')
+                    notifications = notifications[:messages - 1] + [notifications[messages - 1:]]
+                limit.take(len(notifications))
+                batches.append((sink, userkey, notifications))
+        return batches, wait
+
+    def _send(self, sink, userkey, notifications):
+        for notification in notifications:
+            if isinstance(notification, list):
+                header, message = merge_notifications(notification)
+            else:
+                header, message = notification['header'], notification['message']
+            try:
+                sink.send(userkey, header, message)
+            except Exception as e:
+                metrics.inc('errors_total', stage='dispatch_' + sink.name)
+                logging.getLogger('ns_notifications').error('Exception sending notification to ' + sink.name + ' ' +
+                                                            repr(e))
+                for failed in (notification if isinstance(notification, list) else [notification]):
+                    self._forget(failed['marker'])
+
+    def _run(self):
+        while True:
+            with self._condition:
+                batches, wait = self._take_due(time.monotonic())
+                if not batches:
+                    if self._stopping:
+                        return
+                    self._flushing = False
+                    self._condition.notify_all()
+                    self._condition.wait(wait)
+                    continue
+            for sink, userkey, notifications in batches:
+                self._send(sink, userkey, notifications)
+
+    def pending(self):
+        with self._condition:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """
+        Send all queued notifications now, waiting at most timeout seconds for that. Returns whether all were sent
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._flushing = True
+            self._condition.notify_all()
+            while self._flushing and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return not self._flushing
+
+    def close(self, timeout=FLUSH_TIMEOUT):
+        """
+        Send what is queued, and stop the background thread
+        """
+        sent = self.flush(timeout)
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join(max(0.0, timeout))
+        return sent
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-ins for the NS API and openHAB on localhost, for benchmarks. The NS stand-in answers with recorded
+responses (see RecordingNSAPI) when it has them, otherwise with generated ones, after an injected latency
+and with an injected share of errors
+"""
+import datetime
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from ns_client import NotifierNSAPI
+
+# ns_api expects the times of the NS API in this format
+NS_DATETIME = '%Y-%m-%dT%H:%M:%S%z'
+
+
+def get_fixture_name(url):
+    """
+    File name of the recorded response of the NS API for url: the endpoint, and for trips the stations
+    """
+    parsed = urlparse(url)
+    endpoint = parsed.path.rstrip('/').rsplit('/', 1)[-1]
+    if endpoint != 'trips':
+        return endpoint + '.json'
+    query = parse_qs(parsed.query)
+    stations = [query.get(name, [''])[0] for name in ('fromStation', 'toStation', 'viaStation')]
+    return 'trips_' + '_'.join(station.replace('/', '-') for station in stations if station) + '.json'
+
+
+class RecordingNSAPI(NotifierNSAPI):
+    """
+    NotifierNSAPI that saves every response of the NS API in fixture_dir, to be replayed by FakeNS
+    """
+
+    def __init__(self, subscription_key, fixture_dir, **kwargs):
+        super(RecordingNSAPI, self).__init__(subscription_key, **kwargs)
+        self.fixture_dir = fixture_dir
+
+    def _request(self, method, url, postdata=None, params=None):
+        text = super(RecordingNSAPI, self)._request(method, url, postdata, params)
+        with open(os.path.join(self.fixture_dir, get_fixture_name(url)), 'w') as fixture:
+            fixture.write(text)
+        return text
+
+
+class FakeService(object):
+    """
+    HTTP server on a free port of localhost, running in a thread. Every request is counted, waits latency
+    seconds and fails with a 503 for error_rate (0-1) of the requests
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                service.handle(self, 'GET')
+
+            def do_POST(self):
+                service.handle(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request, method):
+        body = None
+        if request.headers.get('Content-Length'):
+            body = request.rfile.read(int(request.headers['Content-Length'])).decode('utf-8')
+        with self.lock:
+            self.requests += 1
+            failing = self.random.random() < self.error_rate
+            if failing:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if failing:
+            status, text = 503, '{"error": "injected"}'
+        else:
+            status, text = self.respond(method, urlparse(request.path), body)
+        data = text.encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def respond(self, method, url, body):
+        raise NotImplementedError
+
+
+class FakeNS(FakeService):
+    """
+    Stand-in for the trips, disruptions and stations of the NS API. Generated trips get other delays
+    every generation, so consecutive runs of the notifier find changes
+    """
+
+    def __init__(self, stations, nr_disruptions=10, fixture_dir=None, **kwargs):
+        super(FakeNS, self).__init__(**kwargs)
+        self.stations = stations
+        self.nr_disruptions = nr_disruptions
+        self.fixture_dir = fixture_dir
+        self.generation = 0
+
+    def get_fixture(self, url):
+        if not self.fixture_dir:
+            return None
+        path = os.path.join(self.fixture_dir, get_fixture_name(url.path + '?' + url.query))
+        if not os.path.exists(path):
+            return None
+        with open(path) as fixture:
+            return fixture.read()
+
+    def respond(self, method, url, body):
+        fixture = self.get_fixture(url)
+        if fixture is not None:
+            return 200, fixture
+        endpoint = url.path.rstrip('/').rsplit('/', 1)[-1]
+        if endpoint == 'trips':
+            query = parse_qs(url.query)
+            return 200, json.dumps(self.make_trips(query['fromStation'][0], query['toStation'][0],
+                                                   query.get('viaStation', [None])[0], query['dateTime'][0]))
+        if endpoint == 'disruptions':
+            return 200, json.dumps(self.make_disruptions())
+        if endpoint == 'stations':
+            return 200, json.dumps(self.make_stations())
+        return 404, '{"error": "unknown endpoint"}'
+
+    def make_stations(self):
+        payload = []
+        for index, name in enumerate(self.stations):
+            payload.append({'EVACode': str(8400000 + index), 'code': 'S' + str(index), 'UICCode': str(8400000 + index),
+                            'stationType': 'MEGA_STATION', 'namen': {'kort': name[:10], 'middel': name[:16],
+                                                                     'lang': name},
+                            'land': 'NL', 'lat': 52.0, 'lng': 4.5, 'synoniemen': [], 'heeftFaciliteiten': True,
+                            'heeftReisassistentie': True, 'heeftVertrektijden': True})
+        return {'payload': payload}
+
+    def make_disruptions(self):
+        payload = []
+        for index in range(self.nr_disruptions):
+            departure = self.stations[index % len(self.stations)]
+            destination = self.stations[(index * 7 + 3) % len(self.stations)]
+            payload.append({'id': 'prio-' + str(100000 + index), 'type': 'verstoring',
+                            'titel': departure + ' - ' + destination,
+                            'verstoring': 'Tussen ' + departure + ' en ' + destination + ' rijden minder treinen. '
+                                          'Update ' + str((self.generation + index) // 5)})
+        return {'payload': payload}
+
+    def get_name(self, station):
+        if station.startswith('S') and station[1:].isdigit() and int(station[1:]) < len(self.stations):
+            return self.stations[int(station[1:])]
+        return station
+
+    def make_trips(self, departure, destination, via, requested):
+        """
+        Three trips, 15 minutes apart, around the requested time; the middle one leaves at that time
+        """
+        requested_time = datetime.datetime.strptime(requested, '%Y-%m-%dT%H:%M').replace(
+            tzinfo=datetime.datetime.now().astimezone().tzinfo)
+        departure, destination = self.get_name(departure), self.get_name(destination)
+        transfer = self.get_name(via) if via else self.stations[(len(departure) + len(destination)) % len(self.stations)]
+        trips = []
+        for offset in (-15, 0, 15):
+            delay = (self.generation + offset + len(departure)) % 7
+            start = requested_time + datetime.timedelta(minutes=offset)
+            legs = []
+            for leg, (origin, end) in enumerate(((departure, transfer), (transfer, destination))):
+                leg_start = start + datetime.timedelta(minutes=leg * 30)
+                leg_end = leg_start + datetime.timedelta(minutes=25)
+                times = [leg_start, leg_start + datetime.timedelta(minutes=12), leg_end]
+                legs.append({
+                    'travelType': 'PUBLIC_TRANSIT', 'cancelled': False, 'crowdForecast': 'LOW',
+                    'product': {'operatorName': 'NS', 'categoryCode': 'IC', 'number': str(3000 + leg)},
+                    'origin': {'name': origin, 'plannedDateTime': leg_start.strftime(NS_DATETIME),
+                               'actualDateTime': (leg_start + datetime.timedelta(minutes=delay)).strftime(NS_DATETIME),
+                               'plannedTrack': '4', 'actualTrack': '4'},
+                    'destination': {'name': end, 'plannedDateTime': leg_end.strftime(NS_DATETIME),
+                                    'actualDateTime': (leg_end + datetime.timedelta(minutes=delay)).strftime(
+                                        NS_DATETIME),
+                                    'plannedTrack': '7b', 'actualTrack': '7b'},
+                    'stops': [{'name': name, 'plannedDepartureDateTime': stop_time.strftime(NS_DATETIME),
+                               'actualDepartureDateTime': (stop_time + datetime.timedelta(minutes=delay)).strftime(
+                                   NS_DATETIME),
+                               'plannedDepartureTrack': '4', 'actualDepartureTrack': '4'}
+                              for name, stop_time in zip((origin, 'Tussenstation', end), times)],
+                })
+            trips.append({'status': 'NORMAL' if not delay else 'DISRUPTION', 'transfers': 1,
+                          'plannedDurationInMinutes': 55, 'actualDurationInMinutes': 55 + delay,
+                          'crowdForecast': 'LOW', 'legs': legs})
+        return {'trips': trips}
+
+
+class FakeOpenHAB(FakeService):
+    """
+    Stand-in for the items of the openHAB REST API, remembering the commanded states
+    """
+
+    def __init__(self, **kwargs):
+        super(FakeOpenHAB, self).__init__(**kwargs)
+        self.states = {}
+        self.commands = 0
+
+    @property
+    def url(self):
+        return super(FakeOpenHAB, self).url + '/rest'
+
+    def respond(self, method, url, body):
+        if not url.path.startswith('/rest/items/'):
+            return 404, '{"error": "unknown endpoint"}'
+        name = url.path[len('/rest/items/'):]
+        if method == 'POST':
+            with self.lock:
+                self.states[name] = body
+                self.commands += 1
+            return 200, ''
+        return 200, json.dumps({'type': 'String', 'name': name, 'label': name, 'state': self.states.get(name, 'NULL'),
+                                'editable': False, 'tags': [], 'groupNames': [], 'link': ''})
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+History of the delays of the configured routes, in an SQLite database
+"""
+import sqlite3
+import threading
+import time
+
+
+class DelayHistory(object):
+    """
+    One row per route per planned departure, holding the last observed delays of that train.
+    Statistics are calculated by SQLite, so they never need all rows in Python
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS observations ('
+                                'route TEXT NOT NULL, '
+                                'departure_planned TEXT NOT NULL, '
+                                'weekday INTEGER NOT NULL, '
+                                'hour INTEGER NOT NULL, '
+                                'departure_delay INTEGER NOT NULL, '
+                                'arrival_delay INTEGER NOT NULL, '
+                                'cancelled INTEGER NOT NULL, '
+                                'observed_at REAL NOT NULL, '
+                                'disruptions INTEGER NOT NULL DEFAULT 0, '
+                                'PRIMARY KEY (route, departure_planned)) WITHOUT ROWID')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(observations)')]
+        if 'disruptions' not in columns:
+            # History from before the number of active disruptions was recorded
+            self.connection.execute('ALTER TABLE observations ADD COLUMN disruptions INTEGER NOT NULL DEFAULT 0')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS observations_departure '
+                                'ON observations (departure_planned)')
+
+    def record(self, observations):
+        """
+        Store observations, dicts with route, departure_planned (datetime), departure_delay and arrival_delay
+        (in seconds), cancelled and optionally disruptions (the number of active disruptions on the route).
+        A later observation of the same train replaces the earlier one
+        """
+        now = time.time()
+        rows = []
+        for observation in observations:
+            departure_planned = observation['departure_planned']
+            rows.append((observation['route'], departure_planned.strftime('%Y-%m-%d %H:%M'),
+                         departure_planned.isoweekday(), departure_planned.hour,
+                         int(observation['departure_delay']), int(observation['arrival_delay']),
+                         int(observation['cancelled']), now, int(observation.get('disruptions', 0))))
+        if not rows:
+            return
+        with self._lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany('INSERT OR REPLACE INTO observations '
+                                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def get_statistics(self, since, per_weekday=True):
+        """
+        Number of trains, p50/p90 departure and arrival delay (in seconds, of the trains that went) and
+        cancellation rate per route (and weekday) of the trains planned since (a datetime)
+        """
+        group = 'route, weekday' if per_weekday else 'route'
+        query = '''
+            WITH ranked AS (
+                SELECT route, weekday, cancelled, departure_delay, arrival_delay,
+                    ROW_NUMBER() OVER (PARTITION BY {group}, cancelled ORDER BY departure_delay) AS departure_position,
+                    ROW_NUMBER() OVER (PARTITION BY {group}, cancelled ORDER BY arrival_delay) AS arrival_position,
+                    COUNT(*) OVER (PARTITION BY {group}, cancelled) AS went
+                FROM observations
+                WHERE departure_planned >= ?
+            )
+            SELECT route, {weekday}, COUNT(*),
+                MIN(CASE WHEN NOT cancelled AND departure_position >= 0.5 * went THEN departure_delay END),
+                MIN(CASE WHEN NOT cancelled AND departure_position >= 0.9 * went THEN departure_delay END),
+                MIN(CASE WHEN NOT cancelled AND arrival_position >= 0.5 * went THEN arrival_delay END),
+                MIN(CASE WHEN NOT cancelled AND arrival_position >= 0.9 * went THEN arrival_delay END),
+                AVG(cancelled)
+            FROM ranked
+            GROUP BY {group}
+            ORDER BY {group}
+        '''.format(group=group, weekday='weekday' if per_weekday else 'NULL')
+        with self._lock:
+            rows = self.connection.execute(query, (since.strftime('%Y-%m-%d %H:%M'), )).fetchall()
+        keys = ('route', 'weekday', 'trains', 'departure_p50', 'departure_p90', 'arrival_p50', 'arrival_p90',
+                'cancelled')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def get_delay_counts(self, since, threshold):
+        """
+        Number of trains and number of trains delayed by at least threshold seconds (or cancelled) per route,
+        weekday, hour and whether there were active disruptions on the route, of the trains planned since
+        """
+        query = '''
+            SELECT route, weekday, hour, disruptions > 0, COUNT(*),
+                SUM(cancelled OR departure_delay >= ?)
+            FROM observations
+            WHERE departure_planned >= ?
+            GROUP BY route, weekday, hour, disruptions > 0
+        '''
+        with self._lock:
+            return self.connection.execute(query, (threshold, since.strftime('%Y-%m-%d %H:%M'))).fetchall()
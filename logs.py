@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Logging of the notifier and the server: records are handed to a background thread through a queue, which writes
+them as JSON lines to a rotating file. Every category of records (by default the function logging them) is
+rate limited, so a flood of the same error can't fill the disk
+"""
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+import metrics
+
+# Rotate the log file at this size, keeping this many old ones
+MAX_BYTES = 1024 * 1024
+BACKUP_COUNT = 5
+# Records per category per RATE_PERIOD seconds, the rest is dropped and counted
+RATE_LIMIT = 30
+RATE_PERIOD = 60
+
+# Listener per configured logger name, to configure each one only once
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most limit records per category per period seconds. The category of a record is its
+    'category' extra, otherwise the logger and function that logged it. The number of dropped records is
+    added to the first record of the category that is let through again
+    """
+
+    def __init__(self, limit=RATE_LIMIT, period=RATE_PERIOD):
+        super(RateLimitFilter, self).__init__()
+        self.limit = limit
+        self.period = period
+        # category: [start of the period, records let through, records dropped]
+        self.windows = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_category(record):
+        return getattr(record, 'category', None) or record.name + '.' + record.funcName
+
+    def filter(self, record):
+        if not self.limit:
+            return True
+        category = self.get_category(record)
+        now = time.monotonic()
+        with self._lock:
+            window = self.windows.get(category)
+            if window is None or now - window[0] >= self.period:
+                suppressed = window[2] if window else 0
+                window = self.windows[category] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if window[1] >= self.limit:
+                window[2] += 1
+                metrics.inc('log_records_dropped_total', category=category)
+                return False
+            window[1] += 1
+        record.category = category
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per record
+    """
+
+    def format(self, record):
+        entry = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(),
+                 'level': record.levelname, 'logger': record.name,
+                 'category': getattr(record, 'category', None) or record.name + '.' + record.funcName,
+                 'message': record.getMessage()}
+        if getattr(record, 'suppressed', None):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that only renders the message and traceback of a record, leaving the formatting to the
+    handlers of the listener
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(name, path, level=logging.DEBUG, console_level=None, max_bytes=MAX_BYTES,
+                  backup_count=BACKUP_COUNT, rate_limit=RATE_LIMIT):
+    """
+    Configure logger name to log through a queue to the rotating file path (and stderr from console_level,
+    when given). Only the first call for a name configures it, later ones return the same logger
+    """
+    logger = logging.getLogger(name)
+    with _listeners_lock:
+        if name in _listeners:
+            return logger
+        handlers = []
+        if path:
+            file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                                encoding='utf-8')
+            file_handler.setFormatter(JSONFormatter())
+            handlers.append(file_handler)
+        if console_level is not None:
+            console_handler = logging.StreamHandler()
+            console_handler.setLevel(console_level)
+            console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+            handlers.append(console_handler)
+        records = queue.Queue(-1)
+        queue_handler = RecordQueueHandler(records)
+        queue_handler.addFilter(RateLimitFilter(rate_limit))
+        listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        _listeners[name] = listener
+        # Left behind when logging was stopped before
+        for handler in [handler for handler in logger.handlers if isinstance(handler, RecordQueueHandler)]:
+            logger.removeHandler(handler)
+        logger.setLevel(level)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+    return logger
+
+
+@atexit.register
+def stop_logging():
+    """
+    Write the records that are still queued and stop the background threads
+    """
+    with _listeners_lock:
+        listeners = list(_listeners.values())
+        _listeners.clear()
+    for listener in listeners:
+        listener.stop()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and timing histograms of the notifier, exported in the Prometheus text format
+"""
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+# Upper bounds (in seconds) of the buckets of the timing histograms
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'stage_seconds': 'Time spent in a stage of a run of the notifier, or rendering a page of the server',
+    'upstream_seconds': 'Duration of the requests to an upstream service',
+    'upstream_requests_total': 'Number of requests to an upstream service',
+    'upstream_errors_total': 'Number of failed requests to an upstream service',
+    'upstream_retries_total': 'Number of requests to an upstream service that were tried again',
+    'state_seconds': 'Duration of reads and writes of the state store',
+    'codec_seconds': 'Time spent (de)serialising state values',
+    'cache_lookups_total': 'Number of lookups in a cache, per result',
+    'errors_total': 'Number of errors per stage',
+    'notifications_total': 'Number of notifications (openHAB commands, events, pushes, webhook calls) sent',
+    'dispatch_total': 'Number of notifications submitted for dispatch, per result (queued, coalesced, duplicate, merged)',
+    'runs_total': 'Number of runs of the notifier',
+    'shard_leases_total': 'Number of times this node took over a lease (like checking the disruptions) from another node',
+    'shard_routes_total': 'Number of routes assigned to this node, added up over its runs',
+    'log_records_dropped_total': 'Number of log records dropped by the rate limit, per category',
+}
+
+
+class Registry(object):
+    """
+    Counters and histograms, each identified by a name and a dict of labels. Updating one takes a lock and a
+    few dict operations, so they can stay enabled in production
+    """
+
+    def __init__(self, prefix='ns_notifications_'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # (name, labels): value
+        self.counters = {}
+        # (name, labels): [count per bucket (the last one is +Inf), sum]
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the duration of the with block in histogram name
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for name, value in labels) + '}'
+
+    def render(self):
+        """
+        All counters and histograms in the Prometheus text exposition format
+        """
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(values)) for key, values in self.histograms.items())
+        lines = []
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP {0}{1} {2}'.format(self.prefix, name, HELP.get(name, name)))
+                lines.append('# TYPE {0}{1} counter'.format(self.prefix, name))
+            lines.append('{0}{1}{2} {3}'.format(self.prefix, name, self._format_labels(labels), value))
+        for (name, labels), values in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP {0}{1} {2}'.format(self.prefix, name, HELP.get(name, name)))
+                lines.append('# TYPE {0}{1} histogram'.format(self.prefix, name))
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf', ), values[:-1]):
+                cumulative += count
+                lines.append('{0}{1}_bucket{2} {3}'.format(self.prefix, name,
+                                                           self._format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('{0}{1}_sum{2} {3}'.format(self.prefix, name, self._format_labels(labels), values[-1]))
+            lines.append('{0}{1}_count{2} {3}'.format(self.prefix, name, self._format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+        Write the metrics to path for the textfile collector of node_exporter, replacing it at once
+        """
+        with open(path + '.tmp', 'w') as textfile:
+            textfile.write(self.render())
+        os.rename(path + '.tmp', path)
+
+
+REGISTRY = Registry()
+
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timer = REGISTRY.timer
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Access to the NS API over a persistent connection. Imported by the commands that ask the NS API only, so the
+others (stats, train_model, updated) don't load ns_api and requests
+"""
+import ns_api
+import requests
+
+import metrics
+import upstream
+
+NS_API_URL = 'https://gateway.apiportal.ns.nl'
+
+# Connections kept alive to the NS API, get_nsapi sets it to max_workers from [General]
+POOL_SIZE = 4
+
+# Errors that fail a single query of the trips: no connection, or an answer that can't be used (no trips, not JSON)
+TRIPS_ERRORS = (requests.exceptions.RequestException, ns_api.NoDataReceivedError, ns_api.RequestParametersError,
+                ValueError)
+
+
+class NotifierNSAPI(ns_api.NSAPI):
+    """
+    NSAPI that talks to the NS API through a pooled requests session, so the (TLS) connections
+    are kept alive between queries and runs
+    """
+
+    def __init__(self, subscription_key, pool_size=POOL_SIZE, base_url=NS_API_URL):
+        super(NotifierNSAPI, self).__init__(subscription_key)
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        self.session.headers['Ocp-Apim-Subscription-Key'] = subscription_key
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+
+    def _request(self, method, url, postdata=None, params=None):
+        # Name of the endpoint, like 'trips' for /reisinformatie-api/api/v3/trips?...
+        endpoint = url.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+        metrics.inc('upstream_requests_total', upstream='nsapi', endpoint=endpoint)
+        try:
+            with metrics.timer('upstream_seconds', upstream='nsapi', endpoint=endpoint):
+                response = upstream.get_upstream('nsapi').request(self.session, method, self.base_url + url,
+                                                                  data=postdata, params=params)
+        except requests.exceptions.RequestException:
+            metrics.inc('upstream_errors_total', upstream='nsapi', endpoint=endpoint)
+            raise
+        return response.text
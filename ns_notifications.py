@@ -2,21 +2,39 @@
 """
 NS trip notifier
 """
-import ns_api
 import click
-from pymemcache.client import Client as MemcacheClient
+from concurrent.futures import Future, ThreadPoolExecutor
+import ast
+import collections
 import datetime
+import enum
+import hashlib
+import heapq
 import json
-import requests
 import socket
 import __main__ as main
 import logging
 import sys
 import os
-
-from openhab import OpenHAB
-
-from configparser import ConfigParser
+import re
+import threading
+import time
+import zlib
+
+import config
+import logs
+import metrics
+from relevance import RelevanceIndex
+import sharding
+from state_store import LRUStore, MemcacheStore, SQLiteStore
+from stations import StationIndex
+
+
+try:
+    import msgpack
+except ImportError:
+    # Optional, only needed for the msgpack state codecs
+    msgpack = None
 #try:
 #    import settings
 #except ImportError:
@@ -28,128 +46,632 @@ from configparser import ConfigParser
 MAX_TIME_PAST = 1800
 MAX_TIME_FUTURE = 3600
 
+# Poll interval of a route in daemon mode, depending on the number of seconds left until departure:
+# every minute in the last quarter of an hour, every five minutes up to half an hour before, otherwise every 15 minutes
+ROUTE_POLL_INTERVALS = ((900, 60), (1800, 300), (MAX_TIME_FUTURE, 900))
+# Poll interval of a route that already departed, to catch arrival delays
+ROUTE_POLL_INTERVAL_DEPARTED = 300
+
+# Maximum number of routes queried at the same time, override with max_workers in [General]
+MAX_WORKERS = 4
+
 # Set max time to live for a key to an hour
 MEMCACHE_TTL = 3600
 MEMCACHE_VERSIONCHECK_TTL = 3600 * 12
 MEMCACHE_DISABLING_TTL = 3600 * 6
 
+# Change events are kept for an hour, for clients catching up after a reconnect
+EVENTS_TTL = 3600
+EVENTS_KEEP = 100
+
+# Latest version of the notifier, override with version_url in [General] (e.g., a local stand-in when offline)
+VERSION_URL = 'https://raw.githubusercontent.com/reyhard/ns-notifications-openhab/master/VERSION'
+# Interval between two version checks in daemon mode
+VERSION_CHECK_INTERVAL = 3600 * 6
+
+# Log file, override with log_path in [General]
+LOG_PATH = 'ns_notifications.log'
+
+# Interval between two runs in daemon mode, override with daemon_interval in [General]
+DAEMON_INTERVAL = 300
+
+# Reuse identical trip queries for a minute, override with trips_cache_ttl in [General]
+TRIPS_CACHE_TTL = 60
+
+# The list of stations is fetched from the NS API once a week; invalid routes are reported once a week too
+STATIONS_TTL = 3600 * 24 * 7
+
+# The last answer of the NS API for a query is kept for an hour, to be shown (marked stale) while the NS API fails
+STALE_TRIPS_TTL = 3600
+
+# Via stations learned from the advised trips are kept for a month
+VIA_STATIONS_TTL = 3600 * 24 * 30
+
+# Number of via stations queried for a route that has no alternative in its own answer,
+# override with alternative_vias in [General]. 0: only rank the trips already fetched
+MAX_ALTERNATIVE_VIAS = 2
+
+# The openhab_item_trains items showing alternatives are remembered for a week, to be emptied when no longer needed
+ALTERNATIVE_ITEMS_TTL = 3600 * 24 * 7
+
 VERSION_NSAPI = '3.0.5'
 
+# A route is 'likely delayed' when the chance of a delay of at least prediction_threshold minutes is this high,
+# override with prediction_threshold and prediction_probability in [General]
+PREDICTION_THRESHOLD = 5
+PREDICTION_PROBABILITY = 0.5
+
+# State key: (JSON, trips) last saved by store_changed_trips, so the trips are not parsed again from the state
+# while nobody else changed them
+_saved_trips = {}
+
+# history_path: DelayHistory opened by get_history
+_histories = {}
+
+# (openhab_url, timeout, max_workers): OpenHABOutput created by get_openhab_output
+_openhab_outputs = {}
+
 
 class MemcachedNotInstalledException(Exception):
     pass
 
 
 ## Helper functions for memcache serialisation
+# The memcache flags tell how a value was stored, so values written with another codec can still be read
+FLAG_STRING = 1
+FLAG_JSON = 2
+FLAG_MSGPACK = 4
+FLAG_ZLIB = 8
+
+STATE_CODECS = ('json', 'json+zlib', 'msgpack', 'msgpack+zlib')
+
+
 def json_serializer(key, value):
     if type(value) == str:
-        return value, 1
+        return value, FLAG_STRING
     #if issubclass(value, ns_api.BaseObject):
     #    print ("instance of NS-API object")
     #    return value.to_json(), 3
-    return json.dumps(value), 2
+    return json.dumps(value), FLAG_JSON
 
 def json_deserializer(key, value, flags):
-    if flags == 1:
+    if flags == FLAG_STRING:
         return value
-    if flags == 2:
-        return json.loads(value)
+    with metrics.timer('codec_seconds', operation='deserialize'):
+        if flags & FLAG_ZLIB:
+            value = zlib.decompress(value)
+        if flags & FLAG_JSON:
+            return json.loads(value)
+        if flags & FLAG_MSGPACK:
+            if not msgpack:
+                raise Exception("Value stored with msgpack, but the msgpack package is not installed")
+            return msgpack.unpackb(value, raw=False)
     raise Exception("Unknown serialization format")
 
+def get_serializer(codec='json'):
+    """
+    Get a memcache serializer for codec (see STATE_CODECS). Values are read back with json_deserializer
+    """
+    if codec not in STATE_CODECS:
+        raise ValueError('Unknown state codec ' + codec)
+    if codec.startswith('msgpack') and not msgpack:
+        raise ValueError('State codec ' + codec + ' needs the msgpack package: pip install msgpack')
+    compress = codec.endswith('+zlib')
+
+    def serializer(key, value):
+        if type(value) == str:
+            return value, FLAG_STRING
+        with metrics.timer('codec_seconds', operation='serialize'):
+            if codec.startswith('msgpack'):
+                value, flags = msgpack.packb(value, use_bin_type=True), FLAG_MSGPACK
+            else:
+                value, flags = json.dumps(value).encode('utf-8'), FLAG_JSON
+            if compress:
+                value, flags = zlib.compress(value), flags | FLAG_ZLIB
+        return value, flags
+    return serializer
+
+## NS API objects in the state
+# ns_api's to_json only handles the attributes its parser always sets: a disruption without timestamp, or a trip
+# with an enum status or without remarks, can't be serialised with it. The objects are stored with all their
+# attributes instead, datetimes, timedeltas and enums tagged so they are restored with their type
+def get_object_state(value):
+    import ns_api
+    if isinstance(value, ns_api.BaseObject):
+        state = dict((key, get_object_state(item)) for key, item in value.__dict__.items())
+        state['class_name'] = type(value).__name__
+        return state
+    if isinstance(value, enum.Enum):
+        return {'$enum': type(value).__name__, 'value': value.value}
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {'$timedelta': value.total_seconds()}
+    if isinstance(value, (list, tuple)):
+        return [get_object_state(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, get_object_state(item)) for key, item in value.items())
+    return value
+
+def restore_object_state(state):
+    import ns_api
+    if isinstance(state, list):
+        return [restore_object_state(item) for item in state]
+    if not isinstance(state, dict):
+        return state
+    if '$datetime' in state:
+        return datetime.datetime.fromisoformat(state['$datetime'])
+    if '$timedelta' in state:
+        return datetime.timedelta(seconds=state['$timedelta'])
+    if '$enum' in state:
+        try:
+            return getattr(ns_api, state['$enum'])(state['value'])
+        except (AttributeError, ValueError):
+            return state['value']
+    values = dict((key, restore_object_state(item)) for key, item in state.items() if key != 'class_name')
+    object_class = getattr(ns_api, state.get('class_name') or '', None)
+    if not (isinstance(object_class, type) and issubclass(object_class, ns_api.BaseObject)):
+        return values
+    restored = object_class.__new__(object_class)
+    restored.__dict__ = values
+    return restored
+
+def dump_objects(objects):
+    """
+    Serialise NS API objects (trips, disruptions) for the state, as a list of records the state codec encodes
+    """
+    return [get_object_state(item) for item in objects]
+
+def load_objects(values):
+    """
+    The NS API objects in values, as stored by dump_objects (or as JSON strings, by older versions)
+    """
+    import ns_api
+    objects = []
+    for value in values or []:
+        if not isinstance(value, str):
+            objects.append(restore_object_state(value))
+            continue
+        state = json.loads(value)
+        if '$object' in state:
+            objects.append(restore_object_state(state['$object']))
+        else:
+            objects.extend(ns_api.list_from_json([value]))
+    return objects
+
+def get_state_version(value):
+    """
+    Version of a state value: a hash of its contents, so readers can tell whether it changed without fetching it
+    """
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+def set_state(mc, key, value, ttl):
+    """
+    Store value under key, together with its version under <key>_version
+    """
+    mc.set_many({key: value, key + '_version': get_state_version(value)}, ttl)
+
+def get_state_store(settings):
+    """
+    Open the state store configured with state_backend in [General]: memcache (default), lru or sqlite.
+    Values are stored with the state_codec from [General]
+    """
+    backend = settings['General'].get('state_backend', 'memcache')
+    serializer = get_serializer(settings['General'].get('state_codec', 'json'))
+    if backend == 'memcache':
+        host, _, port = settings['General'].get('memcache_server', '127.0.0.1:11211').rpartition(':')
+        return MemcacheStore((host, int(port)), serializer, json_deserializer)
+    if backend == 'lru':
+        return LRUStore(settings['General'].getint('state_lru_size', fallback=10000))
+    if backend == 'sqlite':
+        return SQLiteStore(settings['General'].get('state_path', 'ns_notifications.sqlite'),
+                           serializer, json_deserializer)
+    raise ValueError('Unknown state backend ' + backend)
+
+## Change events, published for server.py
+def publish_event(mc, event_type, messages, userkey=None):
+    """
+    Publish a change event with the formatted messages of the new or changed disruptions/trips
+    """
+    metrics.inc('notifications_total', sink='events')
+    event_id = mc.incr('events_seq', 1)
+    if event_id is None:
+        # First event ever (or memcache was restarted)
+        mc.add('events_seq', '0', 0)
+        event_id = mc.incr('events_seq', 1)
+    event = {'id': int(event_id), 'type': event_type, 'userkey': userkey, 'messages': messages,
+             'timestamp': datetime.datetime.now().isoformat()}
+    mc.set('event_' + str(event_id), event, EVENTS_TTL)
+    return event
+
+def get_event_seq(mc):
+    """
+    Id of the last published event, 0 when there are none
+    """
+    event_id = mc.get('events_seq')
+    if event_id is None:
+        return 0
+    return int(event_id)
+
+def get_events(mc, after_id):
+    """
+    Get the (at most EVENTS_KEEP) events that were published after event after_id, oldest first
+    """
+    last_id = get_event_seq(mc)
+    if last_id < after_id:
+        # Sequence was reset, start over
+        after_id = 0
+    first_id = max(after_id + 1, last_id - EVENTS_KEEP + 1)
+    if first_id > last_id:
+        return []
+    events = mc.get_many(['event_' + str(event_id) for event_id in range(first_id, last_id + 1)])
+    return sorted(events.values(), key=lambda event: event['id'])
+
 def get_config(config_dir):
-    # Load configuration file
-    config = ConfigParser(delimiters=('=', ))
-    config.optionxform = str
-    config.read([os.path.join(config_dir, 'config.ini.dist'), os.path.join(config_dir, 'config.ini')])
-    return config
+    """
+    Load the configuration, from its compiled cache when config.ini did not change
+    """
+    return config.load_settings(config_dir)
+
+def get_config_mtime(config_dir):
+    """
+    Modification times of the configuration files, to detect changes in daemon mode
+    """
+    return config.get_config_mtime(config_dir)
+
+def get_routes(settings):
+    """
+    Get the list of routes from the [Routes] section
+    """
+    return get_users(settings)[settings.userkey]['routes']
+
+def get_users(settings):
+    """
+    Get the users and their settings: the routes of [Routes] belong to userkey from [General] (default 1),
+    every [User <userkey>] section adds a user with its own routes and openHAB items
+    """
+    return settings.users
+
+
+def get_user_routes(settings):
+    """
+    Get the routes per userkey
+    """
+    return collections.OrderedDict((userkey, user['routes']) for userkey, user in get_users(settings).items())
+
+def get_station_index(mc, nsapi):
+    """
+    Get the index of the NS stations, from the state or, once a week, from the NS API
+    """
+    stations = mc.get('stations')
+    if not stations:
+        stations = StationIndex.from_stations(nsapi.get_stations()).to_json()
+        mc.set('stations', stations, STATIONS_TTL)
+    return StationIndex(stations)
+
+def normalise_route(route, station_index):
+    """
+    Copy of route with its departure, destination and keyword (via) resolved to station codes, and the names of the
+    departure and destination in departure_name and destination_name. Also returns the list of problems found;
+    a route with problems can't be queried
+    """
+    normalised = dict(route)
+    problems = []
+    for field in ('departure', 'destination', 'keyword'):
+        name = route.get(field)
+        if not name:
+            continue
+        code, candidates = station_index.resolve(name)
+        if code:
+            normalised[field] = code
+            if field != 'keyword':
+                normalised[field + '_name'] = station_index.get_name(code)
+        elif candidates:
+            problems.append(field + ' ' + repr(name) + ' could be ' +
+                            ', '.join(station_index.get_name(candidate) for candidate in candidates))
+        else:
+            problems.append(field + ' ' + repr(name) + ' is not a known station')
+    return normalised, problems
+
+def get_valid_user_routes(settings, mc, nsapi, logger):
+    """
+    Get the routes per userkey with their stations resolved to codes. Routes with unknown or ambiguous stations
+    are left out, and logged once a week. When the stations can't be fetched, the routes are used as configured
+    """
+    import ns_api
+    import requests
+    user_routes = get_user_routes(settings)
+    try:
+        station_index = get_station_index(mc, nsapi)
+    except (requests.exceptions.RequestException, ns_api.NoDataReceivedError, ns_api.RequestParametersError) as e:
+        logger.error('Exception getting the stations, routes are not checked ' + repr(e))
+        return user_routes
+
+    valid_routes = collections.OrderedDict()
+    for userkey, routes in user_routes.items():
+        valid_routes[userkey] = []
+        for route in routes:
+            normalised, problems = normalise_route(route, station_index)
+            if not problems:
+                valid_routes[userkey].append(normalised)
+                continue
+            report_key = 'invalid_route_' + hashlib.sha1(
+                (str(userkey) + json.dumps(route, sort_keys=True)).encode('utf-8')).hexdigest()
+            if mc.add(report_key, '1', STATIONS_TTL):
+                logger.error('Skipping route ' + repr(route) + ' of user ' + str(userkey) + ': ' + '; '.join(problems))
+    return valid_routes
+
+def get_history(settings):
+    """
+    Open the delay history in history_path from [General], None when no history is kept.
+    The database is opened once per process, every run (and reload of the configuration) reuses it
+    """
+    from history import DelayHistory
+    path = settings['General'].get('history_path', '')
+    if not path:
+        return None
+    if path not in _histories:
+        _histories[path] = DelayHistory(path)
+    return _histories[path]
 
 ## Check for an update of the notifier
-def get_repo_version():
+def get_repo_version(url=VERSION_URL):
     """
-    Get the current version on GitHub
+    Get the current version on GitHub (or the stand-in at url)
     """
-    url = 'https://raw.githubusercontent.com/reyhard/ns-notifications-openhab/master/VERSION'
+    import requests
+    import upstream
+    metrics.inc('upstream_requests_total', upstream='github', endpoint='version')
     try:
-        response = requests.get(url)
-        if response.status_code != 404:
-            return response.text.replace('\n', '')
-    except requests.exceptions.ConnectionError:
-        #return -1
+        with metrics.timer('upstream_seconds', upstream='github', endpoint='version'):
+            response = upstream.get_upstream('github').request(requests, 'GET', url)
+        # Not response.text: stand-ins often leave out the charset, after which requests guesses it
+        return response.content.decode('utf-8').replace('\n', '')
+    except requests.exceptions.RequestException:
+        # 404, timeout or GitHub unreachable
+        metrics.inc('upstream_errors_total', upstream='github', endpoint='version')
         return None
-    return None
 
 
 def get_local_version():
     """
     Get the locally installed version
     """
-    with open ("VERSION", "r") as versionfile:
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'VERSION'), 'r') as versionfile:
         return versionfile.read().replace('\n', '')
 
 
+def refresh_versions(mc, url=VERSION_URL):
+    """
+    Check whether version of ns-notifier is up-to-date and ns-api is latest version too, and store the resulting
+    update message (None when no updating is needed) for check_versions. Done by `check-version` or in the
+    background of the daemon, as it asks GitHub
+    """
+    import ns_api
+    messages = []
+    version = get_repo_version(url)
+    current_version = get_local_version()
+    # No version on 404 or timeout on remote VERSION file, nothing to report then
+    if version and version != current_version:
+        messages.append('Current version: ' + str(current_version) + '\nNew version: ' + str(version))
+    if ns_api.__version__ != VERSION_NSAPI:
+        messages.append('ns-api needs updating')
+
+    message = None
+    if messages:
+        message = {'header': 'ns-notifications needs updating', 'message': '\n'.join(messages)}
+    set_state(mc, 'update_message', message, MEMCACHE_VERSIONCHECK_TTL)
+    return message
+
+
 def check_versions(mc):
     """
-    Check whether version of ns-notifier is up-to-date and ns-api is latest version too
+    Get the update message stored by refresh_versions, None when no updating is needed (or it did not run yet)
     """
-    message = {'header': 'ns-notifications needs updating', 'message': None}
-    current_version = None
     try:
-        version = mc.get('ns-notifier_version')
+        return mc.get('update_message')
     except socket.error:
         raise MemcachedNotInstalledException
-    if not version:
-        version = get_repo_version()
-        current_version = get_local_version()
-        if not version:
-            # 404 or timeout on remote VERSION file, refresh with current_version
-            mc.set('ns-notifier_version', current_version, MEMCACHE_VERSIONCHECK_TTL)
-        elif version != current_version:
-            message['message'] = 'Current version: ' + str(current_version) + '\nNew version: ' + str(version)
-            mc.set('ns-notifier_version', version, MEMCACHE_VERSIONCHECK_TTL)
-
-    version = mc.get('ns-api_version')
-    if not version:
-        if ns_api.__version__ != VERSION_NSAPI:
-            # ns-api needs updating
-            if message['message']:
-                message['message'] = message['message'] + '\n'
+
+
+## Caching of NS API queries
+class TripsCache(object):
+    """
+    Short-lived cache in front of NSAPI.get_trips. Identical queries that are in flight at the
+    same moment are collapsed into a single call to the NS API; all other attributes are passed
+    through to the wrapped NSAPI object
+    """
+
+    def __init__(self, nsapi, ttl=TRIPS_CACHE_TTL):
+        self.nsapi = nsapi
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.nsapi, name)
+
+    @staticmethod
+    def get_key(timestamp, start, via, destination, departure=True):
+        """
+        Cache key for a query; the requested time is bucketed on the minute, so '7:44' and '07:44' are equal
+        """
+        if len(timestamp) <= 5:
+            hours, minutes = timestamp.split(':')
+            timestamp = '{0:02d}:{1:02d}'.format(int(hours), int(minutes))
+        return (start, destination, via, timestamp, departure)
+
+    def get_trips(self, timestamp, start, via, destination, departure=True):
+        """
+        Get the trips for this query from the cache, from a running identical query, or from the NS API
+        """
+        key = self.get_key(timestamp, start, via, destination, departure)
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self.hits += 1
+                metrics.inc('cache_lookups_total', cache='trips', result='hit')
+                return entry[1]
+            future = self._in_flight.get(key)
+            if future:
+                # Somebody else is already asking the NS API, wait for that answer
+                self.hits += 1
+                metrics.inc('cache_lookups_total', cache='trips', result='coalesced')
+                is_owner = False
             else:
-                message['message'] = ''
-            message['message'] = message['message'] + 'ns-api needs updating'
-            mc.set('ns-api_version', VERSION_NSAPI, MEMCACHE_VERSIONCHECK_TTL)
+                self.misses += 1
+                metrics.inc('cache_lookups_total', cache='trips', result='miss')
+                future = Future()
+                self._in_flight[key] = future
+                is_owner = True
+                # Drop expired entries while we are at it
+                for expired in [k for k, v in self._entries.items() if v[0] <= now]:
+                    del self._entries[expired]
+        if not is_owner:
+            return future.result()
 
-    if not message['message']:
-        # No updating needed, return None object
-        message = None
-    return message
+        try:
+            trips = self.nsapi.get_trips(timestamp, start, via, destination, departure)
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, trips)
+            del self._in_flight[key]
+        future.set_result(trips)
+        return trips
+
+    def get_stats(self):
+        """
+        Hit/miss counters of this cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+def get_shard(settings, mc):
+    """
+    This node of the notifier nodes sharing mc, when node_id is set in [Sharding]. None: this node does everything
+    """
+    node_id = settings.get('Sharding', 'node_id', fallback='')
+    if not node_id:
+        return None
+    return sharding.Shard(mc, node_id, settings.getint('Sharding', 'lease_ttl', fallback=sharding.LEASE_TTL))
+
+def get_nsapi(settings):
+    """
+    Create the (cached) NS API handle from settings, configuring the timeouts, retries and circuit breakers of
+    the upstream services
+    """
+    from ns_client import NS_API_URL, NotifierNSAPI
+    import upstream
+    upstream.configure(settings)
+    return TripsCache(NotifierNSAPI(settings['General'].get('apikey', ''),
+                                    settings['General'].getint('max_workers', fallback=MAX_WORKERS),
+                                    settings['General'].get('ns_api_url', NS_API_URL)),
+                      settings['General'].getint('trips_cache_ttl', fallback=TRIPS_CACHE_TTL))
+
+
+## Sending state to openHAB
+class OpenHABOutput(object):
+    """
+    Sends texts to openHAB items over the (pooled) session of the OpenHAB client. Item handles
+    are looked up once, and only items whose text differs from what they show now are commanded
+    """
+
+    def __init__(self, openhab, max_workers=MAX_WORKERS):
+        self.openhab = openhab
+        self.max_workers = max_workers
+        self._items = {}
+        self._sent = {}
+        self._lock = threading.Lock()
+
+    def get_item(self, name):
+        """
+        Get the handle of item name, remembering its current state as the last sent text
+        """
+        import upstream
+        with self._lock:
+            if name in self._items:
+                return self._items[name]
+        metrics.inc('upstream_requests_total', upstream='openhab', endpoint='item')
+        with metrics.timer('upstream_seconds', upstream='openhab', endpoint='item'):
+            item = upstream.get_upstream('openhab').call(lambda timeout: self.openhab.get_item(name), (Exception, ))
+        with self._lock:
+            self._items[name] = item
+            self._sent.setdefault(name, item.state)
+        return item
+
+    def _command(self, name, text):
+        import upstream
+        metrics.inc('upstream_requests_total', upstream='openhab', endpoint='command')
+        with metrics.timer('upstream_seconds', upstream='openhab', endpoint='command'):
+            upstream.get_upstream('openhab').call(lambda timeout: self._items[name].command(text), (Exception, ))
+        metrics.inc('notifications_total', sink='openhab')
+        with self._lock:
+            self._sent[name] = text
+
+    def update(self, texts):
+        """
+        Send the texts (dict of item name: text) of which the item does not already show that text.
+        Returns the names of the items that were commanded
+        """
+        if not texts:
+            return []
+        workers = max(1, min(self.max_workers, len(texts)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            missing = [name for name in texts if name not in self._items]
+            list(executor.map(self.get_item, missing))
+            changed = [name for name, text in texts.items() if self._sent.get(name) != text]
+            list(executor.map(lambda name: self._command(name, texts[name]), changed))
+        return changed
+
+
+def get_openhab_output(settings):
+    """
+    Get the openHAB output stage configured in settings. It is created once per process (and openHAB server), so
+    the notifications, alternatives and predictions of every run share its item handles and know what was sent
+    """
+    import upstream
+    url = settings['Openhab'].get('openhab_url')
+    timeout = settings['General'].getfloat('upstream_read_timeout', fallback=upstream.READ_TIMEOUT)
+    max_workers = settings['General'].getint('max_workers', fallback=MAX_WORKERS)
+    key = (url, timeout, max_workers)
+    if key not in _openhab_outputs:
+        # The openHAB client is slow to import, and only needed by the commands that send to openHAB
+        from openhab import OpenHAB
+        _openhab_outputs[key] = OpenHABOutput(OpenHAB(url, timeout=timeout), max_workers)
+    return _openhab_outputs[key]
 
 
 ## Often-used handles
-def get_logger():
+def get_logger(settings=None):
     """
-    Create logging handler
+    Create the logger, writing JSON lines to log_path from [General] in the background. Only the first call
+    configures it, so calling this again (e.g., on a reload of the configuration) does not duplicate lines
     """
-    ## Create logger
-    logger = logging.getLogger('ns_notifications')
-    logger.setLevel(logging.DEBUG)
-    # create file handler which logs even debug messages
-    fh = logging.FileHandler('ns_notifications.log')
-    fh.setLevel(logging.DEBUG)
-    # create formatter and add it to the handlers
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh.setFormatter(formatter)
-    # add the handlers to the logger
-    logger.addHandler(fh)
-    return logger
+    if settings is None:
+        return logs.setup_logging('ns_notifications', LOG_PATH)
+    general = settings['General']
+    return logs.setup_logging('ns_notifications', general.get('log_path', LOG_PATH),
+                              max_bytes=general.getint('log_max_bytes', fallback=logs.MAX_BYTES),
+                              backup_count=general.getint('log_backups', fallback=logs.BACKUP_COUNT),
+                              rate_limit=general.getint('log_rate_limit', fallback=logs.RATE_LIMIT))
 
 ## Format messages
 def format_disruption(disruption):
     """
     Format a disruption on a trajectory
     """
-    print(disruption.key)
-    print(disruption.line)
-    print(disruption.timestamp)
+    import ns_api
+    logging.getLogger('ns_notifications').debug('Formatting disruption %s on %s of %s', disruption.key,
+                                                disruption.line, disruption.timestamp)
     #print(disruption.disruption)
     time = disruption.timestamp
     if time != None:
@@ -158,12 +680,20 @@ def format_disruption(disruption):
     #return {'header': 'Traject: ' + disruption.line, 'message': disruption.reason + "\n" + disruption.message}
 
 
+def get_trip_status(trip):
+    """
+    Status of trip as text, 'NORMAL' when it goes as planned. Newer versions of ns_api give a TripStatus instead
+    """
+    return getattr(trip.status, 'value', trip.status)
+
+
 def format_trip(trip, text_type='long'):
     """
     Format a Trip, providing an overview of all events (delays, messages etc)
 
     text_type: (long|symbol)
     """
+    import ns_api
     trip_delay = trip.delay
     message = u''
     if trip_delay['requested_differs']:
@@ -176,8 +706,10 @@ def format_trip(trip, text_type='long'):
         #message = message + u'⇥ ' + ns_api.simple_time(trip.arrival_time_actual) + u' (' + ns_api.simple_time(trip.arrival_time_planned) + u' 🕖 ' + ns_api.simple_time(trip.arrival_time_actual - trip.arrival_time_planned) + ")\n"
         message = message + u'⇥ ' + ns_api.simple_time(trip.arrival_time_planned) + u' +' + ns_api.simple_time(trip.arrival_time_actual - trip.arrival_time_planned) + "\n"
 
-    if trip.trip_remarks:
-        for remark in trip.trip_remarks:
+    # Only known to some versions of ns_api
+    trip_remarks = getattr(trip, 'trip_remarks', None)
+    if trip_remarks:
+        for remark in trip_remarks:
             if remark.is_grave:
                 message = u'⚠ ' + message + remark.message + '\n'
             else:
@@ -197,9 +729,77 @@ def format_trip(trip, text_type='long'):
     return {'header': trip.trip_parts[0].transport_type + ' ' + trip.departure + '-' + trip.destination + ' (' + ns_api.simple_time(trip.requested_time) + ')', 'message': message}
 
 
-def get_changed_disruptions(mc, disruptions):
+def format_train_item(trip):
+    """
+    Format a Trip as the one-line text of an openHAB NS_TrainN item
+    """
+    import ns_api
+    if(get_trip_status(trip) == "NORMAL"):
+        text = "🟢 "
+    else:
+        text = "🔴 "
+    # Versions of ns_api without the category of the product of the trip have the one of its first train
+    category = getattr(trip, 'product_shortCategoryName', None)
+    if category is None and trip.trip_parts:
+        category = trip.trip_parts[0].transport_type
+    text = text + str(category) + " "
+    text = text + "  " + str(ns_api.simple_time(trip.departure_time_planned))
+    text = text + " ➡ " + str(ns_api.simple_time(trip.arrival_time_planned))
+    text = text + " ⏱ " + (str(datetime.timedelta(minutes=(trip.travel_time_actual))))[:-3]
+    return text
+
+
+def get_keyword_matcher(keywords):
+    """
+    Compile the keywords into a single regular expression, None when there are no keywords
+    """
+    if not keywords:
+        return None
+    return re.compile('|'.join(re.escape(keyword) for keyword in keywords))
+
+
+# Fields of a disruption that are shown, a change in any of them is notified
+DISRUPTION_FIELDS = ('key', 'line', 'disruption', 'timestamp')
+
+
+def get_disruption_hash(disruption):
+    """
+    Hash of the contents (DISRUPTION_FIELDS) of a disruption
+    """
+    values = []
+    for field in DISRUPTION_FIELDS:
+        value = getattr(disruption, field, None)
+        values.append(value.isoformat() if isinstance(value, datetime.datetime) else value)
+    return hashlib.sha1(json.dumps(values, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def diff_disruptions(prev_hashes, disruptions):
+    """
+    Compare disruptions with the previous ones (dict of key: content hash).
+    Returns the new or changed disruptions, the keys of the resolved ones and the current serialised
+    disruptions with their hashes
+    """
+    new_or_changed = []
+    current = []
+    current_hashes = {}
+    for disruption in disruptions:
+        if disruption.key in current_hashes:
+            # Duplicate in the feed
+            continue
+        disruption_hash = get_disruption_hash(disruption)
+        current.append(disruption)
+        current_hashes[disruption.key] = disruption_hash
+        if prev_hashes.get(disruption.key) != disruption_hash:
+            new_or_changed.append(disruption)
+    resolved = [key for key in prev_hashes if key not in current_hashes]
+    return new_or_changed, resolved, dump_objects(current), current_hashes
+
+
+def get_changed_disruptions(mc, disruptions, keywordfilter=None, relevance=None):
     """
-    Get the new or changed disruptions
+    Get the new or changed disruptions, leaving out the ones matching a keyword in keywordfilter, and when
+    relevance (a RelevanceIndex) is given, the ones not affecting any configured route. Only the remaining
+    disruptions are stored
     """
     #prev_disruptions = None
     prev_disruptions = mc.get('prev_disruptions')
@@ -207,20 +807,25 @@ def get_changed_disruptions(mc, disruptions):
     if prev_disruptions == None or prev_disruptions == []:
         prev_disruptions = {'unplanned': [], 'planned': []}
 
-    prev_disruptions_unplanned = ns_api.list_from_json(prev_disruptions['unplanned'])
-    new_or_changed_unplanned = ns_api.list_diff(prev_disruptions_unplanned, disruptions['unplanned'])
-    save_unplanned = ns_api.list_merge(prev_disruptions_unplanned, new_or_changed_unplanned)
+    prev_hashes = prev_disruptions.get('hashes')
+    if prev_hashes is None:
+        # Stored by an older version, index it once
+        prev_hashes = {}
+        for disruption in load_objects(prev_disruptions['unplanned']):
+            prev_hashes[disruption.key] = get_disruption_hash(disruption)
 
-    try:
-        keywordfilter = settings.keywordfilter
-    except AttributeError:
-        keywordfilter = []
     # filter away on keyword
-    save_unplanned_filtered = []
-    for item in save_unplanned:
-        for keyword in keywordfilter:
-            if keyword not in item:
-                save_unplanned_filtered.append(item)
+    matcher = get_keyword_matcher(keywordfilter)
+    unplanned = disruptions['unplanned']
+    if matcher:
+        unplanned = [item for item in unplanned
+                     if not matcher.search(str(item.line) + '\n' + str(item.disruption))]
+    if relevance is not None:
+        unplanned = [item for item in unplanned if relevance.match(item)]
+
+    new_or_changed_unplanned, resolved, save_unplanned, save_hashes = diff_disruptions(prev_hashes, unplanned)
+    if resolved:
+        logging.getLogger('ns_notifications').debug('Resolved disruptions: ' + ', '.join(resolved))
 
     # Planned disruptions don't have machine-readable date/time and route information, so
     # we skip planned disruptions for this moment
@@ -235,77 +840,596 @@ def get_changed_disruptions(mc, disruptions):
     #prev_planned = new_or_changed_planned + unchanged_planned
 
     # Update the cached list with the current information
-    mc.set('prev_disruptions', {'unplanned': ns_api.list_to_json(save_unplanned_filtered), 'planned': []}, MEMCACHE_TTL)
+    set_state(mc, 'prev_disruptions', {'unplanned': save_unplanned, 'planned': [], 'hashes': save_hashes}, MEMCACHE_TTL)
     return new_or_changed_unplanned
 
 
-def get_changed_trips(mc, nsapi, routes, userkey):
+def get_route_time(route, current_time):
     """
-    Get the new or changed trips for userkey
+    Get the departure datetime of route, either today or on its configured date
     """
-    today = datetime.datetime.now().strftime('%d-%m')
-    today_date = datetime.datetime.now().strftime('%d-%m-%Y')
-    current_time = datetime.datetime.now()
+    parsed_time = route.get('parsed_time') or config.parse_route_time(route['time'])
+    if len(parsed_time) == 2:
+        return current_time.replace(hour=parsed_time[0], minute=parsed_time[1], second=0, microsecond=0)
+    return datetime.datetime(*parsed_time)
 
-    prev_trips = mc.get(str(userkey) + '_trips')
-    if prev_trips == None:
-        prev_trips = []
-    prev_trips = ns_api.list_from_json(prev_trips)
-    trips = []
-    for route in routes:
-        if len(route['time']) <= 5:
-            route_time = datetime.datetime.strptime(today_date + " " + route['time'], "%d-%m-%Y %H:%M")
-        else:
-            route_time = datetime.datetime.strptime(route['time'], "%d-%m-%Y %H:%M")
-        delta = current_time - route_time
-        if current_time > route_time and delta.total_seconds() > MAX_TIME_PAST:
-            # the route was too long ago ago, lets skip it
-            continue
-        if current_time < route_time and abs(delta.total_seconds()) > MAX_TIME_FUTURE:
-            # the route is too much in the future, lets skip it
-            continue
+
+def is_route_active(route, current_time):
+    """
+    Check whether route departs within the MAX_TIME_PAST/MAX_TIME_FUTURE window
+    """
+    route_time = get_route_time(route, current_time)
+    delta = current_time - route_time
+    if current_time > route_time and delta.total_seconds() > MAX_TIME_PAST:
+        # the route was too long ago ago, lets skip it
+        return False
+    if current_time < route_time and abs(delta.total_seconds()) > MAX_TIME_FUTURE:
+        # the route is too much in the future, lets skip it
+        return False
+    return True
+
+
+def get_poll_interval(seconds_to_departure):
+    """
+    Number of seconds until a route that departs in seconds_to_departure needs to be polled again
+    """
+    if seconds_to_departure < 0:
+        return ROUTE_POLL_INTERVAL_DEPARTED
+    for max_seconds, interval in ROUTE_POLL_INTERVALS:
+        if seconds_to_departure <= max_seconds:
+            return interval
+    return ROUTE_POLL_INTERVALS[-1][1]
+
+
+class RouteSchedule(object):
+    """
+    Timeline of the routes of a day, ordered in a heap on the moment they need to be polled next.
+    A route enters the timeline MAX_TIME_FUTURE before and leaves it MAX_TIME_PAST after departure
+    """
+
+    def __init__(self, user_routes, day):
+        self.day = day
+        self._heap = []
+        day_start = datetime.datetime.combine(day, datetime.time.min)
+        index = 0
+        for userkey, routes in user_routes.items():
+            for route in routes:
+                route_time = get_route_time(route, day_start)
+                window_end = route_time + datetime.timedelta(seconds=MAX_TIME_PAST)
+                if window_end >= day_start:
+                    # Not a route on a fixed date that has already passed
+                    window_start = route_time - datetime.timedelta(seconds=MAX_TIME_FUTURE)
+                    # index keeps the ordering stable for routes activating at the same moment
+                    self._heap.append((window_start, index, route_time, window_end, (userkey, route)))
+                index += 1
+        heapq.heapify(self._heap)
+
+    def get_next_wakeup(self):
+        """
+        Moment at which the next route needs to be polled, None when no routes are left today
+        """
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def get_due_routes(self, current_time):
+        """
+        Get the routes (dict of userkey: routes) that need to be polled at current_time,
+        and reschedule them based on their departure
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= current_time:
+            poll_time, index, route_time, window_end, route = heapq.heappop(self._heap)
+            if current_time > window_end:
+                # Window has passed, route is done for today
+                continue
+            due.append((index, route))
+            seconds_to_departure = (route_time - current_time).total_seconds()
+            next_poll = current_time + datetime.timedelta(seconds=get_poll_interval(seconds_to_departure))
+            if next_poll <= window_end:
+                heapq.heappush(self._heap, (next_poll, index, route_time, window_end, route))
+        # Keep the configured order of the routes
+        due_routes = collections.OrderedDict()
+        for index, (userkey, route) in sorted(due, key=lambda item: item[0]):
+            due_routes.setdefault(userkey, []).append(route)
+        return due_routes
+
+
+def fetch_route_trips(nsapi, route):
+    """
+    Get the current trips for a single route from the NS API
+    """
+    try:
+        keyword = route['keyword']
+    except KeyError:
+        keyword = None
+    return nsapi.get_trips(route['time'], route['departure'], keyword, route['destination'], True)
+
+
+def fetch_all_route_trips(nsapi, routes, max_workers=MAX_WORKERS, return_errors=False):
+    """
+    Get the current trips for all routes, querying at most max_workers routes at the same time.
+    Results are returned in the same order as routes; the first failing query raises its exception (one of
+    TRIPS_ERRORS), unless return_errors is set, in which case the exception is returned in the place of its trips
+    """
+    from ns_client import TRIPS_ERRORS
+    if not routes:
+        return []
+
+    def fetch(route):
         try:
-            keyword = route['keyword']
-        except KeyError:
-            keyword = None
-        current_trips = nsapi.get_trips(route['time'], route['departure'], keyword, route['destination'], True)
-        optimal_trip = ns_api.Trip.get_actual(current_trips, route['time'])
+            return fetch_route_trips(nsapi, route)
+        except TRIPS_ERRORS as e:
+            if not return_errors:
+                raise
+            return e
+
+    if max_workers <= 1 or len(routes) == 1:
+        # Nothing to overlap, don't start a thread
+        return [fetch(route) for route in routes]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(routes))) as executor:
+        return list(executor.map(fetch, routes))
+
+
+def select_trip(route, current_trips):
+    """
+    Select the trip of route from current_trips, None if it is not found or its delay is below the route's 'minimum'
+    """
+    import ns_api
+    optimal_trip = ns_api.Trip.get_actual(current_trips, route['time'])
+    logger = logging.getLogger('ns_notifications')
+    if logger.isEnabledFor(logging.DEBUG):
         for trip in current_trips:
-            print(trip.departure_time_planned)
-            if(trip.status == "NORMAL"):
-                print("according to plan captain!")
-            print(trip.delay)
-            print(trip.status)
-            print(trip.departure_platform_actual)
-
-
-        #optimal_trip = ns_api.Trip.get_optimal(current_trips)
-        if not optimal_trip:
-            #print("Optimal not found. Alert?")
-            # TODO: Get the trip before and the one after route['time']?
+            logger.debug('Trip planned %s, delay %s, status %s, platform %s', trip.departure_time_planned,
+                         trip.delay, trip.status, trip.departure_platform_actual)
+
+    #optimal_trip = ns_api.Trip.get_optimal(current_trips)
+    if not optimal_trip:
+        #print("Optimal not found. Alert?")
+        # TODO: Get the trip before and the one after route['time']?
+        pass
+    else:
+        try:
+            # User set a minimum treshold for departure, skip if within this limit
+            minimal_delay = int(route['minimum'])
+            trip_delay = optimal_trip.delay
+            if (not optimal_trip.has_delay) or (optimal_trip.has_delay and trip_delay['departure_delay'] != None and trip_delay['departure_delay'].seconds//60 < minimal_delay and optimal_trip.going):
+                # Trip is going, has no delay or one that is below threshold, ignore
+                optimal_trip = None
+        except KeyError:
+            # No 'minimum' setting found, just continue
             pass
-        else:
-            try:
-                # User set a minimum treshold for departure, skip if within this limit
-                minimal_delay = int(route['minimum'])
-                trip_delay = optimal_trip.delay
-                if (not optimal_trip.has_delay) or (optimal_trip.has_delay and trip_delay['departure_delay'] != None and trip_delay['departure_delay'].seconds//60 < minimal_delay and optimal_trip.going):
-                    # Trip is going, has no delay or one that is below threshold, ignore
-                    optimal_trip = None
-            except KeyError:
-                # No 'minimum' setting found, just continue
-                pass
-        if optimal_trip:
-            trips.append(optimal_trip)
-        #print(optimal_trip)
+    return optimal_trip
+
+
+def get_route_key(route):
+    """
+    Key of the NS API query for route; routes of different users with the same key share one query
+    """
+    return TripsCache.get_key(route['time'], route['departure'], route.get('keyword'), route['destination'])
+
+
+def get_route_name(route):
+    """
+    Human readable name of a route, as used in the delay history
+    """
+    start, destination, via, timestamp, departure = get_route_key(route)
+    name = route.get('departure_name', start) + ' - ' + route.get('destination_name', destination) + ' ' + timestamp
+    if via:
+        name = name + ' via ' + via
+    return name
+
+
+def get_active_disruption_lines(mc):
+    """
+    Get the lines (trajectories) of the currently stored disruptions
+    """
+    prev_disruptions = mc.get('prev_disruptions')
+    if not prev_disruptions:
+        return []
+    return [disruption.line or '' for disruption in load_objects(prev_disruptions['unplanned'])]
+
+
+def count_route_disruptions(route, lines):
+    """
+    Number of disruption lines that mention the departure or destination of route
+    """
+    stations = (route.get('departure_name', route['departure']).lower(),
+                route.get('destination_name', route['destination']).lower())
+    return len([line for line in lines if any(station in line.lower() for station in stations)])
+
+
+def get_trip_observation(route, trip):
+    """
+    Delays of trip on route, as recorded in the delay history. None if the trip has no planned departure
+    """
+    if not trip.departure_time_planned:
+        return None
+    departure_delay = 0
+    if trip.departure_time_actual:
+        departure_delay = (trip.departure_time_actual - trip.departure_time_planned).total_seconds()
+    arrival_delay = 0
+    if trip.arrival_time_actual and trip.arrival_time_planned:
+        arrival_delay = (trip.arrival_time_actual - trip.arrival_time_planned).total_seconds()
+    return {'route': get_route_name(route), 'departure_planned': trip.departure_time_planned,
+            'departure_delay': departure_delay, 'arrival_delay': arrival_delay, 'cancelled': not trip.going}
+
+
+def get_trips_key(userkey, node_id=None):
+    """
+    State key of the current trips of userkey. When the routes are split over nodes, every node (node_id) keeps
+    the trips of its own routes, so the nodes never overwrite each other's
+    """
+    if node_id is None:
+        return str(userkey) + '_trips'
+    return str(userkey) + '_trips_' + node_id
+
+
+def get_trips_keys(mc, userkey):
+    """
+    State keys of the current trips of userkey: the one of every living node when the routes are split over nodes.
+    The trips of a stopped node are left out, its routes are polled by the others
+    """
+    nodes = sharding.get_live_nodes(mc)
+    if not nodes:
+        return [get_trips_key(userkey)]
+    return [get_trips_key(userkey, node_id) for node_id in nodes]
+
+
+def get_user_trips(mc, userkey):
+    """
+    The current trips of userkey, of all nodes. None when none were stored
+    """
+    keys = get_trips_keys(mc, userkey)
+    values = mc.get_many(keys)
+    if not values:
+        return None
+    trips = []
+    for key in keys:
+        trips.extend(load_objects(values.get(key) or []))
+    return trips
+
+
+def store_changed_trips(mc, userkey, trips, node_id=None):
+    """
+    Save trips as the current trips of userkey (of node node_id), returning the ones that are new or changed
+    """
+    import ns_api
+    key = get_trips_key(userkey, node_id)
+    prev_json = mc.get(key)
+    if prev_json == None:
+        prev_json = []
+    saved = _saved_trips.get(key)
+    if saved is not None and saved[0] == prev_json:
+        # Still what this process saved last time: skip parsing the trips again
+        prev_trips = saved[1]
+    else:
+        prev_trips = load_objects(prev_json)
+        saved = None
 
     new_or_changed_trips = ns_api.list_diff(prev_trips, trips)
     #prev_trips = new_or_changed_trips + trips
     save_trips = ns_api.list_merge(prev_trips, trips)
 
-    mc.set(str(userkey) + '_trips', ns_api.list_to_json(save_trips), MEMCACHE_TTL)
+    if saved is not None and save_trips[:len(prev_trips)] == prev_trips:
+        # list_merge kept the previous trips in front, only the added ones need serialising
+        save_json = list(prev_json) + dump_objects(save_trips[len(prev_trips):])
+    else:
+        save_json = dump_objects(save_trips)
+    set_state(mc, key, save_json, MEMCACHE_TTL)
+    _saved_trips[key] = (save_json, save_trips)
     return new_or_changed_trips
 
+
+def get_last_good_key(route_key):
+    """
+    State key of the last answer of the NS API for the query route_key
+    """
+    return 'last_trips_' + hashlib.sha1(json.dumps(route_key).encode('utf-8')).hexdigest()
+
+
+def serve_stale_trips(mc, unique_routes, results, stale=None):
+    """
+    Trips per route key of unique_routes, from results (the answers, or exceptions, of their queries).
+    Answers are kept as the last known-good ones; for a failed query the last known-good answer is used,
+    and the name of its route added to stale (a dict of route key: name), if given. Failed queries without
+    a known-good answer get None
+    """
+    logger = logging.getLogger('ns_notifications')
+    last_good = mc.get_many([get_last_good_key(route_key) for route_key, result in zip(unique_routes, results)
+                             if isinstance(result, Exception)])
+    trips_per_query = {}
+    for (route_key, route), result in zip(unique_routes.items(), results):
+        if not isinstance(result, Exception):
+            trips_per_query[route_key] = result
+            if result:
+                mc.set(get_last_good_key(route_key), dump_objects(result), STALE_TRIPS_TTL)
+            continue
+        metrics.inc('errors_total', stage='trips')
+        trips_json = last_good.get(get_last_good_key(route_key))
+        if trips_json is None:
+            logger.error('Exception doing trips of ' + get_route_name(route) + ' ' + repr(result))
+            trips_per_query[route_key] = None
+            continue
+        logger.warning('Exception doing trips of ' + get_route_name(route) + ', showing the last known trips ' +
+                       repr(result))
+        metrics.inc('cache_lookups_total', cache='trips', result='stale')
+        trips_per_query[route_key] = load_objects(trips_json)
+        if stale is not None:
+            stale[route_key] = get_route_name(route)
+    return trips_per_query
+
+
+def set_stale_state(mc, stale, current_time):
+    """
+    Store since when, and for which routes, the trips shown are the last known ones instead of current ones,
+    for the status page of server.py. Nothing is written while that does not change
+    """
+    prev_stale = mc.get('nsapi_stale')
+    value = None
+    if stale:
+        value = {'since': (prev_stale or {}).get('since') or current_time.isoformat(),
+                 'routes': sorted(stale.values())}
+    if value != prev_stale:
+        set_state(mc, 'nsapi_stale', value, MEMCACHE_TTL)
+
+
+def get_relevance_index(mc, nsapi, user_routes, logger):
+    """
+    Index the stations passed by user_routes, to match disruptions to them. The index is stored in the state
+    (for server.py) whenever it changed
+    """
+    import ns_api
+    import requests
+    try:
+        station_index = get_station_index(mc, nsapi)
+    except (requests.exceptions.RequestException, ns_api.NoDataReceivedError, ns_api.RequestParametersError) as e:
+        logger.error('Exception getting the stations, disruptions are matched on the configured names ' + repr(e))
+        station_index = None
+    relevance = RelevanceIndex.build(user_routes, get_route_name, station_index, get_via_index(mc))
+    if mc.get('disruption_index_version') != get_state_version(relevance.to_json()):
+        set_state(mc, 'disruption_index', relevance.to_json(), STATIONS_TTL)
+    return relevance
+
+
+def get_via_index(mc):
+    """
+    Get the via stations and stops learned from earlier answers of the NS API
+    """
+    from planner import ViaIndex
+    learned = mc.get_many(['via_stations', 'via_stops'])
+    return ViaIndex(learned.get('via_stations') or {}, learned.get('via_stops') or {})
+
+
+def plan_alternatives(nsapi, via_index, route, current_trips, current_time, max_vias=MAX_ALTERNATIVE_VIAS,
+                      max_workers=MAX_WORKERS):
+    """
+    Rank the trips of route that still go, from current_trips (the answer already fetched for the route).
+    Only if none of them goes, the best known via stations are queried, at the same time
+    """
+    from ns_client import TRIPS_ERRORS
+    from planner import rank_trips
+    alternatives = rank_trips(current_trips, current_time)
+    if alternatives or not max_vias:
+        return alternatives
+    via_routes = [dict(route, keyword=via)
+                  for via in via_index.get_candidates(route['departure'], route['destination'], max_vias)]
+    try:
+        for trips in fetch_all_route_trips(nsapi, via_routes, max_workers):
+            current_trips = current_trips + (trips or [])
+    except TRIPS_ERRORS as e:
+        logging.getLogger('ns_notifications').error('Exception planning alternatives ' + repr(e))
+    return rank_trips(current_trips, current_time)
+
+
+def get_changed_trips_for_users(mc, nsapi, user_routes, max_workers=MAX_WORKERS, history=None, alternatives=None,
+                                max_vias=MAX_ALTERNATIVE_VIAS, stale=None, current_time=None, node_id=None):
+    """
+    Get the new or changed trips for all users in user_routes (dict of userkey: routes).
+    Every distinct query is done once, whatever the number of users having that route.
+    The delays of the trains of the routes are recorded in history, when given.
+    When alternatives (a dict) is given, it is filled with userkey: [(route, ranked alternative trips)]
+    for the routes of which the train is not found, cancelled or at least its 'minimum' late.
+    A failing query does not stop the others: its last known-good answer is used instead (see serve_stale_trips).
+    current_time (default: now) decides which routes are active. With several nodes, the trips are stored as the
+    ones of node_id (see get_trips_key), and only for the users having routes on this node
+    """
+    import ns_api
+    from planner import needs_alternative
+    if current_time is None:
+        current_time = datetime.datetime.now()
+
+    active_routes = collections.OrderedDict()
+    unique_routes = collections.OrderedDict()
+    for userkey, routes in user_routes.items():
+        active_routes[userkey] = [route for route in routes if is_route_active(route, current_time)]
+        for route in active_routes[userkey]:
+            unique_routes.setdefault(get_route_key(route), route)
+
+    results = fetch_all_route_trips(nsapi, list(unique_routes.values()), max_workers, return_errors=True)
+    if stale is None:
+        stale = {}
+    trips_per_query = serve_stale_trips(mc, unique_routes, results, stale)
+
+    if history:
+        lines = get_active_disruption_lines(mc)
+        observations = []
+        for route_key, route in unique_routes.items():
+            if route_key in stale:
+                # Already recorded when it was current
+                continue
+            actual_trip = ns_api.Trip.get_actual(trips_per_query[route_key] or [], route['time'])
+            observation = actual_trip and get_trip_observation(route, actual_trip)
+            if observation:
+                observation['disruptions'] = count_route_disruptions(route, lines)
+                observations.append(observation)
+        history.record(observations)
+
+    if alternatives is not None:
+        via_index = get_via_index(mc)
+        new_vias = False
+        for route_key, route in unique_routes.items():
+            if route_key in stale:
+                continue
+            new_vias = via_index.learn(route['departure'], route['destination'], trips_per_query[route_key] or []) \
+                or new_vias
+        if new_vias:
+            mc.set_many({'via_stations': via_index.to_json(), 'via_stops': via_index.stops}, VIA_STATIONS_TTL)
+        planned = {}
+
+    changed_trips = collections.OrderedDict()
+    for userkey, routes in active_routes.items():
+        trips = []
+        for route in routes:
+            route_key = get_route_key(route)
+            current_trips = trips_per_query[route_key] or []
+            optimal_trip = select_trip(route, current_trips)
+            if optimal_trip:
+                trips.append(optimal_trip)
+            #print(optimal_trip)
+            if alternatives is not None and needs_alternative(ns_api.Trip.get_actual(current_trips, route['time']),
+                                                              int(route.get('minimum') or 0)):
+                if route_key not in planned:
+                    planned[route_key] = plan_alternatives(nsapi, via_index, route, current_trips,
+                                                           current_time.astimezone(), max_vias, max_workers)
+                alternatives.setdefault(userkey, []).append((route, planned[route_key]))
+        if node_id is not None and not user_routes[userkey]:
+            changed_trips[userkey] = []
+            continue
+        changed_trips[userkey] = store_changed_trips(mc, userkey, trips, node_id)
+    return changed_trips
+
+
+def get_changed_trips(mc, nsapi, routes, userkey, max_workers=MAX_WORKERS):
+    """
+    Get the new or changed trips for userkey
+    """
+    return get_changed_trips_for_users(mc, nsapi, {userkey: routes}, max_workers)[userkey]
+
+def get_alternative_items_key(node_id=None):
+    """
+    State key of the openhab_item_trains items that show alternatives (of the routes of node node_id)
+    """
+    if node_id is None:
+        return 'alternative_items'
+    return 'alternative_items_' + node_id
+
+def send_alternatives(settings, mc, alternatives, logger, node_id=None):
+    """
+    Show the alternatives (dict of userkey: [(route, ranked trips)]) in the openhab_item_trains items of the users,
+    best ones first. Items that showed alternatives before and are not needed anymore are emptied; the other items
+    are left alone, they may show the output of check_connections
+    """
+    users = get_users(settings)
+    key = get_alternative_items_key(node_id)
+    prev_filled = mc.get(key) or {}
+    filled = {}
+    texts = {}
+    for userkey, route_alternatives in alternatives.items():
+        items = users.get(userkey, {}).get('openhab_item_trains', [])
+        trips = [trip for route, trips in route_alternatives for trip in trips]
+        filled[userkey] = items[:len(trips)]
+        for item, trip in zip(items, trips):
+            texts[item] = format_train_item(trip)
+        logger.debug('Alternatives for user ' + str(userkey) + ': ' +
+                     repr([(get_route_name(route), len(trips)) for route, trips in route_alternatives]))
+    for userkey, items in prev_filled.items():
+        for item in items:
+            if item not in filled.get(userkey, []):
+                texts[item] = ''
+    if texts:
+        get_openhab_output(settings).update(texts)
+    if filled != prev_filled:
+        mc.set(key, filled, ALTERNATIVE_ITEMS_TTL)
+
+
+def get_delay_predictions(model, user_routes, lines, current_time):
+    """
+    Chance of a delay per route of user_routes that has yet to depart, as dict of userkey: [(route, chance)]
+    """
+    predictions = collections.OrderedDict()
+    for userkey, routes in user_routes.items():
+        predictions[userkey] = []
+        for route in routes:
+            route_time = get_route_time(route, current_time)
+            if route_time < current_time:
+                continue
+            chance = model.score(get_route_name(route), route_time, count_route_disruptions(route, lines))
+            if chance is not None:
+                predictions[userkey].append((route, chance))
+    return predictions
+
+
+def send_delay_predictions(settings, mc, user_routes, logger, current_time=None):
+    """
+    Set the openhab_item_prediction item of the users to the routes that are likely delayed (empty if none)
+    """
+    from prediction import get_model
+    model = get_model(settings['General'].get('model_path', ''))
+    if not model:
+        return
+    users = get_users(settings)
+    probability = settings['General'].getfloat('prediction_probability', fallback=PREDICTION_PROBABILITY)
+    predictions = get_delay_predictions(model, user_routes, get_active_disruption_lines(mc),
+                                        current_time or datetime.datetime.now())
+    texts = {}
+    for userkey, route_predictions in predictions.items():
+        item = users.get(userkey, {}).get('openhab_item_prediction')
+        if not item:
+            continue
+        likely_delayed = [u'⚠ ' + get_route_name(route) + ': ' + str(int(chance * 100)) + '%'
+                          for route, chance in route_predictions if chance >= probability]
+        texts[item] = '\n'.join(likely_delayed)
+        logger.debug('Predictions for user ' + str(userkey) + ': ' + repr(route_predictions))
+    if texts:
+        get_openhab_output(settings).update(texts)
+
+
+## Sending notifications
+def get_dispatcher(settings, mc):
+    """
+    Create the dispatcher of the notifications, sending to the sinks listed in [Notifications]
+    """
+    import dispatch
+    sinks = []
+    for name in settings.get('Notifications', 'sinks', fallback='openhab').split(','):
+        name = name.strip()
+        if name == 'openhab':
+            items = dict((userkey, user['openhab_item_notifications']) for userkey, user in get_users(settings).items())
+            sinks.append(dispatch.OpenHABSink(get_openhab_output(settings), items))
+        elif name == 'pushbullet':
+            sinks.append(dispatch.PushbulletSink(settings.get('Notifications', 'pushbullet_key'),
+                                                 settings.get('Notifications', 'pushbullet_device_id', fallback=None)))
+        elif name == 'webhook':
+            sinks.append(dispatch.WebhookSink(settings.get('Notifications', 'webhook_url')))
+        elif name:
+            raise ValueError('Unknown notification sink ' + name)
+    return dispatch.Dispatcher(
+        sinks, mc,
+        settings.getint('Notifications', 'dedup_window', fallback=dispatch.DEDUP_WINDOW),
+        settings.getint('Notifications', 'coalesce_delay', fallback=dispatch.COALESCE_DELAY),
+        settings.getint('Notifications', 'rate_limit', fallback=dispatch.RATE_LIMIT))
+
+
+def dispatch_notifications(dispatcher, changed_disruptions, changed_trips, arrival_delays=True, relevance=None):
+    """
+    Submit the changed disruptions (for the users whose routes they affect when relevance is given, otherwise for
+    every user) and the changed trips that are delayed (for their user)
+    """
+    for disruption in changed_disruptions:
+        message = format_disruption(disruption)
+        userkeys = list(relevance.match(disruption)) if relevance is not None else [None]
+        for userkey in userkeys:
+            dispatcher.submit(userkey, 'disruption|' + str(disruption.key), message['header'], message['message'] or '')
+    for userkey, trips in changed_trips.items():
+        for trip in trips:
+            if not trip.has_delay(arrival_check=arrival_delays):
+                continue
+            message = format_trip(trip)
+            # The header names the train, so updates of its delay replace each other
+            dispatcher.submit(userkey, 'trip|' + message['header'], message['header'], message['message'])
+
+
 ## Main program
 @click.group()
 def cli():
@@ -341,37 +1465,31 @@ def check_connections(departure, destination, time, config_dir):
     """
 
     settings = get_config(config_dir)
-    nsapi = ns_api.NSAPI( settings['General'].get('apikey',''))
-    print(departure + " " + destination + " " + str(time))
+    nsapi = get_nsapi(settings)
+    click.echo(departure + " " + destination + " " + str(time))
     
 
-    openhab = OpenHAB(settings['Openhab'].get('openhab_url'))
-    item_ns_routeName = openhab.get_item(settings['Openhab'].get('openhab_item_route_name'))
-    item_ns_routeName.command(departure + "->" + destination + " (" + str(time)+")")
-    current_trips = nsapi.get_trips(time, departure, None, destination, True)
-    ns_trains = json.loads(settings['Openhab'].get('openhab_item_trains',[]))
+    # Resolve the station names before asking for trips, a typo would only get an error from the NS API
+    route, problems = normalise_route({'departure': departure, 'destination': destination},
+                                      get_station_index(get_state_store(settings), nsapi))
+    if problems:
+        click.echo('; '.join(problems))
+        sys.exit(1)
+    departure, destination = route['departure_name'], route['destination_name']
+
+    output = get_openhab_output(settings)
+    current_trips = nsapi.get_trips(time, route['departure'], None, route['destination'], True) or []
+    ns_trains = json.loads(settings['Openhab'].get('openhab_item_trains', '[]'))
 
+    texts = {settings['Openhab'].get('openhab_item_route_name'): departure + "->" + destination + " (" + str(time)+")"}
     for index, trip in enumerate(current_trips):
-        print(index)
-        if(trip.status == "NORMAL"):
-            text = "🟢 "
-        else:
-            text = "🔴 "
-        text = text + str(trip.product_shortCategoryName) + " "
-        text = text + "  " + str(ns_api.simple_time(trip.departure_time_planned))
-        text = text + " ➡ " + str(ns_api.simple_time(trip.arrival_time_planned))
-        text = text + " ⏱ " + (str(datetime.timedelta(minutes=(trip.travel_time_actual))))[:-3]
-        
-        if(trip.status == "NORMAL"):
-            print("according to plan captain!")
-        else:
-            print(trip.disruptions_head)
-            print(trip.disruptions_text)
-        #print(trip.delay)
-        print(trip.status)
-        print(trip.departure_platform_actual)
-        item_ns_train = openhab.get_item(ns_trains[index])
-        item_ns_train.command(text)
+        click.echo(str(index) + ' ' + str(get_trip_status(trip)) + ', platform ' + str(trip.departure_platform_actual))
+        if get_trip_status(trip) != "NORMAL" and hasattr(trip, 'disruptions_head'):
+            click.echo(trip.disruptions_head)
+            click.echo(trip.disruptions_text)
+        if index < len(ns_trains):
+            texts[ns_trains[index]] = format_train_item(trip)
+    output.update(texts)
 
 #@cli.command('run_all_notifications')
 @cli.command()
@@ -384,31 +1502,64 @@ def run_all_notifications(config_dir):
     """
     Check for both disruptions and configured trips
     """
-    logger = get_logger()
+    import upstream
     settings = get_config(config_dir)
+    logger = get_logger(settings)
 
-    ## Open memcache
-    mc = MemcacheClient(('127.0.0.1', 11211), serializer=json_serializer,
-            deserializer=json_deserializer)
+    ## Open the state store
+    mc = get_state_store(settings)
 
-    ## Check whether there's a new version of this notifier
-    update_message = check_versions(mc)
+    nsapi = get_nsapi(settings)
     try:
-        if update_message and settings.auto_update:
-            # Create (touch) file that the run_notifier script checks on for 'update needed'
-            open(os.path.dirname(os.path.realpath(__file__)) + '/needs_updating', 'a').close()
-            update_message = None
-    except AttributeError:
-        # 'auto_update' likely not defined in settings.py, default to False
-        pass
+        with metrics.timer('stage_seconds', stage='run'):
+            run_notifications(settings, mc, nsapi, logger)
+    finally:
+        upstream.end_tick()
+        metrics.inc('runs_total')
+        write_metrics(settings, logger)
+
 
-    ## NS Notifier userkey (will come from url/cli parameter in the future)
+def write_metrics(settings, logger):
+    """
+    Write the metrics to metrics_textfile from [General] (if set), for the textfile collector of node_exporter
+    and the /metrics page of server.py
+    """
+    path = settings['General'].get('metrics_textfile', '')
+    if not path:
+        return
     try:
-        userkey = settings.userkey
-    except AttributeError:
-        userkey = 1
+        metrics.REGISTRY.write_textfile(path)
+    except OSError as e:
+        logger.error('Exception writing metrics ' + repr(e))
 
 
+def run_notifications(settings, mc, nsapi, logger, user_routes=None, check_disruptions=True, dispatcher=None,
+                      relevance=None, shard=None, current_time=None, configured_routes=None):
+    """
+    Check for both disruptions and configured trips, using already opened handles.
+    user_routes (dict of userkey: routes) overrides the configured routes (e.g., only the ones due in daemon mode).
+    Notifications go to dispatcher, when given, otherwise they are sent before returning.
+    relevance (RelevanceIndex of all routes) is built from user_routes when not given.
+    shard (this node of the nodes sharing the state) is taken from [Sharding] when not given.
+    current_time (default: now) is the moment of the run, `replay` sets it to the time of the recording.
+    configured_routes (dict of userkey: routes, default: user_routes) are all routes of the users, of which the
+    delays are predicted and the affecting disruptions are looked for, also when only some of them are due
+    """
+    import requests
+    import dispatch
+    from ns_client import TRIPS_ERRORS
+    import upstream
+    ## All calls to the NS API, GitHub and openHAB of this run share one time budget, retries included
+    upstream.start_tick(settings['General'].getfloat('tick_budget', fallback=upstream.TICK_BUDGET))
+
+    ## Check whether there's a new version of this notifier
+    with metrics.timer('stage_seconds', stage='versions'):
+        update_message = check_versions(mc)
+    if update_message and settings.auto_update:
+        # Create (touch) file that the run_notifier script checks on for 'update needed'
+        open(os.path.dirname(os.path.realpath(__file__)) + '/needs_updating', 'a').close()
+        update_message = None
+
     ## Are we planned to run? (E.g., not disabled through web)
     try:
         should_run = mc.get('nsapi_run')
@@ -421,93 +1572,300 @@ def run_all_notifications(config_dir):
 
 
     # HACK, change when moved to Click and parameters
-    try:
-        if settings.skip_trips == True and settings.skip_disruptions == False:
-            should_run = True
-    except AttributeError:
-        logger.error('Tried overriding should_run, but no skip_* found')
+    if settings.skip_trips and not settings.skip_disruptions:
+        should_run = True
 
     #print('should run? ' + str(should_run))
     logger.debug('Should run: ' + str(should_run))
 
     if not should_run:
-        sys.exit(0)
+        return
 
     errors = []
-    nsapi = ns_api.NSAPI( settings.apikey)
-
-    ## Get the list of stations
-    #stations = get_stations(mc, nsapi)
 
+    ## Resolve the stations of the configured routes, leaving out the invalid ones
+    if user_routes is None:
+        with metrics.timer('stage_seconds', stage='stations'):
+            user_routes = get_valid_user_routes(settings, mc, nsapi, logger)
+
+    ## With several nodes, this one only polls its share of the routes. The holder of the disruptions lease
+    ## checks the disruptions and predicts the delays of all routes
+    all_user_routes = user_routes if configured_routes is None else configured_routes
+    leader = True
+    if shard is None:
+        shard = get_shard(settings, mc)
+    if shard is not None:
+        shard.heartbeat()
+        leader = shard.acquire_lease('disruptions')
+        check_disruptions = check_disruptions and leader
+        user_routes = shard.filter_routes(user_routes, get_route_key)
+        metrics.inc('shard_routes_total', sum(len(routes) for routes in user_routes.values()), node=shard.node_id)
 
-    ## Get the current disruptions (globally)
     changed_disruptions = []
-    get_disruptions = True
-    try:
-        if settings.skip_disruptions:
-            get_disruptions = False
-    except AttributeError:
-        logger.error('Missing skip_disruptions setting')
-    if get_disruptions:
+    changed_trips = {}
+    alternatives = {}
+    trips_checked = False
+    stale = {}
+    ## Everything stored for the disruptions and trips is written at once, at the end of this block
+    with mc.batch():
+        ## Get the current disruptions (globally)
+        if check_disruptions and not settings.skip_disruptions:
+            try:
+                with metrics.timer('stage_seconds', stage='disruptions'):
+                    if not settings.getboolean('Routes', 'relevant_disruptions_only', fallback=True):
+                        relevance = None
+                    elif relevance is None:
+                        relevance = get_relevance_index(mc, nsapi, all_user_routes, logger)
+                    disruptions = nsapi.get_disruptions()
+                    keywordfilter = ast.literal_eval(settings.get('Routes', 'keywordfilter', fallback='[]'))
+                    changed_disruptions = get_changed_disruptions(mc, disruptions, keywordfilter, relevance)
+            except requests.exceptions.RequestException as e:
+                #print('[ERROR] connectionerror doing disruptions')
+                metrics.inc('errors_total', stage='disruptions')
+                logger.error('Exception doing disruptions ' + repr(e))
+                errors.append(('Exception doing disruptions', e))
+
+        ## Get the information on the list of trips configured by the users
+        get_trips = not settings.skip_trips
+        if get_trips and any(user_routes.values()):
+            try:
+                max_workers = settings['General'].getint('max_workers', fallback=MAX_WORKERS)
+                with metrics.timer('stage_seconds', stage='trips'):
+                    changed_trips = get_changed_trips_for_users(
+                        mc, nsapi, user_routes, max_workers, get_history(settings), alternatives,
+                        settings['General'].getint('alternative_vias', fallback=MAX_ALTERNATIVE_VIAS), stale,
+                        current_time, shard.node_id if shard is not None else None)
+                trips_checked = True
+                set_stale_state(mc, stale, current_time or datetime.datetime.now())
+            except TRIPS_ERRORS as e:
+                #print('[ERROR] connectionerror doing trips')
+                metrics.inc('errors_total', stage='trips')
+                logger.error('Exception doing trips ' + repr(e))
+                errors.append(('Exception doing trips', e))
+            logger.debug('Trips cache: %s', nsapi.get_stats())
+
+    ## Suggest other trains for the routes of which the train is cancelled or late
+    if alternatives or trips_checked:
         try:
-            disruptions = nsapi.get_disruptions()
-            changed_disruptions = get_changed_disruptions(mc, disruptions)
-        except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
-            #print('[ERROR] connectionerror doing disruptions')
-            logger.error('Exception doing disruptions ' + repr(e))
-            errors.append(('Exception doing disruptions', e))
-
-    ## Get the information on the list of trips configured by the user
-    trips = []
-    get_trips = True
-    try:
-        if settings.skip_trips:
-            get_trips = False
-    except AttributeError:
-        logger.error('Missing skip_trips setting')
-    if get_trips:
+            with metrics.timer('stage_seconds', stage='alternatives'):
+                send_alternatives(settings, mc, alternatives, logger, shard.node_id if shard is not None else None)
+        except Exception as e:
+            metrics.inc('errors_total', stage='alternatives')
+            logger.error('Exception sending alternatives ' + repr(e))
+            errors.append(('Exception sending alternatives', e))
+
+    ## Warn early for routes that are likely delayed, judging from their history
+    if get_trips and leader:
         try:
-            trips = get_changed_trips(mc, nsapi, settings.routes, userkey)
-            print(trips)
-        except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
-            #print('[ERROR] connectionerror doing trips')
-            logger.error('Exception doing trips ' + repr(e))
-            errors.append(('Exception doing trips', e))
+            with metrics.timer('stage_seconds', stage='predictions'):
+                send_delay_predictions(settings, mc, all_user_routes, logger, current_time)
+        except Exception as e:
+            metrics.inc('errors_total', stage='predictions')
+            logger.error('Exception doing predictions ' + repr(e))
+            errors.append(('Exception doing predictions', e))
+
+    ## Publish the changes, now that they are stored
+    with metrics.timer('stage_seconds', stage='publish'):
+        if changed_disruptions:
+            publish_event(mc, 'disruptions', [format_disruption(disruption) for disruption in changed_disruptions])
+        trips = []
+        for userkey, user_trips in changed_trips.items():
+            if user_trips:
+                messages = [format_trip(trip) for trip in user_trips]
+                publish_event(mc, 'trips', messages, userkey)
+                trips.extend(message['header'] for message in messages)
+    # By their headers, some versions of ns_api can't repr a Trip
+    logger.debug('Changed trips: %s', trips)
 
     # User is interested in arrival delays
-    arrival_delays = True
-    try:
-        arrival_delays = settings.arrival_delays
-    except AttributeError:
-        pass
+    arrival_delays = settings.arrival_delays
 
-    if settings.notification_type == 'pb':
-        #p, sendto_device = get_pushbullet_config(logger)
-        #if not sendto_device:
-        #    sys.exit(1)
+    ## Send the notifications, merging them with the ones still queued (daemon mode)
+    if changed_disruptions or any(changed_trips.values()):
+        own_dispatcher = dispatcher is None
+        try:
+            with metrics.timer('stage_seconds', stage='dispatch'):
+                if own_dispatcher:
+                    dispatcher = get_dispatcher(settings, mc)
+                dispatch_notifications(dispatcher, changed_disruptions, changed_trips, arrival_delays, relevance)
+                # Also when the run used up its budget: what is still queued is lost when this process ends
+                if own_dispatcher and not dispatcher.close(max(upstream.budget.remaining() or 0,
+                                                               dispatch.FLUSH_TIMEOUT)):
+                    logger.error('Not all notifications were sent within the time budget')
+        except Exception as e:
+            metrics.inc('errors_total', stage='dispatch')
+            logger.error('Exception dispatching notifications ' + repr(e))
 
-        #if update_message:
-        #    p.push_note(update_message['header'], update_message['message'], sendto_device)
+@cli.command()
+@click.option('--config_dir',
+              required=False,
+              default=sys.path[0],
+              help=(('Config directory, '
+                     'Directory where config.ini is located')))
+@click.option('--interval',
+              required=False,
+              default=None,
+              type=int,
+              help=(('Seconds between two runs, '
+                     'if not specified, it is read from daemon_interval in config.ini')))
+def daemon(config_dir, interval):
+    """
+    Keep running, checking for disruptions and configured trips every interval
+    """
+    import upstream
+    config_mtime = get_config_mtime(config_dir)
+    settings = get_config(config_dir)
+    logger = get_logger(settings)
+
+    ## Open the state store once, it is reused for every run
+    mc = get_state_store(settings)
+
+    # The handles below are built from settings before the first run, and again when it was reloaded
+    settings_changed = True
+    dispatcher = None
+    next_disruptions_run = datetime.datetime.now()
+    next_version_check = datetime.datetime.now()
+    while True:
+        current_mtime = get_config_mtime(config_dir)
+        if current_mtime != config_mtime:
+            # (Re)load the configuration only when it was changed on disk
+            logger.info('Loading configuration from ' + config_dir)
+            config_mtime = current_mtime
+            try:
+                settings = get_config(config_dir)
+            except config.ConfigError as e:
+                # The configuration loaded before is valid, the daemon keeps running with it
+                logger.error('Invalid configuration, keeping the previous one: ' + str(e))
+            else:
+                settings_changed = True
+        if settings_changed:
+            settings_changed = False
+            nsapi = get_nsapi(settings)
+            user_routes = get_valid_user_routes(settings, mc, nsapi, logger)
+            relevance = None
+            if dispatcher:
+                dispatcher.close()
+            dispatcher = get_dispatcher(settings, mc)
+            shard = get_shard(settings, mc)
+            schedule = None
+        if interval:
+            run_interval = interval
+        else:
+            run_interval = settings['General'].getint('daemon_interval', fallback=DAEMON_INTERVAL)
+
+        current_time = datetime.datetime.now()
+        if schedule is None or schedule.day != current_time.date():
+            schedule = RouteSchedule(user_routes, current_time.date())
+        due_routes = schedule.get_due_routes(current_time)
+        check_disruptions = current_time >= next_disruptions_run
+        if check_disruptions:
+            next_disruptions_run = current_time + datetime.timedelta(seconds=run_interval)
+            if settings.getboolean('Routes', 'relevant_disruptions_only', fallback=True):
+                # Built again for every check, with the stops and transfers learned from the trips since
+                relevance = get_relevance_index(mc, nsapi, user_routes, logger)
+
+        if current_time >= next_version_check:
+            # Separate from the runs, so they never wait for GitHub
+            next_version_check = current_time + datetime.timedelta(seconds=VERSION_CHECK_INTERVAL)
+            try:
+                upstream.start_tick(settings['General'].getfloat('tick_budget', fallback=upstream.TICK_BUDGET))
+                refresh_versions(mc, settings['General'].get('version_url', VERSION_URL))
+            except Exception as e:
+                metrics.inc('errors_total', stage='versions')
+                logger.error('Exception checking versions ' + repr(e))
+            upstream.end_tick()
+
+        if due_routes or check_disruptions:
+            try:
+                with metrics.timer('stage_seconds', stage='run'):
+                    run_notifications(settings, mc, nsapi, logger, due_routes, check_disruptions, dispatcher,
+                                      relevance, shard, configured_routes=user_routes)
+            except MemcachedNotInstalledException:
+                raise
+            except Exception as e:
+                # Keep the daemon alive, next run might do better
+                metrics.inc('errors_total', stage='run')
+                logger.exception('Exception during run ' + repr(e))
+            upstream.end_tick()
+            metrics.inc('runs_total')
+            write_metrics(settings, logger)
+
+        # Sleep until a route or the disruptions need polling, the versions need checking or the schedule of the
+        # next day starts
+        wakeup = min(next_disruptions_run, next_version_check,
+                     datetime.datetime.combine(current_time.date() + datetime.timedelta(days=1), datetime.time.min))
+        next_route_poll = schedule.get_next_wakeup()
+        if next_route_poll and next_route_poll < wakeup:
+            wakeup = next_route_poll
+        time.sleep(max(1, (wakeup - datetime.datetime.now()).total_seconds()))
 
-        if changed_disruptions:
-            # There are disruptions that are new or changed since last run
-            sendto_channel = None
-
-            for disruption in changed_disruptions:
-                message = format_disruption(disruption)
-        if trips:
-            for trip in trips:
-                if not arrival_delays:
-                    # User is only interested in departure
-                    notification_needed = trip.has_delay(arrival_check=False)
-                else:
-                    notification_needed = trip.has_delay()
-                if notification_needed:
-                    message = format_trip(trip)
-                    #print message
-                    logger.debug(message)
-                    #p.push_note('title', 'body', sendto_device)
-                    #p.push_note(message['header'], message['message'], sendto_device)
+@cli.command()
+@click.option('--config_dir',
+              required=False,
+              default=sys.path[0],
+              help=(('Config directory, '
+                     'Directory where config.ini is located')))
+@click.option('--days',
+              required=False,
+              default=90,
+              help='Number of days of history to use')
+@click.option('--per-weekday/--per-route',
+              default=True,
+              help='Statistics per route and weekday, or per route only')
+def stats(config_dir, days, per_weekday):
+    """
+    Show punctuality statistics of the routes, from the delay history
+    """
+    settings = get_config(config_dir)
+    history = get_history(settings)
+    if not history:
+        click.echo('No delay history kept, set history_path in the [General] section of config.ini')
+        sys.exit(1)
+
+    since = datetime.datetime.now() - datetime.timedelta(days=days)
+    weekdays = {None: 'all', 1: 'mon', 2: 'tue', 3: 'wed', 4: 'thu', 5: 'fri', 6: 'sat', 7: 'sun'}
+    click.echo('{0:<50} {1:<4} {2:>6} {3:>8} {4:>8} {5:>8} {6:>8} {7:>9}'.format(
+        'route', 'day', 'trains', 'dep p50', 'dep p90', 'arr p50', 'arr p90', 'cancelled'))
+
+    def minutes(seconds):
+        if seconds is None:
+            return '-'
+        return '{0:.1f}m'.format(seconds / 60.0)
+
+    for row in history.get_statistics(since, per_weekday):
+        click.echo('{0:<50} {1:<4} {2:>6} {3:>8} {4:>8} {5:>8} {6:>8} {7:>8.1f}%'.format(
+            row['route'], weekdays[row['weekday']], row['trains'], minutes(row['departure_p50']),
+            minutes(row['departure_p90']), minutes(row['arrival_p50']), minutes(row['arrival_p90']),
+            row['cancelled'] * 100))
+
+@cli.command()
+@click.option('--config_dir',
+              required=False,
+              default=sys.path[0],
+              help=(('Config directory, '
+                     'Directory where config.ini is located')))
+@click.option('--days',
+              required=False,
+              default=180,
+              help='Number of days of history to train on')
+def train_model(config_dir, days):
+    """
+    Train the delay prediction model from the delay history, and save it in model_path
+    """
+    from prediction import DelayModel
+    settings = get_config(config_dir)
+    history = get_history(settings)
+    model_path = settings['General'].get('model_path', '')
+    if not history or not model_path:
+        click.echo('Set both history_path and model_path in the [General] section of config.ini')
+        sys.exit(1)
+
+    started = time.monotonic()
+    threshold = settings['General'].getint('prediction_threshold', fallback=PREDICTION_THRESHOLD) * 60
+    model = DelayModel.train(history, datetime.datetime.now() - datetime.timedelta(days=days), threshold)
+    model.save(model_path)
+    click.echo('Trained on {0} cells of route/weekday/hour in {1:.2f} s, saved to {2}'.format(
+        len(model.counts), time.monotonic() - started, model_path))
 
 @cli.command()
 @click.option('--config_dir',
@@ -522,11 +1880,88 @@ def updated(config_dir):
     
     settings = get_config(config_dir)
 
-    openhab = OpenHAB(settings.openhab_url)
-    item_ns_notification = openhab.get_item(settings.openhab_item_notifications)
+    output = get_openhab_output(settings)
 
     local_version = get_local_version()
-    item_ns_notification.command('Notifier was updated to ' + local_version + ', details might be in your (cron) email')
+    output.update({settings['Openhab'].get('openhab_item_notifications'):
+                   'Notifier was updated to ' + local_version + ', details might be in your (cron) email'})
+
+@cli.command()
+@click.option('--config_dir',
+              required=False,
+              default=sys.path[0],
+              help=(('Config directory, '
+                     'Directory where config.ini is located')))
+@click.option('--url',
+              required=False,
+              default=None,
+              help=(('URL of the latest VERSION, '
+                     'if not specified, it is read from version_url in config.ini')))
+def check_version(config_dir, url):
+    """
+    Check for a new version of the notifier and ns-api, for the next runs (call from cron every few hours)
+    """
+    import upstream
+    settings = get_config(config_dir)
+    upstream.configure(settings)
+    mc = get_state_store(settings)
+    message = refresh_versions(mc, url or settings['General'].get('version_url', VERSION_URL))
+    if message:
+        click.echo(message['message'])
+
+@cli.command()
+@click.option('--config_dir',
+              required=False,
+              default=sys.path[0],
+              help=(('Config directory, '
+                     'Directory where config.ini is located')))
+@click.option('--recording',
+              required=True,
+              help='Directory with a snapshot directory per recorded moment, see record-fixtures --snapshot')
+@click.option('--start',
+              required=False,
+              default=None,
+              help='Start of the replay (YYYY-mm-dd HH:MM), default the first snapshot')
+@click.option('--hours',
+              required=False,
+              default=24.0,
+              help='Hours to replay')
+@click.option('--strategy',
+              required=False,
+              multiple=True,
+              type=click.Choice(['schedule', 'interval']),
+              help=(('Polling of the routes: schedule (like the daemon) or interval (like cron, every --interval), '
+                     'repeat to compare; default both')))
+@click.option('--interval',
+              required=False,
+              default=None,
+              type=int,
+              help='Seconds between polls of the disruptions (and of the routes with --strategy interval)')
+@click.option('--max-time-past', required=False, default=None, type=int, help='Replaces MAX_TIME_PAST')
+@click.option('--max-time-future', required=False, default=None, type=int, help='Replaces MAX_TIME_FUTURE')
+@click.option('--minimum', required=False, default=None, type=int, help='Minimum delay of every route')
+def replay(config_dir, recording, start, hours, strategy, interval, max_time_past, max_time_future, minimum):
+    """
+    Replay recorded NS API answers through the notifier on a simulated clock, reporting the calls to the NS API,
+    the notifications and their latency after the delay first showed up in the recording
+    """
+    import replay as replaying
+    settings = replaying.get_replay_settings(get_config(config_dir), minimum)
+    source = replaying.Recording(recording)
+    start = datetime.datetime.strptime(start, '%Y-%m-%d %H:%M') if start else source.times[0]
+    end = start + datetime.timedelta(hours=hours)
+    if interval is None:
+        interval = settings['General'].getint('daemon_interval', fallback=DAEMON_INTERVAL)
+    reports = collections.OrderedDict()
+    # The strategies share the trips parsed from the recording
+    answers = {}
+    for name in strategy or ('schedule', 'interval'):
+        started = time.perf_counter()
+        reports[name] = replaying.replay(settings, source, start, end, name, interval, max_time_past, max_time_future,
+                                         answers)
+        reports[name]['replay_seconds'] = time.perf_counter() - started
+    for line in replaying.format_reports(reports):
+        click.echo(line)
 
 
 if not hasattr(main, '__file__'):
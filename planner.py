@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Planning of alternatives for a route of which the train is cancelled or late
+"""
+import datetime
+
+
+class ViaIndex(object):
+    """
+    Transfer stations of the trips NS advised, learned from the trip parts of earlier answers.
+    They are indexed per departure and destination of the query and per station, so the candidate
+    vias of a route are found with a few dictionary lookups, without asking the NS API.
+    The stations the trips stop at (or pass) on the way are kept per query as well
+    """
+
+    def __init__(self, pairs=None, stops=None):
+        # 'departure|destination': {via: number of advised trips transferring there}, as stored in the state
+        self.pairs = pairs or {}
+        # 'departure|destination': {station: number of advised trips stopping there}, as stored in the state
+        self.stops = stops or {}
+        self.from_station = {}
+        self.to_station = {}
+        for pair, vias in self.pairs.items():
+            departure, destination = pair.split('|', 1)
+            for via, count in vias.items():
+                self._add_edges(departure, destination, via, count)
+
+    @staticmethod
+    def get_key(departure, destination):
+        return departure.lower() + '|' + destination.lower()
+
+    def _add_edges(self, departure, destination, via, count):
+        from_vias = self.from_station.setdefault(departure, {})
+        from_vias[via] = from_vias.get(via, 0) + count
+        to_vias = self.to_station.setdefault(destination, {})
+        to_vias[via] = to_vias.get(via, 0) + count
+
+    def learn(self, departure, destination, trips):
+        """
+        Add the transfer stations and stops of trips (an answer for departure to destination) to the index.
+        Returns whether a via or stop was seen that was not known yet
+        """
+        key = self.get_key(departure, destination)
+        departure, destination = key.split('|', 1)
+        vias = self.pairs.setdefault(key, {})
+        stops = self.stops.setdefault(key, {})
+        new_station = False
+        for trip in trips:
+            for part in trip.trip_parts[:-1]:
+                via = part.destination
+                if via.lower() in (departure, destination):
+                    continue
+                new_station = new_station or via not in vias
+                vias[via] = vias.get(via, 0) + 1
+                self._add_edges(departure, destination, via, 1)
+            for part in trip.trip_parts:
+                for stop in part.stops:
+                    if stop.name.lower() in (departure, destination):
+                        continue
+                    new_station = new_station or stop.name not in stops
+                    stops[stop.name] = stops.get(stop.name, 0) + 1
+        if not vias:
+            del self.pairs[key]
+        if not stops:
+            del self.stops[key]
+        return new_station
+
+    def get_stations(self, departure, destination):
+        """
+        The transfer stations and stops of the trips advised from departure to destination
+        """
+        key = self.get_key(departure, destination)
+        stations = list(self.pairs.get(key, {}))
+        stations.extend(stop for stop in self.stops.get(key, {}) if stop not in stations)
+        return stations
+
+    def get_candidates(self, departure, destination, limit):
+        """
+        At most limit via stations to try from departure to destination: first the ones NS advised for this
+        very query, then the stations that were transfers both from departure and to destination
+        """
+        key = self.get_key(departure, destination)
+        departure, destination = key.split('|', 1)
+        advised = self.pairs.get(key, {})
+        candidates = sorted(advised, key=advised.get, reverse=True)
+        from_vias = self.from_station.get(departure, {})
+        to_vias = self.to_station.get(destination, {})
+        connecting = [via for via in from_vias if via in to_vias and via not in advised]
+        candidates.extend(sorted(connecting, key=lambda via: from_vias[via] + to_vias[via], reverse=True))
+        return [via for via in candidates if via.lower() not in (departure, destination)][:limit]
+
+    def to_json(self):
+        return self.pairs
+
+
+def get_departure(trip):
+    return trip.departure_time_actual or trip.departure_time_planned
+
+
+def get_arrival(trip):
+    return trip.arrival_time_actual or trip.arrival_time_planned
+
+
+def needs_alternative(trip, minimum=0):
+    """
+    Whether alternatives should be planned for trip, the train of a route: it is not found, cancelled or at least
+    minimum minutes (the 'minimum' of the route) late
+    """
+    if trip is None or not trip.going:
+        return True
+    delay = trip.delay['departure_delay']
+    return bool(delay) and delay.total_seconds() // 60 >= minimum
+
+
+def rank_trips(trips, now=None):
+    """
+    The trips that are going and did not depart before now (timezone-aware datetime), earliest actual
+    arrival first and then the fewest transfers. The same train found by several queries is listed once
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    ranked = {}
+    for trip in trips:
+        if not trip.going or not get_arrival(trip) or not get_departure(trip) or get_departure(trip) < now:
+            continue
+        key = (get_departure(trip), get_arrival(trip), tuple(part.journey_id for part in trip.trip_parts))
+        ranked.setdefault(key, trip)
+    return sorted(ranked.values(), key=lambda trip: (get_arrival(trip), trip.nr_transfers, get_departure(trip)))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Prediction of delays of the configured routes, from the delay history
+"""
+import datetime
+import json
+import os
+
+# Below this number of trains in a (route, weekday, hour) cell, the numbers of the whole route are used
+MIN_SAMPLES = 5
+
+
+class DelayModel(object):
+    """
+    Empirical chance of a delay of at least threshold seconds, per route, weekday, hour and whether there are
+    active disruptions on the route. Scoring only does dictionary lookups
+    """
+
+    def __init__(self, threshold, counts, trained_at=None):
+        self.threshold = threshold
+        self.trained_at = trained_at
+        # 'route|weekday|hour|disrupted': [trains, delayed]
+        self.counts = counts
+        # Totals per 'route|disrupted', the fallback for cells with too little data
+        self.route_counts = {}
+        for key, (trains, delayed) in counts.items():
+            route, weekday, hour, disrupted = key.rsplit('|', 3)
+            totals = self.route_counts.setdefault(route + '|' + disrupted, [0, 0])
+            totals[0] += trains
+            totals[1] += delayed
+
+    @classmethod
+    def train(cls, history, since, threshold):
+        """
+        Build the model from the trains in history (a DelayHistory) planned since
+        """
+        counts = {}
+        for route, weekday, hour, disrupted, trains, delayed in history.get_delay_counts(since, threshold):
+            counts['{0}|{1}|{2}|{3}'.format(route, weekday, hour, int(disrupted))] = [trains, delayed]
+        return cls(threshold, counts, datetime.datetime.now().isoformat())
+
+    def save(self, path):
+        with open(path + '.tmp', 'w') as model_file:
+            json.dump({'threshold': self.threshold, 'trained_at': self.trained_at, 'counts': self.counts}, model_file)
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as model_file:
+            data = json.load(model_file)
+        return cls(data['threshold'], data['counts'], data.get('trained_at'))
+
+    def score(self, route, departure_planned, disruptions=0):
+        """
+        Chance (0-1) that the train of route at departure_planned (datetime) is delayed by at least threshold,
+        given the number of active disruptions on the route. None when the route has no history
+        """
+        disrupted = str(int(disruptions > 0))
+        key = '{0}|{1}|{2}|{3}'.format(route, departure_planned.isoweekday(), departure_planned.hour, disrupted)
+        trains, delayed = self.counts.get(key, (0, 0))
+        if trains < MIN_SAMPLES:
+            trains, delayed = self.route_counts.get(route + '|' + disrupted, (0, 0))
+        if not trains:
+            return None
+        # Laplace smoothing, so a few trains don't make a certainty
+        return (delayed + 1.0) / (trains + 2.0)
+
+
+_loaded_models = {}
+
+
+def get_model(path):
+    """
+    Load the model in path, reusing it until the file changes. None when there is no model (yet)
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    if path not in _loaded_models or _loaded_models[path][0] != mtime:
+        _loaded_models[path] = (mtime, DelayModel.load(path))
+    return _loaded_models[path][1]
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the stations the configured routes pass, to find the users affected by a disruption from its line
+(like 'Amsterdam Centraal - Utrecht Centraal') with a dictionary lookup per station in it
+"""
+import re
+
+# Separators of the stations in the line of a disruption
+LINE_SEPARATORS = re.compile(r'\s+-\s+|/|,|;|\s+en\s+|\s+and\s+|:')
+
+
+class RelevanceIndex(object):
+    """
+    Routes per station, by station code and by every (lowercase) name of the station. A route passes its
+    departure, destination, via (keyword) and the transfer stations and stops of the trips NS advised for it before
+    """
+
+    def __init__(self, stations=None):
+        # station code or name: {userkey: [route names]}, as stored in the state
+        self.stations = stations or {}
+
+    @classmethod
+    def build(cls, user_routes, get_route_name, station_index=None, via_index=None):
+        """
+        Index user_routes (dict of userkey: routes). Names of the stations are taken from station_index,
+        transfers and stops from via_index, when given
+        """
+        aliases = {}
+        if station_index is not None:
+            for code, name, other_names in station_index.stations:
+                aliases[code.lower()] = [name] + list(other_names)
+        index = cls()
+        for userkey, routes in user_routes.items():
+            for route in routes:
+                stations = [route[field] for field in ('departure', 'destination', 'keyword') if route.get(field)]
+                if via_index is not None:
+                    stations.extend(via_index.get_stations(route['departure'], route['destination']))
+                for station in stations:
+                    for name in [station] + aliases.get(station.lower(), []):
+                        index.add(name, userkey, get_route_name(route))
+        return index
+
+    def add(self, station, userkey, route_name):
+        routes = self.stations.setdefault(station.strip().lower(), {}).setdefault(str(userkey), [])
+        if route_name not in routes:
+            routes.append(route_name)
+
+    @staticmethod
+    def get_line_stations(line):
+        """
+        The (lowercase) station names in the line of a disruption
+        """
+        return [station.strip().lower() for station in LINE_SEPARATORS.split(line or '') if station.strip()]
+
+    def match(self, disruption):
+        """
+        The users affected by disruption, as dict of userkey: names of their routes passing a station of its line
+        """
+        affected = {}
+        for station in self.get_line_stations(disruption.line):
+            for userkey, route_names in self.stations.get(station, {}).items():
+                user_routes = affected.setdefault(userkey, [])
+                user_routes.extend(name for name in route_names if name not in user_routes)
+        return affected
+
+    def to_json(self):
+        return self.stations
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Replay of recorded NS API answers through the whole notifier (trips and disruptions diffing, dispatching) on a
+simulated clock, to compare polling strategies and settings offline: counts the calls to the NS API and the
+notifications, and how long after a delay first showed up in the recording it was notified
+"""
+import bisect
+import collections
+import copy
+import datetime
+import logging
+import os
+import threading
+from urllib.parse import urlencode
+
+import requests
+
+import dispatch
+import ns_client
+import ns_notifications
+from fake_services import get_fixture_name
+from state_store import LRUStore
+
+# Name of the directory of a snapshot: the moment it was recorded
+SNAPSHOT_FORMAT = '%Y%m%dT%H%M%S'
+
+
+class Clock(object):
+    """
+    Simulated time, only moved by the replay
+    """
+
+    def __init__(self, start):
+        self.current = start
+
+    def now(self):
+        return self.current
+
+    def time(self):
+        # Seconds since the epoch, like time.time(), for the expiry of keys in the state store
+        return self.current.timestamp()
+
+    def advance(self, moment):
+        self.current = max(self.current, moment)
+
+
+class Recording(object):
+    """
+    Recorded answers of the NS API: a directory per snapshot, named after the moment it was taken (SNAPSHOT_FORMAT),
+    holding the responses as saved by `benchmark.py record-fixtures`. At any moment, the last snapshot taken
+    before it answers
+    """
+
+    def __init__(self, recording_dir):
+        self.recording_dir = recording_dir
+        self.times = []
+        self.names = []
+        for name in sorted(os.listdir(recording_dir)):
+            try:
+                moment = datetime.datetime.strptime(name, SNAPSHOT_FORMAT)
+            except ValueError:
+                continue
+            self.times.append(moment)
+            self.names.append(name)
+        if not self.times:
+            raise ValueError('No snapshots in ' + recording_dir)
+
+    def get_snapshot(self, moment):
+        """
+        Index of the snapshot answering at moment (the first one before the recording started)
+        """
+        return max(0, bisect.bisect(self.times, moment) - 1)
+
+    def respond(self, moment, url):
+        """
+        Recorded response to url at moment, None when there is none
+        """
+        path = os.path.join(self.recording_dir, self.names[self.get_snapshot(moment)], get_fixture_name(url))
+        if not os.path.exists(path):
+            return None
+        with open(path) as fixture:
+            return fixture.read()
+
+
+class ReplayNSAPI(ns_client.NotifierNSAPI):
+    """
+    NotifierNSAPI answering from source (a Recording, or anything with times, get_snapshot(moment) and
+    respond(moment, url)) at the time of clock, counting the calls per endpoint. Trips are parsed once per
+    query, date and snapshot, in answers (a dict, which can be shared with other ReplayNSAPI objects of source,
+    also of replays with other strategies)
+    """
+
+    def __init__(self, source, clock, answers=None, **kwargs):
+        super(ReplayNSAPI, self).__init__('replay', **kwargs)
+        self.source = source
+        self.clock = clock
+        self.answers = {} if answers is None else answers
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def get_trips(self, timestamp, start, via, destination, departure=True):
+        # A route time is asked on the date of the clock, a snapshot can answer on both sides of midnight
+        key = (self.source.get_snapshot(self.clock.now()), self.clock.now().date(),
+               ns_notifications.TripsCache.get_key(timestamp, start, via, destination, departure))
+        trips = self.answers.get(key)
+        if trips is None:
+            if len(timestamp) == 5:
+                # ns_api would put the route time on today's date, the replay asks on the date of its clock
+                timestamp = self.clock.now().strftime('%d-%m-%Y ') + timestamp
+            trips = super(ReplayNSAPI, self).get_trips(timestamp, start, via, destination, departure)
+            self.answers[key] = trips
+        else:
+            with self._lock:
+                self.calls['trips'] += 1
+        return trips
+
+    def _request(self, method, url, postdata=None, params=None):
+        if params:
+            url = url + ('&' if '?' in url else '?') + urlencode(params)
+        endpoint = url.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+        with self._lock:
+            self.calls[endpoint] += 1
+        text = self.source.respond(self.clock.now(), url)
+        if text is None:
+            raise requests.exceptions.HTTPError('No recorded response for ' + url)
+        return text
+
+
+class ReplaySink(dispatch.Sink):
+    """
+    Keeps the notifications with the (simulated) moment they were sent
+    """
+
+    name = 'replay'
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []
+
+    def send(self, userkey, header, message):
+        self.sent.append((self.clock.now(), userkey, header))
+
+
+def get_replay_settings(settings, minimum=None):
+    """
+    Copy of settings for a replay, which keeps no delay history, makes no predictions and sends nothing to
+    openHAB. The recorded answers are parsed one after the other, threads would only add overhead. With minimum,
+    every route gets that minimum delay
+    """
+    replay_settings = copy.deepcopy(settings)
+    replay_settings.read_dict({'General': {'history_path': '', 'model_path': '', 'max_workers': '1'}})
+    replay_settings.users = collections.OrderedDict()
+    for userkey, user in settings.users.items():
+        routes = [dict(route) for route in user['routes']]
+        if minimum is not None:
+            for route in routes:
+                route['minimum'] = minimum
+        replay_settings.users[userkey] = dict(user, routes=routes, openhab_item_trains=[],
+                                              openhab_item_notifications=None, openhab_item_prediction=None)
+    return replay_settings
+
+
+def get_route_windows(route, start, end):
+    """
+    (opening, closing) moments of the windows between start and end in which route is polled: one per day for
+    a daily route
+    """
+    windows = []
+    day = datetime.datetime.combine(start.date(), datetime.time.min)
+    while day < end:
+        route_time = ns_notifications.get_route_time(route, day)
+        window = (max(start, route_time - datetime.timedelta(seconds=ns_notifications.MAX_TIME_FUTURE)),
+                  min(end, route_time + datetime.timedelta(seconds=ns_notifications.MAX_TIME_PAST)))
+        if window[0] < window[1] and window not in windows:
+            windows.append(window)
+        day += datetime.timedelta(days=1)
+    return windows
+
+
+def get_first_delays(source, user_routes, start, end, arrival_delays=True, answers=None):
+    """
+    Moment each delayed train of user_routes (dict of userkey: routes) first shows up in source between start
+    and end, within the window the route is polled in: dict of (userkey, header): moment. A delay in the snapshot
+    answering when the window opens counts from the opening. answers are the trips parsed by ReplayNSAPI before
+    """
+    clock = Clock(start)
+    nsapi = ReplayNSAPI(source, clock, answers)
+    first = {}
+    for userkey, routes in user_routes.items():
+        for route in routes:
+            for opening, closing in get_route_windows(route, start, end):
+                moments = [opening] + source.times[bisect.bisect(source.times, opening):
+                                                   bisect.bisect(source.times, closing)]
+                for moment in moments:
+                    clock.current = moment
+                    try:
+                        trips = ns_notifications.fetch_route_trips(nsapi, route)
+                    except requests.exceptions.RequestException:
+                        continue
+                    trip = ns_notifications.select_trip(route, trips)
+                    if trip and trip.has_delay(arrival_check=arrival_delays):
+                        first.setdefault((userkey, ns_notifications.format_trip(trip)['header']), moment)
+    return first
+
+
+def get_first_disruptions(source, start, end):
+    """
+    Moment each disruption first shows up in the snapshots of source between start and end, as dict of header: moment
+    """
+    clock = Clock(start)
+    nsapi = ReplayNSAPI(source, clock)
+    first = {}
+    for moment in [moment for moment in source.times if start <= moment < end]:
+        clock.current = moment
+        try:
+            disruptions = nsapi.get_disruptions()
+        except requests.exceptions.RequestException:
+            continue
+        for disruption in disruptions['unplanned']:
+            first.setdefault(ns_notifications.format_disruption(disruption)['header'], moment)
+    return first
+
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100.0))]
+
+
+def replay(settings, source, start, end, strategy='schedule', interval=ns_notifications.DAEMON_INTERVAL,
+           max_time_past=None, max_time_future=None, answers=None):
+    """
+    Run the notifier over source from start to end, polling like the daemon (strategy 'schedule': every route
+    from its schedule, the disruptions every interval seconds) or like cron (strategy 'interval': everything
+    every interval seconds). settings come from get_replay_settings; max_time_past and max_time_future replace
+    MAX_TIME_PAST and MAX_TIME_FUTURE during the replay. answers (a dict) keeps the trips parsed from source, pass
+    the same one to the replays of other strategies over source. Returns the report: calls to the NS API per
+    endpoint, notifications, and the latency of the notifications of delayed trains and disruptions
+    """
+    original = ns_notifications.MAX_TIME_PAST, ns_notifications.MAX_TIME_FUTURE
+    if max_time_past is not None:
+        ns_notifications.MAX_TIME_PAST = max_time_past
+    if max_time_future is not None:
+        ns_notifications.MAX_TIME_FUTURE = max_time_future
+    try:
+        return run_replay(settings, source, start, end, strategy, interval, {} if answers is None else answers)
+    finally:
+        ns_notifications.MAX_TIME_PAST, ns_notifications.MAX_TIME_FUTURE = original
+
+
+def run_replay(settings, source, start, end, strategy, interval, answers):
+    logger = logging.getLogger('ns_notifications')
+    clock = Clock(start)
+    mc = LRUStore(clock=clock.time)
+    # Identical queries within a run are still asked once, later runs always ask again (counted as calls, even
+    # when their answer was parsed before)
+    nsapi = ns_notifications.TripsCache(ReplayNSAPI(source, clock, answers), ttl=0)
+    sink = ReplaySink(clock)
+    dispatcher = dispatch.Dispatcher(
+        [sink], mc, settings.getint('Notifications', 'dedup_window', fallback=dispatch.DEDUP_WINDOW),
+        coalesce_delay=0, rate_limit=0)
+
+    user_routes = ns_notifications.get_valid_user_routes(settings, mc, nsapi, logger)
+    relevance = None
+
+    runs = 0
+    schedule = None
+    next_disruptions_run = start
+    next_interval_run = start
+    try:
+        while clock.now() < end:
+            current_time = clock.now()
+            if strategy == 'schedule':
+                if schedule is None or schedule.day != current_time.date():
+                    schedule = ns_notifications.RouteSchedule(user_routes, current_time.date())
+                due_routes = schedule.get_due_routes(current_time)
+            elif current_time >= next_interval_run:
+                next_interval_run = current_time + datetime.timedelta(seconds=interval)
+                due_routes = user_routes
+            else:
+                due_routes = {}
+            check_disruptions = current_time >= next_disruptions_run
+            if check_disruptions:
+                next_disruptions_run = current_time + datetime.timedelta(seconds=interval)
+                if settings.getboolean('Routes', 'relevant_disruptions_only', fallback=True):
+                    # Like the daemon, with the stops and transfers learned from the trips since
+                    relevance = ns_notifications.get_relevance_index(mc, nsapi, user_routes, logger)
+            if due_routes or check_disruptions:
+                ns_notifications.run_notifications(settings, mc, nsapi, logger, due_routes, check_disruptions,
+                                                   dispatcher, relevance, current_time=current_time,
+                                                   configured_routes=user_routes)
+                dispatcher.flush()
+                runs += 1
+
+            wakeup = min(next_disruptions_run,
+                         datetime.datetime.combine(current_time.date() + datetime.timedelta(days=1), datetime.time.min))
+            if strategy == 'schedule':
+                next_route_poll = schedule.get_next_wakeup()
+                if next_route_poll and next_route_poll < wakeup:
+                    wakeup = next_route_poll
+            else:
+                wakeup = min(wakeup, next_interval_run)
+            # Like the daemon, which sleeps at least a second
+            clock.advance(max(wakeup, current_time + datetime.timedelta(seconds=1)))
+    finally:
+        dispatcher.close()
+
+    first_delays = get_first_delays(source, user_routes, start, end, settings.arrival_delays, answers)
+    first_disruptions = get_first_disruptions(source, start, end)
+    trip_latencies = {}
+    disruption_latencies = {}
+    for moment, userkey, header in sink.sent:
+        if (userkey, header) in first_delays:
+            trip_latencies.setdefault((userkey, header), (moment - first_delays[(userkey, header)]).total_seconds())
+        elif header in first_disruptions:
+            disruption_latencies.setdefault(header, (moment - first_disruptions[header]).total_seconds())
+
+    report = collections.OrderedDict()
+    report['runs'] = runs
+    report['api_calls'] = dict(nsapi.nsapi.calls)
+    report['notifications'] = len(sink.sent)
+    report['delays'] = len(first_delays)
+    report['delays_notified'] = len(trip_latencies)
+    report['disruptions'] = len(first_disruptions)
+    report['disruptions_notified'] = len(disruption_latencies)
+    for name, latencies in (('delay', trip_latencies), ('disruption', disruption_latencies)):
+        if latencies:
+            report[name + '_latency_p50'] = get_percentile(latencies.values(), 50)
+            report[name + '_latency_p90'] = get_percentile(latencies.values(), 90)
+            report[name + '_latency_max'] = max(latencies.values())
+    return report
+
+
+def format_reports(reports):
+    """
+    Lines of a table of reports (dict of name: report), a column per report
+    """
+    names = list(reports)
+    rows = []
+    for report in reports.values():
+        rows.extend(key for key in report if key not in rows)
+    lines = ['{0:<24}'.format('') + ''.join('{0:>16}'.format(name) for name in names)]
+    for row in rows:
+        values = []
+        for name in names:
+            value = reports[name].get(row, '-')
+            if isinstance(value, dict):
+                value = sum(value.values())
+            elif isinstance(value, float):
+                value = '{0:.1f}s'.format(value)
+            values.append('{0:>16}'.format(value))
+        lines.append('{0:<24}'.format(row) + ''.join(values))
+    return lines
@@ -1,37 +1,102 @@
+import collections
+import json
 import logging
-from pymemcache.client import Client as MemcacheClient
+import logs
+import metrics
+import os
+import queue
+import sys
+import threading
+import time
 from flask import Flask
-from flask import jsonify
 from flask import request
-from werkzeug.debug import get_current_traceback
+from flask import Response
 from ns_notifications import *
 
 app = Flask(__name__)
 
-# create logger
-logger = logging.getLogger('nsapi_server')
-logger.setLevel(logging.DEBUG)
-# create file handler which logs even debug messages
-fh = logging.FileHandler('nsapi_server.log')
-fh.setLevel(logging.DEBUG)
-# create console handler with a higher log level
-ch = logging.StreamHandler()
-ch.setLevel(logging.ERROR)
-# create formatter and add it to the handlers
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
-# add the handlers to the logger
-logger.addHandler(fh)
-logger.addHandler(ch)
-
-# Connect to the Memcache daemon
-mc = MemcacheClient(('127.0.0.1', 11211), serializer=json_serializer,
-        deserializer=json_deserializer)
+# Open the state store (memcache, unless configured otherwise)
+settings = get_config(sys.path[0])
+mc = get_state_store(settings)
 
-@app.route('/')
-def nsapi_status():
-    logger.info('[%s][status] nsapi_run: %s', request.remote_addr, mc.get('nsapi_run'))
+# create logger, writing in the background so requests never wait for the log file; errors also go to the console.
+# Unless server_log_path is set, the log is written next to config.ini, whatever the working directory
+logger = logs.setup_logging('nsapi_server',
+                            settings['General'].get('server_log_path', os.path.join(sys.path[0], 'nsapi_server.log')),
+                            console_level=logging.ERROR,
+                            max_bytes=settings['General'].getint('log_max_bytes', fallback=logs.MAX_BYTES),
+                            backup_count=settings['General'].getint('log_backups', fallback=logs.BACKUP_COUNT),
+                            rate_limit=settings['General'].getint('log_rate_limit', fallback=logs.RATE_LIMIT))
+
+# The metrics of the notifier itself are read from metrics_textfile, keep the names of these apart
+metrics.REGISTRY.prefix = 'ns_notifications_server_'
+
+# Rendered pages per (page, userkey), with the ETag of the state they were rendered from. Only the pages of
+# configured users are kept, at most RENDERED_PAGES_MAX of them (the least recently used are dropped)
+RENDERED_PAGES_MAX = 256
+rendered_pages = collections.OrderedDict()
+rendered_pages_lock = threading.Lock()
+
+
+def get_state_etag(userkey):
+    """
+    ETag of the state shown for userkey, built from the versions the notifier stores next to it
+    """
+    keys = ['nsapi_run', 'nsapi_stale_version', 'prev_disruptions_version']
+    keys.extend(key + '_version' for key in get_trips_keys(mc, userkey))
+    versions = mc.get_many(keys)
+    return get_state_version([versions.get(key) for key in keys])
+
+
+def cached_page(page, userkey, render, mimetype):
+    """
+    Respond with the page rendered by render(userkey), re-rendering only when the state changed.
+    Clients that already have the current version get a 304
+    """
+    etag = get_state_etag(userkey)
+    if request.if_none_match.contains(etag):
+        metrics.inc('cache_lookups_total', cache=page, result='not_modified')
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    with rendered_pages_lock:
+        cached = rendered_pages.get((page, userkey))
+        if cached:
+            rendered_pages.move_to_end((page, userkey))
+    if cached and cached[0] == etag:
+        metrics.inc('cache_lookups_total', cache=page, result='hit')
+        body = cached[1]
+    else:
+        metrics.inc('cache_lookups_total', cache=page, result='miss')
+        with metrics.timer('stage_seconds', stage='render_' + page):
+            body = render(userkey)
+        # Any userkey can be asked for, don't let unknown ones fill the memory
+        if userkey in get_users(settings):
+            with rendered_pages_lock:
+                rendered_pages[(page, userkey)] = (etag, body)
+                rendered_pages.move_to_end((page, userkey))
+                while len(rendered_pages) > RENDERED_PAGES_MAX:
+                    rendered_pages.popitem(last=False)
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+
+def get_status(userkey):
+    """
+    Current state for userkey as dictionary, with formatted disruptions and delays
+    """
+    status = {'nsapi_run': mc.get('nsapi_run'), 'stale': mc.get('nsapi_stale'), 'disruptions': [], 'delays': []}
+    prev_disruptions = mc.get('prev_disruptions')
+    if prev_disruptions:
+        for disruption in load_objects(prev_disruptions['unplanned']):
+            status['disruptions'].append(format_disruption(disruption))
+    for delay in get_user_trips(mc, userkey) or []:
+        status['delays'].append(format_trip(delay))
+    return status
+
+
+def render_status(userkey):
     result = []
     result.append('<html><head><title>NS Storingen</title></head><body>')
     result.append('<h2>NS api status</h2>')
@@ -40,10 +105,14 @@ def nsapi_status():
         result.append("nsapi_run: %s" % mc['nsapi_run'])
     except KeyError:
         result.append("nsapi_run not found")
+    stale = mc.get('nsapi_stale')
+    if stale:
+        result.append('<p>The NS API can not be reached since %s, the last known trips of %s are shown</p>' %
+                      (stale['since'], ', '.join(stale['routes'])))
     result.append('<h2>Disruptions</h2>')
     try:
         prev_disruptions = mc.get('prev_disruptions')
-        disruptions = ns_api.list_from_json(prev_disruptions['unplanned'])
+        disruptions = load_objects(prev_disruptions['unplanned'])
         for disruption in disruptions:
             message = format_disruption(disruption)
             logger.debug(message)
@@ -56,14 +125,11 @@ def nsapi_status():
                 result.append('<pre>Nothing to see here</pre>')
     except TypeError:
         result.append('No disruptions found')
-        track = get_current_traceback(skip=1, show_hidden_frames=True,
-                                      ignore_system_exceptions=False)
-        track.log()
+        logger.exception('Exception rendering the disruptions')
         #abort(500)
     result.append('<h2>Delays</h2>')
     try:
-        prev_delays = mc.get('1_trips')
-        delays = ns_api.list_from_json(prev_delays)
+        delays = get_user_trips(mc, userkey)
         for delay in delays:
             message = format_trip(delay)
             if not message['message']:
@@ -72,13 +138,190 @@ def nsapi_status():
             result.append('<pre>' + message['message'] + '</pre>')
     except TypeError:
         result.append('No trips found')
-        track = get_current_traceback(skip=1, show_hidden_frames=True,
-                                      ignore_system_exceptions=False)
-        track.log()
+        logger.exception('Exception rendering the trips')
         #abort(500)
     result.append('</body></html>')
     return u'\n'.join(result)
 
+
+@app.route('/')
+@app.route('/user/<userkey>')
+def nsapi_status(userkey='1'):
+    logger.info('[%s][status][user: %s]', request.remote_addr, userkey)
+    return cached_page('status', userkey, render_status, 'text/html')
+
+
+@app.route('/api/status')
+@app.route('/api/status/<userkey>')
+def nsapi_status_json(userkey='1'):
+    return cached_page('api_status', userkey, lambda key: json.dumps(get_status(key)), 'application/json')
+
+# Memcache is checked for new events once per EVENTS_POLL_INTERVAL seconds, whatever the number of clients
+EVENTS_POLL_INTERVAL = 1
+# Idle event streams get a comment every EVENTS_KEEPALIVE seconds to keep proxies from closing them
+EVENTS_KEEPALIVE = 15
+# Every open stream holds a thread of the web server (unless it runs an async worker), more clients get a 503,
+# override with events_max_clients in [General]
+EVENTS_MAX_CLIENTS = 20
+
+
+class EventQueue(queue.Queue):
+    """
+    Events for one /events client. overflowed is set when the client fell EVENTS_KEEP events behind
+    """
+    overflowed = False
+
+
+class EventBroker(object):
+    """
+    Fans out the change events that the notifier publishes to all connected /events clients,
+    from a single thread polling memcache
+    """
+
+    def __init__(self, mc, poll_interval=EVENTS_POLL_INTERVAL, max_clients=EVENTS_MAX_CLIENTS):
+        self.mc = mc
+        self.poll_interval = poll_interval
+        self.max_clients = max_clients
+        self.last_id = None
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self):
+        """
+        Get a queue on which new events will be put, None when max_clients are connected already
+        """
+        subscriber = EventQueue(maxsize=EVENTS_KEEP)
+        with self.lock:
+            if len(self.subscribers) >= self.max_clients:
+                return None
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.last_id = get_event_seq(self.mc)
+                self.thread = threading.Thread(target=self.run, name='event-broker')
+                self.thread.daemon = True
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def poll(self):
+        """
+        Put the events published since the last poll on the queues of all subscribers
+        """
+        events = get_events(self.mc, self.last_id)
+        for event in events:
+            self.last_id = event['id']
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                try:
+                    subscriber.put_nowait(event)
+                except queue.Full:
+                    # Client is not reading: its stream is closed after the queued events, it reconnects with Last-Event-ID
+                    subscriber.overflowed = True
+                    self.unsubscribe(subscriber)
+        return events
+
+    def run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Exception polling for events')
+
+
+event_broker = EventBroker(mc, max_clients=settings['General'].getint('events_max_clients',
+                                                                    fallback=EVENTS_MAX_CLIENTS))
+
+
+def format_event(event):
+    """
+    Format an event as Server-Sent Event
+    """
+    return 'id: {0}\nevent: {1}\ndata: {2}\n\n'.format(event['id'], event['type'], json.dumps(event))
+
+
+def parse_event_id(value):
+    """
+    The event id in a Last-Event-ID header (or ?after=), None when missing or malformed
+    """
+    try:
+        event_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return event_id if event_id >= 0 else None
+
+
+@app.route('/events')
+def events():
+    """
+    Stream of disruption and trip changes as Server-Sent Events. ?user=<userkey> limits the trip changes to one user,
+    the Last-Event-ID header (or ?after=<id>) replays the events that were missed
+    """
+    userkey = request.args.get('user')
+    last_event_header = request.headers.get('Last-Event-ID', request.args.get('after'))
+    last_event_id = parse_event_id(last_event_header)
+    if last_event_header is not None and last_event_id is None:
+        logger.warning('[%s][events][user: %s] malformed last event %r, sending live events only', request.remote_addr,
+                       userkey, last_event_header)
+    subscriber = event_broker.subscribe()
+    if subscriber is None:
+        logger.warning('[%s][events][user: %s] refused, %s clients connected', request.remote_addr, userkey,
+                       event_broker.max_clients)
+        return Response('Too many event streams, try again later', status=503,
+                        headers={'Retry-After': str(EVENTS_KEEPALIVE)})
+    logger.info('[%s][events][user: %s] connected, last event %s', request.remote_addr, userkey, last_event_id)
+
+    # The request is gone once the stream runs
+    remote_addr = request.remote_addr
+
+    def stream():
+        sent_id = 0
+        pending = []
+        if last_event_id is not None:
+            pending = get_events(mc, last_event_id)
+        while True:
+            for event in pending:
+                if event['id'] <= sent_id or (userkey and event['userkey'] not in (None, userkey)):
+                    continue
+                sent_id = event['id']
+                yield format_event(event)
+            if subscriber.overflowed and subscriber.empty():
+                logger.info('[%s][events][user: %s] closed, %s events behind', remote_addr, userkey, EVENTS_KEEP)
+                return
+            try:
+                pending = [subscriber.get(timeout=EVENTS_KEEPALIVE)]
+            except queue.Empty:
+                pending = []
+                yield ': keepalive\n\n'
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also when the client went away before the stream started
+    response.call_on_close(lambda: event_broker.unsubscribe(subscriber))
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    Metrics of the last run of the notifier (when metrics_textfile is set) and of this server, for Prometheus
+    """
+    body = metrics.REGISTRY.render()
+    path = settings['General'].get('metrics_textfile', '')
+    if path:
+        try:
+            with open(path) as textfile:
+                body = textfile.read() + body
+        except IOError:
+            logger.warning('No metrics of the notifier in ' + path + ' (yet)')
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/disable/<location>')
 def disable_notifier(location=None):
     location_prefix = '[{0}][location: {1}]'.format(request.remote_addr, location)
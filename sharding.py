@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting the routes over several notifier nodes that share one state store: every node polls the routes that
+map to it on a consistent hash ring of the living nodes, and one of them (the holder of a lease) also checks
+the disruptions. Nodes keep a heartbeat key alive in the store; when a node stops, its key expires and its
+routes move to the others
+"""
+import bisect
+import collections
+import hashlib
+import json
+import time
+
+import metrics
+
+# Seconds a heartbeat and a lease stay valid without being renewed; longer than the time between two runs
+LEASE_TTL = 600
+# Points per node on the hash ring, more points spread the routes more evenly
+REPLICAS = 100
+
+NODES_KEY = 'shard_nodes'
+NODES_LOCK_KEY = 'shard_nodes_lock'
+# Seconds the lock on the list of nodes is held at most, and attempts to get it
+NODES_LOCK_TTL = 5
+NODES_LOCK_ATTEMPTS = 20
+
+
+def get_heartbeat_key(node_id):
+    return 'shard_node_' + node_id
+
+
+def get_live_nodes(mc):
+    """
+    The nodes in the list of nodes of mc with a heartbeat that did not expire
+    """
+    nodes = mc.get(NODES_KEY) or []
+    alive = mc.get_many([get_heartbeat_key(node_id) for node_id in nodes])
+    return sorted(node_id for node_id in nodes if get_heartbeat_key(node_id) in alive)
+
+
+def get_hash(key):
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring: a key belongs to the first node point after its hash. Adding or removing a node only
+    moves the keys of that node
+    """
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.nodes = sorted(nodes)
+        self.points = sorted((get_hash(node + '-' + str(replica)), node)
+                             for node in self.nodes for replica in range(replicas))
+        self.hashes = [point for point, node in self.points]
+
+    def get_node(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.hashes, get_hash(key)) % len(self.points)
+        return self.points[index][1]
+
+
+class Shard(object):
+    """
+    This node (node_id) of the nodes sharing the state store mc
+    """
+
+    def __init__(self, mc, node_id, lease_ttl=LEASE_TTL, replicas=REPLICAS):
+        self.mc = mc
+        self.node_id = node_id
+        self.lease_ttl = lease_ttl
+        self.replicas = replicas
+        self.ring = None
+
+    def heartbeat(self):
+        """
+        Tell the other nodes this one is alive, joining the list of nodes when needed. Returns the living nodes
+        """
+        self.mc.set(get_heartbeat_key(self.node_id), str(time.time()), self.lease_ttl)
+        if self.node_id not in (self.mc.get(NODES_KEY) or []):
+            self._join()
+        # Even when joining failed (the lock was taken all the time), this node is alive
+        nodes = sorted(set(self.get_nodes()) | {self.node_id})
+        if self.ring is None or self.ring.nodes != nodes:
+            self.ring = HashRing(nodes, self.replicas)
+        return nodes
+
+    def _join(self):
+        """
+        Add this node to the list of nodes (dropping the ones without heartbeat), under a lock so nodes starting
+        at the same moment don't overwrite each other
+        """
+        for _ in range(NODES_LOCK_ATTEMPTS):
+            if self.mc.add(NODES_LOCK_KEY, self.node_id, NODES_LOCK_TTL):
+                try:
+                    nodes = set(self.get_nodes())
+                    nodes.add(self.node_id)
+                    self.mc.set(NODES_KEY, sorted(nodes), 0)
+                finally:
+                    self.mc.delete(NODES_LOCK_KEY)
+                return True
+            time.sleep(NODES_LOCK_TTL / float(NODES_LOCK_ATTEMPTS))
+        return False
+
+    def get_nodes(self):
+        """
+        The nodes with a heartbeat that did not expire
+        """
+        return get_live_nodes(self.mc)
+
+    def owns(self, key):
+        """
+        Whether key (a string) belongs to this node, judging from the living nodes at the last heartbeat
+        """
+        if self.ring is None or not self.ring.nodes:
+            return True
+        return self.ring.get_node(key) == self.node_id
+
+    def filter_routes(self, user_routes, get_route_key):
+        """
+        The routes of user_routes (dict of userkey: routes) this node polls. Routes are split by their query
+        (get_route_key), so a route shared by several users is still polled by one node only
+        """
+        owners = {}
+        owned = collections.OrderedDict()
+        for userkey, routes in user_routes.items():
+            owned[userkey] = []
+            for route in routes:
+                route_key = json.dumps(get_route_key(route))
+                if route_key not in owners:
+                    owners[route_key] = self.owns(route_key)
+                if owners[route_key]:
+                    owned[userkey].append(route)
+        return owned
+
+    def acquire_lease(self, name):
+        """
+        Hold (or renew) the lease name for lease_ttl seconds. Returns whether this node holds it.
+        The state stores have no compare-and-set, so renewing is a get and a set: last writer wins. Only when the
+        lease expires between the two (it is renewed every run, well within lease_ttl) can another node take it
+        and be overwritten, and both check the disruptions in that run; the deduplication of the dispatcher,
+        in the same store, still sends each notification once
+        """
+        key = 'shard_lease_' + name
+        holder = self.mc.get(key)
+        if holder == self.node_id:
+            self.mc.set(key, self.node_id, self.lease_ttl)
+            return True
+        if holder is None and self.mc.add(key, self.node_id, self.lease_ttl):
+            metrics.inc('shard_leases_total', lease=name)
+            return True
+        return False
+
+    def release_lease(self, name):
+        key = 'shard_lease_' + name
+        if self.mc.get(key) == self.node_id:
+            self.mc.delete(key)
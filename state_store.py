@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Storage of the notifier state (previous disruptions and trips, nsapi_run, versions, events)
+"""
+import collections
+import contextlib
+import sqlite3
+import threading
+import time
+
+import metrics
+
+
+class StateStore(object):
+    """
+    Key/value store with expiring keys, in the style of a memcache client. Within a batch() block, writes are
+    collected and written at once at the end of the block (for SQLite: in a single transaction)
+    """
+
+    # Name of the backend in the metrics
+    backend = None
+
+    def __init__(self):
+        self._batch = None
+
+    def _read_many(self, keys):
+        raise NotImplementedError
+
+    def _write_many(self, items):
+        """
+        Write items, a dict of key: (value, expire)
+        """
+        raise NotImplementedError
+
+    def add(self, key, value, expire=0):
+        raise NotImplementedError
+
+    def incr(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Collect all writes in this block and write them when the block ends
+        """
+        if self._batch is not None:
+            # Already batching, the outer block writes
+            yield
+            return
+        self._batch = collections.OrderedDict()
+        try:
+            yield
+            if self._batch:
+                with metrics.timer('state_seconds', backend=self.backend, operation='write'):
+                    self._write_many(self._batch)
+        finally:
+            self._batch = None
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        result = {}
+        missing = []
+        for key in keys:
+            if self._batch is not None and key in self._batch:
+                result[key] = self._batch[key][0]
+            else:
+                missing.append(key)
+        if missing:
+            with metrics.timer('state_seconds', backend=self.backend, operation='read'):
+                result.update(self._read_many(missing))
+        return result
+
+    def set(self, key, value, expire=0):
+        return self.set_many({key: value}, expire)
+
+    def set_many(self, values, expire=0):
+        items = collections.OrderedDict((key, (value, expire)) for key, value in values.items())
+        if self._batch is not None:
+            self._batch.update(items)
+        else:
+            with metrics.timer('state_seconds', backend=self.backend, operation='write'):
+                self._write_many(items)
+        return []
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+class MemcacheStore(StateStore):
+    """
+    State in memcached. Keys can be evicted by memcached before they expire. The client of pymemcache is not
+    thread-safe: the background threads (the dispatcher of the notifications) share it under a lock
+    """
+    backend = 'memcache'
+
+    def __init__(self, server, serializer, deserializer):
+        super(MemcacheStore, self).__init__()
+        # Imported here, so the other backends don't need pymemcache
+        from pymemcache.client import Client as MemcacheClient
+        self.client = MemcacheClient(server, serializer=serializer, deserializer=deserializer)
+        self._lock = threading.Lock()
+
+    def _read_many(self, keys):
+        with self._lock:
+            return self.client.get_many(keys)
+
+    def _write_many(self, items):
+        # memcache sets one expiry per call, so group the items on it
+        per_expire = collections.OrderedDict()
+        for key, (value, expire) in items.items():
+            per_expire.setdefault(expire, {})[key] = value
+        with self._lock:
+            for expire, values in per_expire.items():
+                self.client.set_many(values, expire)
+
+    def add(self, key, value, expire=0):
+        with self._lock:
+            return self.client.add(key, value, expire, noreply=False)
+
+    def incr(self, key, value):
+        with self._lock:
+            return self.client.incr(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            return self.client.delete(key)
+
+
+class LRUStore(StateStore):
+    """
+    State in the memory of this process, only useful when the notifier keeps running (daemon mode).
+    The least recently used keys are dropped when more than maxsize keys are stored
+    """
+    backend = 'lru'
+
+    def __init__(self, maxsize=10000, clock=time.time):
+        super(LRUStore, self).__init__()
+        self.maxsize = maxsize
+        # Current time in seconds, for the expiry of keys (a simulated clock in `replay`)
+        self.clock = clock
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        # Call with the lock held
+        try:
+            value, expires = self._values[key]
+        except KeyError:
+            return None
+        if expires and expires <= now:
+            del self._values[key]
+            return None
+        self._values.move_to_end(key)
+        return value
+
+    def _put(self, key, value, expire):
+        # Call with the lock held
+        self._values[key] = (value, self.clock() + expire if expire else None)
+        self._values.move_to_end(key)
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+
+    def _read_many(self, keys):
+        now = self.clock()
+        result = {}
+        with self._lock:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    result[key] = value
+        return result
+
+    def _write_many(self, items):
+        with self._lock:
+            for key, (value, expire) in items.items():
+                self._put(key, value, expire)
+
+    def add(self, key, value, expire=0):
+        with self._lock:
+            if self._get(key, self.clock()) is not None:
+                return False
+            self._put(key, value, expire)
+            return True
+
+    def incr(self, key, value):
+        with self._lock:
+            try:
+                current, expires = self._values[key]
+            except KeyError:
+                return None
+            new_value = int(current) + value
+            self._values[key] = (str(new_value), expires)
+            return new_value
+
+    def delete(self, key):
+        with self._lock:
+            return self._values.pop(key, None) is not None
+
+
+class SQLiteStore(StateStore):
+    """
+    State in an SQLite database file (in WAL mode), so it survives restarts and is never evicted
+    """
+    backend = 'sqlite'
+
+    def __init__(self, path, serializer, deserializer):
+        super(SQLiteStore, self).__init__()
+        self.serializer = serializer
+        self.deserializer = deserializer
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state '
+                                '(key TEXT PRIMARY KEY, value BLOB, flags INTEGER, expires REAL)')
+
+    def _read_many(self, keys):
+        result = {}
+        query = 'SELECT key, value, flags FROM state WHERE key IN ({0}) AND (expires IS NULL OR expires > ?)'.format(
+            ','.join('?' * len(keys)))
+        with self._lock:
+            rows = self.connection.execute(query, list(keys) + [time.time()]).fetchall()
+        for key, value, flags in rows:
+            result[key] = self.deserializer(key, value, flags)
+        return result
+
+    def _get_row(self, key):
+        # Call with the lock held
+        return self.connection.execute('SELECT value, flags, expires FROM state WHERE key = ? '
+                                       'AND (expires IS NULL OR expires > ?)', (key, time.time())).fetchone()
+
+    def _write_rows(self, items):
+        # Call with the lock held, in a transaction
+        rows = []
+        for key, (value, expire) in items.items():
+            stored, flags = self.serializer(key, value)
+            rows.append((key, stored, flags, time.time() + expire if expire else None))
+        self.connection.executemany('INSERT OR REPLACE INTO state (key, value, flags, expires) VALUES (?, ?, ?, ?)',
+                                    rows)
+
+    def _write_many(self, items):
+        with self._lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self._write_rows(items)
+
+    def add(self, key, value, expire=0):
+        with self._lock:
+            with self.connection:
+                self.connection.execute('BEGIN IMMEDIATE')
+                if self._get_row(key):
+                    return False
+                self._write_rows({key: (value, expire)})
+                return True
+
+    def incr(self, key, value):
+        with self._lock:
+            with self.connection:
+                self.connection.execute('BEGIN IMMEDIATE')
+                row = self._get_row(key)
+                if not row:
+                    return None
+                new_value = int(self.deserializer(key, row[0], row[1])) + value
+                self.connection.execute('UPDATE state SET value = ?, flags = ? WHERE key = ?',
+                                        self.serializer(key, str(new_value)) + (key, ))
+                return new_value
+
+    def delete(self, key):
+        with self._lock:
+            with self.connection:
+                return self.connection.execute('DELETE FROM state WHERE key = ?', (key, )).rowcount > 0
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the NS stations, to resolve the station names in the configuration to station codes
+"""
+import bisect
+import difflib
+
+# Minimum similarity (0-1) of a misspelled station name to a known one
+FUZZY_CUTOFF = 0.8
+
+
+class StationIndex(object):
+    """
+    Exact lookup of a station by code, name or synonym (case insensitive) in one dict, and a sorted list of
+    those keys for prefix matches. Close matches of misspelled names are only searched when both fail
+    """
+
+    def __init__(self, stations):
+        # [[code, long name, [other names and synonyms]]], as stored in the state
+        self.stations = stations
+        self.names = {}
+        self.codes = {}
+        for code, name, aliases in stations:
+            self.names[code] = name
+            for alias in [code, name] + list(aliases):
+                self.codes.setdefault(alias.lower(), code)
+        self.keys = sorted(self.codes)
+
+    @classmethod
+    def from_stations(cls, stations):
+        """
+        Build the index from a list of ns_api.Station
+        """
+        entries = []
+        for station in stations:
+            aliases = [name for name in (station.names['short'], station.names['middle']) if name]
+            entries.append([station.code, station.names['long'], aliases + list(station.synonyms)])
+        return cls(entries)
+
+    def to_json(self):
+        return self.stations
+
+    def get_code(self, name):
+        """
+        Code of the station with exactly this code, name or synonym, None if there is none
+        """
+        return self.codes.get(name.strip().lower())
+
+    def get_name(self, code):
+        return self.names.get(code, code)
+
+    def match(self, name, limit=5):
+        """
+        Codes of at most limit stations name could mean: the exact match, otherwise the stations whose name
+        starts with name, otherwise the ones with a similar name
+        """
+        key = name.strip().lower()
+        if key in self.codes:
+            return [self.codes[key]]
+        candidates = []
+        position = bisect.bisect_left(self.keys, key)
+        while position < len(self.keys) and self.keys[position].startswith(key):
+            candidates.append(self.keys[position])
+            position += 1
+        if not candidates:
+            candidates = difflib.get_close_matches(key, self.keys, limit, FUZZY_CUTOFF)
+        codes = []
+        for candidate in candidates:
+            if self.codes[candidate] not in codes:
+                codes.append(self.codes[candidate])
+        return codes[:limit]
+
+    def resolve(self, name):
+        """
+        The code of the station meant by name, and the codes it could mean when it is ambiguous or unknown.
+        Returns (code, []) when name is clear, (None, candidate codes) otherwise
+        """
+        codes = self.match(name)
+        if len(codes) == 1:
+            return codes[0], []
+        return None, codes
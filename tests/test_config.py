@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Routes of config.ini, as the NS API gets them, and loading it in daemon mode
+"""
+import logging
+
+import ns_api
+import pytest
+
+import benchmark
+import config
+import ns_client
+import ns_notifications
+from fake_services import FakeNS
+
+
+def test_route_times_are_normalised():
+    routes = config.parse_routes("[{'departure': 'Haarlem', 'destination': 'Leiden Centraal', 'time': '7:44'}, "
+                                 "{'departure': 'Haarlem', 'destination': 'Leiden Centraal', 'time': '4-1-2020 7:05'}]",
+                                 'Routes')
+    assert [route['time'] for route in routes] == ['07:44', '04-01-2020 07:05']
+    assert [route['parsed_time'] for route in routes] == [[7, 44], [2020, 1, 4, 7, 5]]
+
+
+def test_trips_of_a_route_without_leading_zero():
+    route = config.parse_routes("[{'departure': 'Haarlem', 'destination': 'Leiden Centraal', 'time': '7:44'}]",
+                                'Routes')[0]
+    fake_ns = FakeNS(['Haarlem', 'Leiden Centraal', 'Utrecht Centraal']).start()
+    try:
+        nsapi = ns_client.NotifierNSAPI('test', base_url=fake_ns.url)
+        trips = ns_notifications.fetch_route_trips(nsapi, route)
+    finally:
+        fake_ns.stop()
+    assert ns_api.Trip.get_actual(trips, route['time']) is trips[1]
+
+
+class StopDaemon(Exception):
+    pass
+
+
+def test_daemon_runs_when_the_first_reload_fails(tmp_path, monkeypatch):
+    fake_ns = FakeNS(benchmark.STATIONS).start()
+    try:
+        benchmark.write_harness_config(str(tmp_path), fake_ns.url, fake_ns.url, 2, 1)
+        # The configuration changes on disk between the start of the daemon and its first loop, to an invalid one
+        mtimes = iter(range(10))
+        monkeypatch.setattr(ns_notifications, 'get_config_mtime', lambda config_dir: next(mtimes))
+        load_settings = config.load_settings
+        loads = []
+
+        def get_config(config_dir):
+            loads.append(config_dir)
+            if len(loads) > 1:
+                raise config.ConfigError('invalid')
+            return load_settings(config_dir)
+
+        runs = []
+
+        def sleep(seconds):
+            raise StopDaemon()
+
+        monkeypatch.setattr(ns_notifications, 'get_config', get_config)
+        monkeypatch.setattr(ns_notifications, 'get_logger', lambda settings: logging.getLogger('ns_notifications'))
+        monkeypatch.setattr(ns_notifications, 'refresh_versions', lambda mc, url: None)
+        monkeypatch.setattr(ns_notifications, 'run_notifications', lambda *args, **kwargs: runs.append(args))
+        monkeypatch.setattr(ns_notifications.time, 'sleep', sleep)
+        with pytest.raises(StopDaemon):
+            ns_notifications.daemon.callback(str(tmp_path), 60)
+    finally:
+        fake_ns.stop()
+    assert len(loads) == 2
+    assert len(runs) == 1
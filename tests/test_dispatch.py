@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Deduplication of the notifications by the dispatcher: only what was delivered counts as sent
+"""
+import threading
+import time
+
+import dispatch
+from state_store import LRUStore, MemcacheStore
+
+
+class RecordingSink(dispatch.Sink):
+    """
+    Sink remembering what it sent, failing while failing is set
+    """
+
+    name = 'recording'
+
+    def __init__(self):
+        self.sent = []
+        self.failing = False
+
+    def send(self, userkey, header, message):
+        if self.failing:
+            raise IOError('sink is down')
+        self.sent.append((userkey, header, message))
+
+
+def get_dispatcher(sink, coalesce_delay=0):
+    return dispatch.Dispatcher([sink], LRUStore(), coalesce_delay=coalesce_delay, rate_limit=0)
+
+
+def test_sent_notifications_are_not_sent_again():
+    sink = RecordingSink()
+    dispatcher = get_dispatcher(sink)
+    assert dispatcher.submit('1', 'trip|IC 3000', 'IC 3000', '+5')
+    assert dispatcher.flush(5)
+    assert not dispatcher.submit('1', 'trip|IC 3000', 'IC 3000', '+5')
+    dispatcher.close(5)
+    assert sink.sent == [('1', 'IC 3000', '+5')]
+
+
+def test_failed_notifications_are_sent_again():
+    sink = RecordingSink()
+    sink.failing = True
+    dispatcher = get_dispatcher(sink)
+    dispatcher.submit('1', 'trip|IC 3000', 'IC 3000', '+5')
+    assert dispatcher.flush(5)
+
+    sink.failing = False
+    assert dispatcher.submit('1', 'trip|IC 3000', 'IC 3000', '+5')
+    dispatcher.close(5)
+    assert sink.sent == [('1', 'IC 3000', '+5')]
+
+
+def test_replaced_notifications_can_be_sent_later():
+    sink = RecordingSink()
+    dispatcher = get_dispatcher(sink, coalesce_delay=60)
+    dispatcher.submit('1', 'trip|IC 3000', 'IC 3000', '+5')
+    dispatcher.submit('1', 'trip|IC 3000', 'IC 3000', '+8')
+    assert dispatcher.flush(5)
+    # +5 was never sent, the delay going back to it is news
+    assert dispatcher.submit('1', 'trip|IC 3000', 'IC 3000', '+5')
+    dispatcher.close(5)
+    assert sink.sent == [('1', 'IC 3000', '+8'), ('1', 'IC 3000', '+5')]
+
+
+class SingleThreadedClient(object):
+    """
+    Stand-in for the pymemcache client, counting the calls made while another thread was using it
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.overlaps = 0
+        self.busy = threading.Lock()
+
+    def call(self, function):
+        if not self.busy.acquire(blocking=False):
+            self.overlaps += 1
+            self.busy.acquire()
+        try:
+            time.sleep(0.001)
+            return function()
+        finally:
+            self.busy.release()
+
+    def add(self, key, value, expire, noreply):
+        return self.call(lambda: self.values.setdefault(key, value) is value)
+
+    def delete(self, key):
+        return self.call(lambda: self.values.pop(key, None) is not None)
+
+    def get_many(self, keys):
+        return self.call(lambda: dict((key, self.values[key]) for key in keys if key in self.values))
+
+    def set_many(self, values, expire):
+        return self.call(lambda: self.values.update(values))
+
+
+def test_memcache_is_shared_with_the_dispatcher_thread():
+    mc = MemcacheStore(('127.0.0.1', 11211), None, None)
+    mc.client = SingleThreadedClient()
+    sink = RecordingSink()
+    # The dispatcher thread removes the markers of what the sink failed to send, while the notifier goes on
+    sink.failing = True
+    dispatcher = dispatch.Dispatcher([sink], mc, coalesce_delay=0, rate_limit=0)
+    for index in range(50):
+        dispatcher.submit('1', 'trip|IC ' + str(index), 'IC ' + str(index), '+5')
+        for _ in range(5):
+            mc.get('nsapi_run')
+    assert dispatcher.flush(5)
+    dispatcher.close(5)
+    assert mc.client.overlaps == 0
+    assert not [key for key in mc.client.values if key.startswith('dispatched_')]
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Diffing of the disruptions as ns_api parses them from the NS API (without timestamp)
+"""
+import json
+
+import ns_api
+
+import ns_client
+import ns_notifications
+from fake_services import FakeNS
+from planner import ViaIndex
+from relevance import RelevanceIndex
+from state_store import LRUStore
+
+
+def parse_disruptions(texts):
+    payload = [{'id': key, 'type': 'verstoring', 'titel': line, 'verstoring': text}
+               for key, (line, text) in sorted(texts.items())]
+    return ns_api.NSAPI.parse_disruptions(json.dumps({'payload': payload}))
+
+
+def get_keys(disruptions):
+    return sorted(disruption.key for disruption in disruptions)
+
+
+def test_only_new_and_changed_disruptions_are_returned():
+    mc = LRUStore()
+    texts = {'prio-1': ('Haarlem - Leiden Centraal', 'Seinstoring'),
+             'prio-2': ('Utrecht Centraal - Zwolle', 'Defecte trein')}
+    assert get_keys(ns_notifications.get_changed_disruptions(mc, parse_disruptions(texts))) == ['prio-1', 'prio-2']
+    assert ns_notifications.get_changed_disruptions(mc, parse_disruptions(texts)) == []
+
+    texts['prio-2'] = ('Utrecht Centraal - Zwolle', 'Defecte trein, er rijden weer treinen')
+    texts['prio-3'] = ('Nijmegen - Arnhem Centraal', 'Aanrijding')
+    assert get_keys(ns_notifications.get_changed_disruptions(mc, parse_disruptions(texts))) == ['prio-2', 'prio-3']
+
+    del texts['prio-1']
+    assert ns_notifications.get_changed_disruptions(mc, parse_disruptions(texts)) == []
+    stored = ns_notifications.load_objects(mc.get('prev_disruptions')['unplanned'])
+    assert get_keys(stored) == ['prio-2', 'prio-3']
+
+
+def test_keywords_are_filtered_out():
+    mc = LRUStore()
+    texts = {'prio-1': ('Haarlem - Leiden Centraal', 'Seinstoring'),
+             'prio-2': ('Utrecht Centraal - Zwolle', 'Defecte trein')}
+    changed = ns_notifications.get_changed_disruptions(mc, parse_disruptions(texts), ['Seinstoring'])
+    assert get_keys(changed) == ['prio-2']
+
+
+def test_hash_ignores_other_attributes():
+    disruption = parse_disruptions({'prio-1': ('Haarlem - Leiden Centraal', 'Seinstoring')})['unplanned'][0]
+    disruption_hash = ns_notifications.get_disruption_hash(disruption)
+    disruption.extra = 'not shown'
+    assert ns_notifications.get_disruption_hash(disruption) == disruption_hash
+    disruption.disruption = 'Seinstoring verholpen'
+    assert ns_notifications.get_disruption_hash(disruption) != disruption_hash
+
+
+def test_disruptions_on_the_stops_of_a_route_are_relevant():
+    route = {'departure': 'Amsterdam Centraal', 'destination': 'Zwolle', 'time': '07:44'}
+    fake_ns = FakeNS(['Amsterdam Centraal', 'Utrecht Centraal', 'Zwolle']).start()
+    try:
+        nsapi = ns_client.NotifierNSAPI('test', base_url=fake_ns.url)
+        trips = ns_notifications.fetch_route_trips(nsapi, route)
+    finally:
+        fake_ns.stop()
+    via_index = ViaIndex()
+    assert via_index.learn(route['departure'], route['destination'], trips)
+    relevance = RelevanceIndex.build({'1': [route]}, ns_notifications.get_route_name, via_index=via_index)
+
+    # The trains stop at Tussenstation on the way, which is not in the route
+    disruptions = parse_disruptions({'prio-1': ('Tussenstation - Den Helder', 'Seinstoring'),
+                                     'prio-2': ('Nijmegen - Arnhem Centraal', 'Aanrijding')})['unplanned']
+    assert [relevance.match(disruption) for disruption in disruptions] == [
+        {'1': [ns_notifications.get_route_name(route)]}, {}]
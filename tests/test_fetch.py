@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent fetching of the trips of the routes, against the NS stand-in of fake_services
+"""
+import collections
+import json
+import time
+from urllib.parse import parse_qs
+
+import ns_api
+import pytest
+
+import ns_client
+import ns_notifications
+from fake_services import FakeNS
+from state_store import LRUStore
+
+STATIONS = ['Amsterdam Centraal', 'Haarlem', 'Leiden Centraal', 'Utrecht Centraal', 'Zwolle', 'Nijmegen']
+# Seconds the stand-in takes to answer for a departure station
+LATENCIES = {'Amsterdam Centraal': 0.6, 'Haarlem': 0.2, 'Leiden Centraal': 0.2, 'Utrecht Centraal': 0.2,
+             'Zwolle': 0.2}
+
+
+class SlowFakeNS(FakeNS):
+    """
+    FakeNS taking LATENCIES seconds to answer the trips from a station
+    """
+
+    def make_trips(self, departure, destination, via, requested):
+        time.sleep(LATENCIES.get(self.get_name(departure), 0))
+        return super(SlowFakeNS, self).make_trips(departure, destination, via, requested)
+
+
+@pytest.fixture
+def nsapi():
+    fake_ns = SlowFakeNS(STATIONS).start()
+    try:
+        yield ns_client.NotifierNSAPI('test', base_url=fake_ns.url)
+    finally:
+        fake_ns.stop()
+
+
+def get_routes():
+    return [{'departure': departure, 'destination': 'Nijmegen', 'time': '07:44'} for departure in LATENCIES]
+
+
+def test_fetch_takes_as_long_as_the_slowest_route(nsapi):
+    started = time.perf_counter()
+    results = ns_notifications.fetch_all_route_trips(nsapi, get_routes(), max_workers=len(LATENCIES))
+    elapsed = time.perf_counter() - started
+
+    assert [len(trips) for trips in results] == [3] * len(LATENCIES)
+    assert elapsed >= max(LATENCIES.values())
+    # One after the other this takes the sum of the latencies (1.4 s)
+    assert elapsed < max(LATENCIES.values()) + 0.4
+
+
+def test_fetch_keeps_the_order_of_the_routes(nsapi):
+    routes = get_routes()
+    results = ns_notifications.fetch_all_route_trips(nsapi, routes, max_workers=2)
+    assert [trips[1].departure for trips in results] == [route['departure'] for route in routes]
+
+
+def test_one_worker_fetches_one_route_at_a_time(nsapi):
+    started = time.perf_counter()
+    ns_notifications.fetch_all_route_trips(nsapi, get_routes(), max_workers=1)
+    assert time.perf_counter() - started >= sum(LATENCIES.values())
+
+
+class BrokenFakeNS(FakeNS):
+    """
+    FakeNS of which the answers for the trips from the stations in answers can't be used
+    """
+
+    def __init__(self, stations, **kwargs):
+        super(BrokenFakeNS, self).__init__(stations, **kwargs)
+        # Departure station: answer for its trips
+        self.answers = {}
+
+    def respond(self, method, url, body):
+        departure = self.get_name(parse_qs(url.query).get('fromStation', [''])[0])
+        if departure in self.answers:
+            return 200, self.answers[departure]
+        return super(BrokenFakeNS, self).respond(method, url, body)
+
+
+def test_unusable_answers_only_fail_their_route():
+    fake_ns = BrokenFakeNS(STATIONS).start()
+    try:
+        nsapi = ns_client.NotifierNSAPI('test', base_url=fake_ns.url)
+        routes = get_routes()
+        unique_routes = collections.OrderedDict((ns_notifications.get_route_key(route), route) for route in routes)
+        mc = LRUStore()
+        ns_notifications.serve_stale_trips(
+            mc, unique_routes, ns_notifications.fetch_all_route_trips(nsapi, routes, 2, return_errors=True))
+
+        fake_ns.answers = {'Haarlem': '<html>Bad gateway</html>', 'Zwolle': ''}
+        results = ns_notifications.fetch_all_route_trips(nsapi, routes, 2, return_errors=True)
+    finally:
+        fake_ns.stop()
+    assert [type(result) for result in results if isinstance(result, Exception)] == [
+        json.JSONDecodeError, ns_api.NoDataReceivedError]
+
+    stale = {}
+    trips_per_query = ns_notifications.serve_stale_trips(mc, unique_routes, results, stale)
+    # The last known trips of the broken routes, the current ones of the others
+    assert [len(trips) for trips in trips_per_query.values()] == [3] * len(routes)
+    assert sorted(stale.values()) == ['Haarlem - Nijmegen 07:44', 'Zwolle - Nijmegen 07:44']
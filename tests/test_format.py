@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Messages and openHAB items made of the trips the installed ns_api parses
+"""
+import pytest
+
+import ns_client
+import ns_notifications
+from fake_services import FakeNS
+
+STATIONS = ['Amsterdam Centraal', 'Haarlem', 'Utrecht Centraal']
+
+
+@pytest.fixture(scope='module')
+def trips():
+    fake_ns = FakeNS(STATIONS, 0).start()
+    try:
+        nsapi = ns_client.NotifierNSAPI('test', base_url=fake_ns.url)
+        return nsapi.get_trips('07:44', 'Amsterdam Centraal', None, 'Utrecht Centraal', True)
+    finally:
+        fake_ns.stop()
+
+
+def test_trips_are_formatted(trips):
+    for trip in trips:
+        message = ns_notifications.format_trip(trip)
+        assert message['header'].endswith('Amsterdam Centraal-Utrecht Centraal (07:44)')
+        assert message['message'].endswith('(ns-notifier)')
+
+
+def test_train_items_show_the_status(trips):
+    for trip in trips:
+        status = ns_notifications.get_trip_status(trip)
+        assert status in ('NORMAL', 'DISRUPTION')
+        item = ns_notifications.format_train_item(trip)
+        assert item.startswith((u'🟢 IC ' if status == 'NORMAL' else u'🔴 IC '))
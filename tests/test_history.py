@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+The delay history is opened once per process, not on every run
+"""
+import configparser
+
+import ns_notifications
+
+
+def get_settings(path):
+    settings = configparser.ConfigParser()
+    settings['General'] = {'history_path': path}
+    return settings
+
+
+def test_history_is_opened_once(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    history = ns_notifications.get_history(get_settings(path))
+    # A reloaded configuration with the same history_path gets the same database
+    assert ns_notifications.get_history(get_settings(path)) is history
+    assert ns_notifications.get_history(get_settings(str(tmp_path / 'other.sqlite'))) is not history
+    assert ns_notifications.get_history(get_settings('')) is None
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Runs of the notifier against the stand-ins of the NS API and openHAB
+"""
+import logging
+
+import pytest
+
+import benchmark
+import ns_notifications
+from fake_services import FakeNS, FakeOpenHAB
+
+
+@pytest.fixture
+def services():
+    fake_ns = FakeNS(benchmark.STATIONS, 0).start()
+    fake_openhab = FakeOpenHAB().start()
+    yield fake_ns, fake_openhab
+    fake_openhab.stop()
+    fake_ns.stop()
+
+
+@pytest.fixture
+def notifier(services, tmp_path):
+    fake_ns, fake_openhab = services
+    benchmark.write_harness_config(str(tmp_path), fake_ns.url, fake_openhab.url, 4, 2)
+    settings = ns_notifications.get_config(str(tmp_path))
+    mc = ns_notifications.get_state_store(settings)
+    nsapi = ns_notifications.get_nsapi(settings)
+    logger = logging.getLogger('ns_notifications')
+    user_routes = ns_notifications.get_valid_user_routes(settings, mc, nsapi, logger)
+    return settings, mc, nsapi, logger, user_routes
+
+
+def test_delays_are_predicted_for_all_routes(notifier, monkeypatch):
+    settings, mc, nsapi, logger, user_routes = notifier
+    predicted = []
+    monkeypatch.setattr(ns_notifications, 'send_delay_predictions',
+                        lambda settings, mc, user_routes, logger, current_time=None: predicted.append(user_routes))
+    # In daemon mode only the routes that are due are polled
+    due_routes = dict((userkey, routes[:1]) for userkey, routes in user_routes.items())
+    ns_notifications.run_notifications(settings, mc, nsapi, logger, due_routes, False,
+                                       configured_routes=user_routes)
+    assert predicted == [user_routes]
+
+
+def test_openhab_output_is_shared(notifier):
+    settings = notifier[0]
+    # Item handles and the texts sent are kept between runs
+    assert ns_notifications.get_openhab_output(settings) is ns_notifications.get_openhab_output(settings)
+
+
+def with_minimum(user_routes, minimum):
+    return dict((userkey, [dict(route, minimum=minimum) for route in routes]) for userkey, routes in user_routes.items())
+
+
+def test_alternatives_respect_the_minimum_and_are_cleared(services, notifier):
+    fake_ns, fake_openhab = services
+    settings, mc, nsapi, logger, user_routes = notifier
+    items = ['U{0}_Train{1}'.format(user, item) for user in range(2) for item in range(1, 4)]
+    # Shown by check_connections
+    fake_openhab.states.update(dict((item, 'IC 07:44') for item in items))
+
+    # Every train is a few minutes late, less than the minimum of the routes: the items are left alone
+    fake_ns.generation = 1
+    ns_notifications.run_notifications(settings, mc, nsapi, logger, with_minimum(user_routes, 10), False)
+    assert [fake_openhab.states[item] for item in items] == ['IC 07:44'] * len(items)
+
+    ns_notifications.run_notifications(settings, mc, nsapi, logger, with_minimum(user_routes, 0), False)
+    assert ' IC ' in fake_openhab.states['U0_Train1']
+
+    # Only the items that showed alternatives are emptied
+    ns_notifications.run_notifications(settings, mc, nsapi, logger, with_minimum(user_routes, 10), False)
+    filled = [item for item in items if fake_openhab.states[item] != 'IC 07:44']
+    assert filled and [fake_openhab.states[item] for item in filled] == [''] * len(filled)
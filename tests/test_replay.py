@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Replay of NS API answers on the simulated clock of replay
+"""
+import datetime
+
+import benchmark
+import replay
+from fake_services import FakeNS
+
+STATIONS = ['Amsterdam Centraal', 'Haarlem', 'Utrecht Centraal', 'Nijmegen']
+
+
+def test_trips_are_asked_on_the_day_of_the_clock():
+    start = datetime.datetime(2024, 3, 5, 6, 0)
+    fake_ns = FakeNS(STATIONS)
+    try:
+        source = benchmark.GeneratedRecording(fake_ns, start, 1, 300)
+        nsapi = replay.ReplayNSAPI(source, replay.Clock(start))
+        trips = nsapi.get_trips('07:44', 'Haarlem', None, 'Nijmegen')
+    finally:
+        fake_ns.server.server_close()
+
+    assert [trip.departure_time_planned.strftime('%d-%m-%Y %H:%M') for trip in trips] == [
+        '05-03-2024 07:29', '05-03-2024 07:44', '05-03-2024 07:59']
+    assert trips[1].requested_time.date() == start.date()
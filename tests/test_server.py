@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Status pages and the event stream of server.py, with the state in memory
+"""
+import configparser
+import os
+import sys
+
+import pytest
+
+import ns_notifications
+from state_store import LRUStore
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    config_dir = str(tmp_path_factory.mktemp('config'))
+    settings = configparser.ConfigParser()
+    settings['General'] = {'userkey': '1', 'state_backend': 'lru', 'history_path': '', 'model_path': '',
+                           'server_log_path': os.path.join(config_dir, 'nsapi_server.log'), 'metrics_textfile': ''}
+    settings['Routes'] = {'routes': "[{'departure': 'Haarlem', 'destination': 'Leiden Centraal', 'time': '7:44'}]"}
+    settings['User 2'] = {'routes': '[]'}
+    with open(os.path.join(config_dir, 'config.ini'), 'w') as config_file:
+        settings.write(config_file)
+    # server.py reads config.ini from sys.path[0] when imported
+    sys.path.insert(0, config_dir)
+    try:
+        import server
+    finally:
+        sys.path.remove(config_dir)
+    return server
+
+
+@pytest.fixture
+def mc(server):
+    mc = LRUStore()
+    server.mc = mc
+    # Polled by the tests themselves
+    server.event_broker = server.EventBroker(mc, poll_interval=3600)
+    server.rendered_pages.clear()
+    return mc
+
+
+def test_status_page_is_rendered_once_per_state(server, mc):
+    client = server.app.test_client()
+    first = client.get('/user/1')
+    assert first.status_code == 200
+    assert client.get('/user/1').data == first.data
+    assert client.get('/user/1', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+    ns_notifications.set_state(mc, 'nsapi_run', True, 0)
+    assert client.get('/user/1').headers['ETag'] != first.headers['ETag']
+
+
+def test_only_pages_of_configured_users_are_kept(server, mc):
+    client = server.app.test_client()
+    for userkey in ('1', '2', 'unknown', 'other'):
+        assert client.get('/api/status/' + userkey).status_code == 200
+    assert sorted(userkey for page, userkey in server.rendered_pages) == ['1', '2']
+
+
+def test_rendered_pages_are_bounded(server, mc, monkeypatch):
+    monkeypatch.setattr(server, 'RENDERED_PAGES_MAX', 2)
+    client = server.app.test_client()
+    for path in ('/user/1', '/api/status/1', '/user/2', '/api/status/2'):
+        client.get(path)
+    assert list(server.rendered_pages) == [('status', '2'), ('api_status', '2')]
+
+
+def read_events(response, count):
+    chunks = (chunk for chunk in response.response if not chunk.startswith(b':'))
+    return [next(chunks) for _ in range(count)]
+
+
+def test_events_are_streamed(server, mc):
+    client = server.app.test_client()
+    ns_notifications.publish_event(mc, 'disruptions', [{'header': 'Traject: Haarlem - Leiden Centraal'}])
+    ns_notifications.publish_event(mc, 'trips', [{'header': 'IC Haarlem-Leiden Centraal'}], '2')
+
+    response = client.get('/events?after=0&user=1', buffered=False)
+    try:
+        assert response.mimetype == 'text/event-stream'
+        first = read_events(response, 1)[0]
+        assert first.startswith(b'id: 1\nevent: disruptions\n')
+
+        # Published while connected: put on the queue of the stream by the broker
+        ns_notifications.publish_event(mc, 'trips', [{'header': 'IC Haarlem-Leiden Centraal'}], '1')
+        assert [event['id'] for event in server.event_broker.poll()] == [3]
+        assert read_events(response, 1)[0].startswith(b'id: 3\nevent: trips\n')
+    finally:
+        response.close()
+    assert not server.event_broker.subscribers
+
+
+def test_event_streams_are_capped(server, mc, monkeypatch):
+    monkeypatch.setattr(server.event_broker, 'max_clients', 1)
+    # The test client waits for the first chunk, which is a keepalive here
+    monkeypatch.setattr(server, 'EVENTS_KEEPALIVE', 0.01)
+    client = server.app.test_client()
+    first = client.get('/events', buffered=False)
+    try:
+        refused = client.get('/events', buffered=False)
+        assert refused.status_code == 503
+        assert refused.headers['Retry-After']
+    finally:
+        first.close()
+    second = client.get('/events', buffered=False)
+    assert second.status_code == 200
+    second.close()
+
+
+def test_malformed_last_event_id_gets_live_events(server, mc, monkeypatch):
+    monkeypatch.setattr(server, 'EVENTS_KEEPALIVE', 0.01)
+    client = server.app.test_client()
+    ns_notifications.publish_event(mc, 'disruptions', [{'header': 'Traject: Haarlem - Leiden Centraal'}])
+
+    response = client.get('/events', headers={'Last-Event-ID': 'abc'}, buffered=False)
+    try:
+        assert response.status_code == 200
+        ns_notifications.publish_event(mc, 'trips', [{'header': 'IC Haarlem-Leiden Centraal'}], '1')
+        server.event_broker.poll()
+        assert read_events(response, 1)[0].startswith(b'id: 2\nevent: trips\n')
+    finally:
+        response.close()
+
+
+def test_streams_falling_behind_are_closed(server, mc, monkeypatch):
+    monkeypatch.setattr(server, 'EVENTS_KEEPALIVE', 0.01)
+    monkeypatch.setattr(server, 'EVENTS_KEEP', 2)
+    client = server.app.test_client()
+    response = client.get('/events', buffered=False)
+    try:
+        for _ in range(3):
+            ns_notifications.publish_event(mc, 'trips', [{'header': 'IC Haarlem-Leiden Centraal'}], '1')
+        server.event_broker.poll()
+        assert not server.event_broker.subscribers
+        # The queued events are sent, then the stream ends and the client reconnects with Last-Event-ID
+        events = [chunk for chunk in response.response if not chunk.startswith(b':')]
+        assert [event.split(b'\n')[0] for event in events] == [b'id: 1', b'id: 2']
+    finally:
+        response.close()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Several notifier nodes sharing one state store: every route is polled by one node, and the trips of all nodes
+together are the ones a single node would keep
+"""
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import benchmark
+import ns_notifications
+from fake_services import FakeNS
+from sharding import Shard
+from state_store import LRUStore
+
+NODES = 3
+
+
+class CountingFakeNS(FakeNS):
+    """
+    FakeNS counting the trip queries per departure, destination and time
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingFakeNS, self).__init__(*args, **kwargs)
+        self.queries = collections.Counter()
+
+    def respond(self, method, url, body):
+        query = parse_qs(url.query)
+        if url.path.endswith('/trips'):
+            with self.lock:
+                self.queries[(query['fromStation'][0], query['toStation'][0], query['dateTime'][0])] += 1
+        return super(CountingFakeNS, self).respond(method, url, body)
+
+
+def get_trip_keys(trips):
+    return sorted((trip.departure, trip.destination, trip.departure_time_planned) for trip in trips or [])
+
+
+def test_routes_are_polled_once_and_stored_per_node(tmp_path):
+    # Slow enough for the runs of the nodes to overlap
+    fake_ns = CountingFakeNS(benchmark.STATIONS, 0, latency=0.05).start()
+    try:
+        benchmark.write_harness_config(str(tmp_path), fake_ns.url, fake_ns.url, 12, 3)
+        settings = ns_notifications.get_config(str(tmp_path))
+        nsapi = ns_notifications.get_nsapi(settings)
+        server = LRUStore()
+        shards = [Shard(benchmark.LRUClient(server), 'node-' + str(node)) for node in range(NODES)]
+        for shard in shards:
+            shard.heartbeat()
+        user_routes = ns_notifications.get_valid_user_routes(settings, shards[0].mc, nsapi,
+                                                                  logging.getLogger('ns_notifications'))
+
+        def run_node(shard):
+            # Like run_notifications, knowing all nodes that started
+            shard.heartbeat()
+            ns_notifications.get_changed_trips_for_users(
+                shard.mc, nsapi, shard.filter_routes(user_routes, ns_notifications.get_route_key),
+                node_id=shard.node_id)
+
+        with ThreadPoolExecutor(NODES) as executor:
+            list(executor.map(run_node, shards))
+        queries = dict(fake_ns.queries)
+        single = LRUStore()
+        ns_notifications.get_changed_trips_for_users(single, nsapi, user_routes)
+    finally:
+        fake_ns.stop()
+
+    unique_routes = set(ns_notifications.get_route_key(route) for routes in user_routes.values() for route in routes)
+    assert len(queries) == len(unique_routes)
+    assert set(queries.values()) == {1}
+    for userkey in user_routes:
+        assert get_trip_keys(ns_notifications.get_user_trips(server, userkey)) == get_trip_keys(
+            ns_notifications.get_user_trips(single, userkey))
+
+
+def test_routes_of_a_stopped_node_move_to_the_others():
+    now = [0]
+    server = LRUStore(clock=lambda: now[0])
+    shards = [Shard(benchmark.LRUClient(server), 'node-' + str(node), lease_ttl=600) for node in range(NODES)]
+    user_routes = {'1': [{'departure': departure, 'destination': destination, 'time': '7:44'}
+                         for departure in benchmark.STATIONS for destination in benchmark.STATIONS[:4]
+                         if departure != destination]}
+    for shard in shards:
+        shard.heartbeat()
+    for shard in shards:
+        shard.heartbeat()
+    before = [shard.filter_routes(user_routes, ns_notifications.get_route_key)['1'] for shard in shards]
+    assert all(before) and sum(len(routes) for routes in before) == len(user_routes['1'])
+
+    # The last node stops: once its heartbeat expired, the others split its routes
+    now[0] = 400
+    for shard in shards[:-1]:
+        shard.heartbeat()
+    now[0] = 700
+    after = [shard.filter_routes(user_routes, ns_notifications.get_route_key)['1'] for shard in shards[:-1]
+             if shard.heartbeat()]
+    assert sorted(route['departure'] + route['destination'] for routes in after for route in routes) == sorted(
+        route['departure'] + route['destination'] for route in user_routes['1'])
+    for routes_before, routes_after in zip(before, after):
+        assert all(route in routes_after for route in routes_before)
+    # Its trips are no longer read
+    assert ns_notifications.get_trips_keys(server, '1') == ['1_trips_node-0', '1_trips_node-1']
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+NS API objects in the state: what the notifier stores must come back equal, or every run finds changes
+"""
+import json
+
+import ns_api
+
+import ns_client
+import ns_notifications
+from fake_services import FakeNS
+
+STATIONS = ['Amsterdam Centraal', 'Haarlem', 'Utrecht Centraal']
+
+
+def test_trips_come_back_equal():
+    fake_ns = FakeNS(STATIONS, 2).start()
+    try:
+        nsapi = ns_client.NotifierNSAPI('test', base_url=fake_ns.url)
+        trips = nsapi.get_trips('07:44', 'Amsterdam Centraal', None, 'Utrecht Centraal', True)
+    finally:
+        fake_ns.stop()
+    for codec in ns_notifications.STATE_CODECS:
+        try:
+            serializer = ns_notifications.get_serializer(codec)
+        except ValueError:
+            # msgpack not installed
+            continue
+        stored, flags = serializer('1_trips', ns_notifications.dump_objects(trips))
+        restored = ns_notifications.load_objects(ns_notifications.json_deserializer('1_trips', stored, flags))
+
+        assert restored == trips
+        assert ns_api.list_diff(restored, trips) == []
+        assert restored[1].delay == trips[1].delay
+
+
+def test_disruptions_without_timestamp_are_stored():
+    disruptions = ns_api.NSAPI.parse_disruptions(json.dumps({'payload': [
+        {'id': 'prio-1', 'type': 'verstoring', 'titel': 'Haarlem - Leiden Centraal', 'verstoring': 'Seinstoring'}]}))
+    stored = ns_notifications.dump_objects(disruptions['unplanned'])
+    restored = ns_notifications.load_objects(json.loads(json.dumps(stored)))
+
+    assert restored == disruptions['unplanned']
+    assert restored[0].timestamp is None
+
+
+def test_values_of_ns_api_are_still_read():
+    station = ns_api.Station()
+    station.code, station.names = 'HLM', {'long': 'Haarlem'}
+    assert ns_notifications.load_objects([station.to_json()]) == [station]
+
+
+def test_json_strings_of_older_versions_are_still_read():
+    disruptions = ns_api.NSAPI.parse_disruptions(json.dumps({'payload': [
+        {'id': 'prio-1', 'type': 'verstoring', 'titel': 'Haarlem - Leiden Centraal', 'verstoring': 'Seinstoring'}]}))
+    stored = [json.dumps({'$object': state}) for state in ns_notifications.dump_objects(disruptions['unplanned'])]
+    assert ns_notifications.load_objects(stored) == disruptions['unplanned']
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Retries and circuit breakers of the upstream calls
+"""
+import configparser
+
+import pytest
+import requests
+
+import upstream
+
+
+class NotFound(requests.exceptions.HTTPError):
+    def __init__(self):
+        response = requests.models.Response()
+        response.status_code = 404
+        super(NotFound, self).__init__('404 Not Found', response=response)
+
+
+def half_open_upstream():
+    breaker = upstream.CircuitBreaker(threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == 'half-open'
+    return upstream.Upstream('test', upstream.Budget(), retries=0, breaker=breaker)
+
+
+def fail(error):
+    def function(timeout):
+        raise error
+    return function
+
+
+def test_trial_ends_on_errors_that_are_not_retried():
+    service = half_open_upstream()
+    with pytest.raises(NotFound):
+        service.call(fail(NotFound()))
+    # Not stuck waiting for the outcome of the trial
+    assert service.call(lambda timeout: 'answer') == 'answer'
+    assert service.breaker.state == 'closed'
+
+
+def test_trial_ends_when_the_budget_is_used_up():
+    service = half_open_upstream()
+    service.budget.reset(0)
+    with pytest.raises(upstream.BudgetExhaustedError):
+        service.call(lambda timeout: 'answer')
+    service.budget.reset()
+    assert service.call(lambda timeout: 'answer') == 'answer'
+
+
+def test_failed_trial_opens_the_circuit_again():
+    service = half_open_upstream()
+    service.breaker.reset_timeout = 60
+    service.breaker.opened_at -= 60
+    with pytest.raises(requests.exceptions.ConnectionError):
+        service.call(fail(requests.exceptions.ConnectionError()))
+    assert service.breaker.state == 'open'
+    with pytest.raises(upstream.CircuitOpenError):
+        service.call(lambda timeout: 'answer')
+
+
+def test_configure_keeps_the_state_of_the_breakers():
+    settings = configparser.ConfigParser()
+    settings['General'] = {'breaker_threshold': '1', 'upstream_retries': '0'}
+    upstream.configure(settings)
+    nsapi = upstream.get_upstream('nsapi')
+    with pytest.raises(requests.exceptions.ConnectionError):
+        nsapi.call(fail(requests.exceptions.ConnectionError()))
+
+    settings['General']['breaker_reset'] = '120'
+    upstream.configure(settings)
+    assert upstream.get_upstream('nsapi') is nsapi
+    assert nsapi.breaker.state == 'open'
+    assert nsapi.breaker.reset_timeout == 120
+    nsapi.breaker.record_success()
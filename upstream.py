@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Calls to the upstream services (NS API, GitHub, openHAB) with timeouts, jittered retries within the time
+budget of a run, and a circuit breaker per upstream
+"""
+import random
+import threading
+import time
+
+import requests
+
+import metrics
+
+# Seconds to connect and to wait for an answer, per attempt
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+# Attempts after the first one, and the base of the (exponential, jittered) wait between attempts
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+# The circuit of an upstream opens after this many failures in a row, and lets a trial call through after
+# BREAKER_RESET seconds
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 60
+# Seconds a run may spend waiting on upstreams, retries included
+TICK_BUDGET = 60
+
+# HTTP statuses worth trying again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    The upstream failed too often lately, it is not called until its circuit closes again
+    """
+
+
+class BudgetExhaustedError(requests.exceptions.Timeout):
+    """
+    The time budget of this run is used up
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Counts the failures of an upstream in a row. Once open, calls fail at once until reset_timeout passed,
+    after which one trial call decides whether the circuit closes again
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+    def release(self):
+        """
+        End a trial call that says nothing about the upstream, so the next call is a trial again
+        """
+        with self._lock:
+            self._trial = False
+
+
+class Budget(object):
+    """
+    Deadline shared by all upstream calls of one run
+    """
+
+    def __init__(self, seconds=None):
+        self.reset(seconds)
+
+    def reset(self, seconds=None):
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+
+class Upstream(object):
+    """
+    One upstream service, with its own circuit breaker and the shared budget of the run
+    """
+
+    def __init__(self, name, budget, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES,
+                 breaker=None):
+        self.name = name
+        self.budget = budget
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+
+    def get_timeout(self):
+        """
+        (connect, read) timeout of the next attempt, never beyond the budget of the run
+        """
+        remaining = self.budget.remaining()
+        if remaining is not None and remaining <= 0:
+            raise BudgetExhaustedError('Time budget of this run is used up, not calling ' + self.name)
+        if remaining is None:
+            return self.connect_timeout, self.read_timeout
+        return min(self.connect_timeout, remaining), min(self.read_timeout, remaining)
+
+    def call(self, function, retry_on=(requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        """
+        Call function(timeout) until it succeeds, an exception not in retry_on is raised, the retries are used up
+        or waiting for the next attempt would exceed the budget. Of the HTTP errors, only the ones with a status
+        from RETRY_STATUSES are retried; only retried errors count for the circuit breaker
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                metrics.inc('upstream_errors_total', upstream=self.name, endpoint='circuit_open')
+                raise CircuitOpenError('Circuit of ' + self.name + ' is open')
+            succeeded = None
+            try:
+                result = function(self.get_timeout())
+                succeeded = True
+            except BudgetExhaustedError:
+                raise
+            except Exception as e:
+                # HTTP errors (of requests, or of the client of openHAB) carry the response
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                retryable = status in RETRY_STATUSES if status else isinstance(e, retry_on)
+                if retryable:
+                    succeeded = False
+                if not retryable or attempt >= self.retries:
+                    raise
+                wait = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+                remaining = self.budget.remaining()
+                if remaining is not None and wait >= remaining:
+                    raise
+            finally:
+                # Also ends the trial call of a half-open circuit when the attempt did not count (the budget was used
+                # up, or the error is not retried)
+                if succeeded is None:
+                    self.breaker.release()
+                elif succeeded:
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+            if succeeded:
+                return result
+            metrics.inc('upstream_retries_total', upstream=self.name)
+            time.sleep(wait)
+            attempt += 1
+
+    def request(self, session, method, url, **kwargs):
+        """
+        Do an HTTP request with session through call(), raising HTTPError for error statuses
+        """
+        def send(timeout):
+            response = session.request(method, url, timeout=timeout, **kwargs)
+            response.raise_for_status()
+            return response
+        return self.call(send)
+
+
+## The upstreams of this process, sharing one budget
+budget = Budget()
+_upstreams = {}
+_upstreams_lock = threading.Lock()
+
+
+def configure(settings):
+    """
+    Set the timeouts, retries and breakers of all upstreams from the [General] section of settings. Upstreams
+    configured before keep the state of their breaker
+    """
+    general = settings['General']
+    with _upstreams_lock:
+        for name in ('nsapi', 'github', 'openhab', 'pushbullet', 'webhook'):
+            if name not in _upstreams:
+                _upstreams[name] = Upstream(name, budget)
+            configured = _upstreams[name]
+            configured.connect_timeout = general.getfloat('upstream_connect_timeout', fallback=CONNECT_TIMEOUT)
+            configured.read_timeout = general.getfloat('upstream_read_timeout', fallback=READ_TIMEOUT)
+            configured.retries = general.getint('upstream_retries', fallback=RETRIES)
+            configured.breaker.threshold = general.getint('breaker_threshold', fallback=BREAKER_THRESHOLD)
+            configured.breaker.reset_timeout = general.getfloat('breaker_reset', fallback=BREAKER_RESET)
+
+
+def get_upstream(name):
+    with _upstreams_lock:
+        if name not in _upstreams:
+            _upstreams[name] = Upstream(name, budget)
+        return _upstreams[name]
+
+
+def start_tick(seconds=TICK_BUDGET):
+    """
+    Start the time budget of a run
+    """
+    budget.reset(seconds)
+
+
+def end_tick():
+    """
+    End the time budget of a run; calls between runs (like notifications sent in the background) have none
+    """
+    budget.reset()